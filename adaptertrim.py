@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# adaptertrim.py - trim adapter read-through from the FASTQs of a
+# demultiplexing output, streaming chunks of reads to a process pool.
+
+import argparse
+import gzip
+import json
+import os
+import re
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from redemux import COMPRESSION_LEVEL, read_records
+
+# reads handed to a worker at a time
+CHUNK_READS = 50000
+# chunks per worker process read but not yet written, bounds memory
+CHUNKS_IN_FLIGHT = 2
+# mismatches allowed per base of adapter overlap, as in cutadapt
+ERROR_RATE = 0.1
+# shortest adapter prefix trimmed at the end of a read
+MIN_OVERLAP = 3
+TRIMMED_DIR = 'Trimmed'
+STATS_FILE = 'adapter_trimming.tsv'
+STATS_COLUMNS = ['sample', 'read', 'reads', 'trimmed_reads',
+                 'percent_trimmed', 'bases_in', 'bases_out']
+# bcl2fastq output names, e.g. S1_S1_L001_R1_001.fastq.gz
+FASTQ_NAME = re.compile(r'^(.+)_S\d+(?:_L\d{3})?_(R\d)_\d{3}\.fastq\.gz$')
+SKIPPED_DIRS = ['Stats', 'Reports', 'shards', TRIMMED_DIR]
+
+def adapter_starts(seqs, adapter, error_rate=ERROR_RATE,
+                   min_overlap=MIN_OVERLAP):
+    """
+    Start of the adapter in each sequence, or its length if there is none.
+    The adapter matches at the first position where it, or the prefix of it
+    running off the end of the read, has at most error_rate mismatches per
+    base. Reads of a length are compared to the adapter together, one
+    position at a time.
+    """
+    starts = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    code = np.frombuffer(adapter, dtype=np.uint8)
+    by_length = {}
+    for i, seq in enumerate(seqs):
+        by_length.setdefault(len(seq), []).append(i)
+    for length, rows in by_length.items():
+        if length < min_overlap:
+            continue
+        rows = np.array(rows)
+        block = np.frombuffer(b''.join(seqs[i] for i in rows),
+                              dtype=np.uint8).reshape(len(rows), length)
+        for pos in range(length - min_overlap + 1):
+            overlap = min(len(code), length - pos)
+            allowed = int(overlap * error_rate)
+            mismatches = (block[:, pos:pos + overlap] !=
+                          code[:overlap]).sum(axis=1, dtype=np.int16)
+            hit = mismatches <= allowed
+            if hit.any():
+                # reads with an adapter found are not compared further
+                starts[rows[hit]] = pos
+                rows = rows[~hit]
+                block = block[~hit]
+                if not len(rows):
+                    break
+    return(starts)
+
+def trim_chunk(records, adapter, error_rate, min_overlap):
+    """
+    Trim a chunk of raw 4-line records. Returns the trimmed records as one
+    gzip member and the counts of the chunk. Reads are kept even if trimmed
+    to nothing, so paired files stay in step.
+    """
+    fields = [record.split(b'\n', 3) for record in records]
+    starts = adapter_starts([f[1] for f in fields], adapter, error_rate,
+                            min_overlap)
+    out = []
+    counts = {'reads': len(records), 'trimmed_reads': 0, 'bases_in': 0,
+              'bases_out': 0}
+    for (header, seq, plus, qual), start in zip(fields, starts):
+        counts['bases_in'] += len(seq)
+        counts['bases_out'] += int(start)
+        if start < len(seq):
+            counts['trimmed_reads'] += 1
+        out.append(b'\n'.join([header, seq[:start], plus,
+                               qual.rstrip(b'\n')[:start]]) + b'\n')
+    return(gzip.compress(b''.join(out), COMPRESSION_LEVEL), counts)
+
+def fastq_files(out_path):
+    """(relative path, sample, read) of the sample read FASTQs to trim."""
+    files = []
+    for root, dirs, names in os.walk(out_path):
+        if root == out_path:
+            dirs[:] = [d for d in dirs if d not in SKIPPED_DIRS]
+        dirs.sort()
+        for name in sorted(names):
+            match = FASTQ_NAME.match(name)
+            if match and not name.startswith('Undetermined'):
+                files.append((os.path.relpath(os.path.join(root, name),
+                                              out_path),
+                              match.group(1), match.group(2)))
+    return(files)
+
+class Trimmer:
+    def __init__(self, out_path, adapters, processes=None,
+                 error_rate=ERROR_RATE, min_overlap=MIN_OVERLAP,
+                 chunk_reads=CHUNK_READS):
+        self.out_path = out_path
+        # adapter of each read, e.g. {'R1': b'AGATCGG...', 'R2': ...}
+        self.adapters = adapters
+        self.processes = processes or os.cpu_count() or 1
+        self.error_rate = error_rate
+        self.min_overlap = min_overlap
+        self.chunk_reads = chunk_reads
+    def run(self, files):
+        """Trim files into TRIMMED_DIR; returns counts per (sample, read)."""
+        stats = {}
+        outputs = {}
+        pending = deque()
+        def finish():
+            path, future = pending.popleft()
+            if future is None:
+                outputs.pop(path).close()
+                return
+            member, counts = future.result()
+            outputs[path].write(member)
+            for key, value in counts.items():
+                stats[path][key] += value
+        with ProcessPoolExecutor(self.processes) as pool:
+            for path, sample, read in files:
+                adapter = self.adapters.get(read, self.adapters['R1'])
+                dest = os.path.join(self.out_path, TRIMMED_DIR, path)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                # concatenated gzip members are a valid gzip file
+                outputs[path] = open(dest, 'wb')
+                stats[path] = {'sample': sample, 'read': read, 'reads': 0,
+                               'trimmed_reads': 0, 'bases_in': 0,
+                               'bases_out': 0}
+                for chunk in read_records(os.path.join(self.out_path, path),
+                                          self.chunk_reads):
+                    pending.append((path, pool.submit(
+                        trim_chunk, chunk, adapter, self.error_rate,
+                        self.min_overlap)))
+                    while len(pending) > CHUNKS_IN_FLIGHT * self.processes:
+                        finish()
+                pending.append((path, None))
+            while pending:
+                finish()
+        return(stats)
+
+def sample_stats(stats):
+    """Counts summed per sample and read over lanes, in STATS_COLUMNS."""
+    summed = {}
+    for counts in stats.values():
+        key = (counts['sample'], counts['read'])
+        entry = summed.setdefault(key, dict(counts, reads=0, trimmed_reads=0,
+                                            bases_in=0, bases_out=0))
+        for name in ['reads', 'trimmed_reads', 'bases_in', 'bases_out']:
+            entry[name] += counts[name]
+    rows = []
+    for key in sorted(summed):
+        entry = summed[key]
+        entry['percent_trimmed'] = round(100.0 * entry['trimmed_reads'] /
+                                         entry['reads'], 2) \
+            if entry['reads'] else 0.0
+        rows.append([entry[col] for col in STATS_COLUMNS])
+    return(rows)
+
+def main():
+    parser = argparse.ArgumentParser(description='''Trim adapters from the
+                    sample FASTQs of a demultiplexing output into %s/.'''
+                    % TRIMMED_DIR)
+    parser.add_argument('out_path', help='Demultiplexing output directory')
+    parser.add_argument('-a', '--adapter', required=True,
+                        help='Adapter of read 1')
+    parser.add_argument('-A', '--adapter2',
+                        help='Adapter of read 2 (default: same as read 1)')
+    parser.add_argument('-p', '--processes', type=int,
+                        help='Worker processes (default: all cores)')
+    parser.add_argument('-e', '--error-rate', type=float, default=ERROR_RATE,
+                        help='Mismatches allowed per adapter base')
+    parser.add_argument('-O', '--overlap', type=int, default=MIN_OVERLAP,
+                        help='Shortest adapter prefix trimmed at read ends')
+    parser.add_argument('--chunk', type=int, default=CHUNK_READS,
+                        help='Reads sent to a worker at a time')
+    args = parser.parse_args()
+    adapters = {'R1': args.adapter.upper().encode('ascii')}
+    if args.adapter2:
+        adapters['R2'] = args.adapter2.upper().encode('ascii')
+    files = fastq_files(args.out_path)
+    if not files:
+        print('No sample FASTQs to trim in %s' % args.out_path)
+        return(0)
+    trimmer = Trimmer(args.out_path, adapters, args.processes,
+                      args.error_rate, args.overlap, args.chunk)
+    rows = sample_stats(trimmer.run(files))
+    fname = os.path.join(args.out_path, TRIMMED_DIR, STATS_FILE)
+    with open(fname, 'w') as outfile:
+        outfile.write('\t'.join(STATS_COLUMNS) + '\n')
+        for row in rows:
+            outfile.write('\t'.join(map(str, row)) + '\n')
+    with open(fname[:-len('.tsv')] + '.json', 'w') as outfile:
+        json.dump([dict(zip(STATS_COLUMNS, row)) for row in rows], outfile,
+                  indent=2)
+    for row in rows:
+        print('%-24s %s %10d reads, %6.2f%% trimmed' %
+              (row[0], row[1], row[2], row[4]))
+    return(0)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,17 +2,24 @@
 
 import argparse
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from iemwriter import IEMWriter,MissingBarcodeError
 from demuxscripter import DemuxScripter
+import timing
 import pipelineparams as params
 
 p = argparse.ArgumentParser()
-p.add_argument('-r', '--run_id', required=True,
+runs = p.add_mutually_exclusive_group(required=True)
+runs.add_argument('-r', '--run_id', nargs='+',
                type=str,
                help = '''Name of Illumina Instrument Run
-                    (e.g. 190624_A00421_0081_AHC7G3DRXX)''',
+                    (e.g. 190624_A00421_0081_AHC7G3DRXX). Several runs
+                    may be given to set them up in one batch.''',
                 metavar='run')
+runs.add_argument('-m', '--manifest', type=str,
+               help = '''File listing one Illumina Instrument Run per line.
+               Blank lines and lines starting with # are skipped.''')
 p.add_argument('-l', '--lanes', nargs='*', type = int,
                     help = '''List of lanes to demultiplex.
                     e.g. -l 1 4 8 or -l 2''', metavar='lane')
@@ -31,44 +38,173 @@ p.add_argument('-o', '--out_path', nargs='?',
 p.add_argument('-n','--nextera', action = 'store_true',
                help='''Add flag to indicate nextera adapters for MiSeq Nano Runs.
                Otherwise, Illumina adapters are assumed to be the case.''')
+p.add_argument('-s','--shard', type=int, metavar='N',
+               help='''Split bcl2fastq into concurrent jobs of N lanes each
+               (standard and patchpcr runs).''')
+p.add_argument('--incremental', action = 'store_true',
+               help='''Only demultiplex the lanes whose sample sheet rows
+               changed since the last finished demultiplexing of the run and
+               link the outputs of the other lanes (standard and patchpcr
+               runs).''')
+p.add_argument('--history', type=str,
+               default=getattr(params, 'demux_history', None),
+               help='''JSON lines file of past demultiplexing timings used to
+               tune the bcl2fastq thread counts.''')
+p.add_argument('--refresh', action = 'store_true',
+               help='''Query GNomEx even if cached records exist, e.g.
+               after correcting barcodes.''')
+p.add_argument('-j','--jobs', type=int, default=4,
+               help='''Number of runs to set up concurrently in batch
+               mode.''')
+p.add_argument('--submit', action = 'store_true',
+               help='''Queue demuxer.sh with the scheduler daemon
+               (scheduler.py) instead of printing the command to start it.''')
+p.add_argument('--priority', type=int, default=0,
+               help='''Priority of submitted runs, higher priorities start
+               first (e.g. 10 for urgent runs).''')
 p.add_argument('-b','--bcl2fastq', nargs=argparse.REMAINDER,
                help='''Any argument to pass to bcl2fastq. Note, these args
                are not sanitized.''')
-args = p.parse_args()
 
-# sanitize lanes
-if args.lanes:
-    valid_lanes = list(range(1,9))
-    args.lanes = [lane for lane in args.lanes if lane in valid_lanes]
-    # drop duplicate lanes
-    args.lanes = list(dict.fromkeys(args.lanes))
-else:
-    args.lanes = None
+def read_manifest(fname):
+    """Run ids listed in a manifest file, in order and without duplicates."""
+    run_ids = []
+    with open(fname) as manifest:
+        for line in manifest:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                run_ids.append(line.split()[0])
+    return(list(dict.fromkeys(run_ids)))
 
-# check the run folder exists
-run_folder_path = os.path.join(args.run_path, args.run_id)
-if not os.path.exists(run_folder_path):
-    raise OSError('Run path does not exist: %s' % run_folder_path)
-# create unique output directory
-date_folder = datetime.now().strftime("%Y%m%d-%H%M%S")
-out_demux_path = os.path.join(args.out_path, args.run_id, date_folder)
-os.makedirs(out_demux_path, exist_ok=True)
+def setup_run(run_id, args, date_folder, records=None):
+    """
+    Write the sample sheet and demultiplexing script of a single run.
+    Returns the output directory holding demuxer.sh.
+    """
+    # check the run folder exists
+    run_folder_path = os.path.join(args.run_path, run_id)
+    if not os.path.exists(run_folder_path):
+        raise OSError('Run path does not exist: %s' % run_folder_path)
+    # create unique output directory; runs set up within the same second
+    # (e.g. one per library type) get a numbered suffix
+    out_demux_path = os.path.join(args.out_path, run_id, date_folder)
+    suffix = 1
+    while True:
+        try:
+            os.makedirs(out_demux_path, exist_ok=False)
+            break
+        except FileExistsError:
+            suffix += 1
+            out_demux_path = os.path.join(args.out_path, run_id,
+                                          '%s-%d' % (date_folder, suffix))
+    # spans of this run, from this thread, go to its output directory
+    timing.configure(os.path.join(out_demux_path, timing.TIMINGS), run_id)
 
-if args.type == 'nano':
-    print("Nano: No SampleSheet.csv being written. User must specify SampleSheet.csv")
-else:
-    # write SampleSheet.CSV
-    iem = IEMWriter(args.run_id, out_demux_path, args.lanes)
-    write_header = args.type == 'standard' or args.type == 'patchpcr'
-    success = iem.write_sample_sheet(iem_header=write_header)
-    if not success:
-        raise Exception('Do not execute run until GNomEx records are available.')
+    if args.type == 'nano':
+        print("Nano: No SampleSheet.csv being written. User must specify SampleSheet.csv")
+    else:
+        # GNomEx access is only loaded for runs needing a sample sheet
+        from iemwriter import IEMWriter
+        # write SampleSheet.CSV
+        iem = IEMWriter(run_id, out_demux_path, args.lanes, records,
+                        args.refresh)
+        write_header = args.type == 'standard' or args.type == 'patchpcr'
+        success = iem.write_sample_sheet(iem_header=write_header)
+        if not success:
+            raise Exception('Do not execute run until GNomEx records are available.')
 
-# write script for demultiplexing demux.sh
-demuxer = DemuxScripter(args.run_id, run_folder_path, out_demux_path,
-                        args.type, args.nextera, args.bcl2fastq)
-demuxer.write_demux_script()
+    previous = None
+    if args.incremental:
+        from incremental import latest_output
+        previous = latest_output(os.path.join(args.out_path, run_id),
+                                 exclude=date_folder)
+        if previous is None:
+            print('No finished demultiplexing of %s to reuse, all lanes are '
+                  'demultiplexed' % run_id)
 
-print("Start demultiplexing with the following commands: ")
-print("cd " + out_demux_path)
-print("nohup ./demuxer.sh & ")
+    # write script for demultiplexing demux.sh
+    demuxer = DemuxScripter(run_id, run_folder_path, out_demux_path,
+                            args.type, args.nextera, args.bcl2fastq,
+                            args.shard, args.history, previous)
+    with timing.span('write_demux_script', demux_type=args.type):
+        demuxer.write_demux_script()
+    if args.submit:
+        ids = demuxer.submit(args.priority)
+        print('Queued %s as jobs %s' % (run_id, ', '.join(map(str, ids))))
+    return(out_demux_path)
+
+def setup_batch(run_ids, args, date_folder):
+    """
+    Set up several runs concurrently over one GNomEx query. Returns a list
+    of (run id, output directory or None, error or None) in input order;
+    a failing run does not stop the others.
+    """
+    if args.type == 'nano':
+        records = {run_id: None for run_id in run_ids}
+    else:
+        from runrecords import fetch_run_records
+        records = fetch_run_records(run_ids, args.lanes, args.refresh)
+    def attempt(run_id):
+        try:
+            out_demux_path = setup_run(run_id, args, date_folder,
+                                       records[run_id])
+            return((run_id, out_demux_path, None))
+        except Exception as err:
+            return((run_id, None, err))
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        return(list(pool.map(attempt, run_ids)))
+
+def main():
+    args = p.parse_args()
+
+    # sanitize lanes
+    if args.lanes:
+        valid_lanes = list(range(1,9))
+        args.lanes = [lane for lane in args.lanes if lane in valid_lanes]
+        # drop duplicate lanes
+        args.lanes = list(dict.fromkeys(args.lanes))
+    else:
+        args.lanes = None
+
+    if args.incremental and args.type not in ['standard', 'patchpcr']:
+        p.error('--incremental is only available for standard and patchpcr runs')
+
+    if args.manifest:
+        run_ids = read_manifest(args.manifest)
+    else:
+        run_ids = list(dict.fromkeys(args.run_id))
+    date_folder = datetime.now().strftime("%Y%m%d-%H%M%S")
+
+    if len(run_ids) == 1:
+        out_demux_path = setup_run(run_ids[0], args, date_folder)
+        if args.submit:
+            print("cd " + out_demux_path)
+            print("Follow the jobs with: python3 %s status" %
+                  os.path.join(params.alademux_path, 'scheduler.py'))
+            return(0)
+        print("Start demultiplexing with the following commands: ")
+        print("cd " + out_demux_path)
+        print("nohup ./demuxer.sh & ")
+        return(0)
+
+    results = setup_batch(run_ids, args, date_folder)
+    failed = [res for res in results if res[2] is not None]
+    print("Batch summary: %d of %d runs ready" %
+          (len(results) - len(failed), len(results)))
+    for run_id, out_demux_path, err in results:
+        if err is None:
+            print("OK      %s" % run_id)
+        else:
+            print("FAILED  %s: %s" % (run_id, err))
+    if args.submit and len(failed) < len(results):
+        print("\nFollow the jobs with: python3 %s status" %
+              os.path.join(params.alademux_path, 'scheduler.py'))
+    elif len(failed) < len(results):
+        print("\nStart demultiplexing with the following commands: ")
+        for run_id, out_demux_path, err in results:
+            if err is None:
+                print("(cd %s && nohup ./demuxer.sh &) " % out_demux_path)
+    return(1 if failed else 0)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# barcodes.py - pre-flight analysis of index collisions in a sample sheet and
+# selection of the largest safe bcl2fastq --barcode-mismatches.
+
+import itertools
+import numpy as np
+
+# bcl2fastq accepts 0, 1 or 2 mismatches per index read
+MAX_MISMATCHES = 2
+# marks positions past the end of a shorter index
+PAD = 255
+# rows of the distance matrix computed at a time, bounds memory per lane
+CHUNK = 256
+
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate(b'ACGT'):
+    BASE_CODES[base] = code
+    BASE_CODES[ord(chr(base).lower())] = code
+
+class BarcodeCollisionError(LookupError):
+    '''Samples in a lane share the same index combination.'''
+
+class BarcodeReport:
+    def __init__(self, dual):
+        self.dual = dual
+        # lane -> list of (sample, sample) pairs with identical indexes
+        self.collisions = {}
+        # lane -> largest safe (index, index2) mismatches within the lane
+        self.lane_mismatches = {}
+        self.most = (MAX_MISMATCHES, MAX_MISMATCHES if dual else 0)
+        self.mismatches = self.most
+    def format(self, mismatches):
+        if self.dual:
+            return('%d,%d' % mismatches)
+        return(str(mismatches[0]))
+    def option(self):
+        """Value for --barcode-mismatches."""
+        return(self.format(self.mismatches))
+    def summary(self):
+        lines = ['Barcode mismatches: %s' % self.option()]
+        for lane, mm in sorted(self.lane_mismatches.items()):
+            if mm == self.most or mm != self.mismatches:
+                continue
+            lines.append('lane %s limits mismatches to %s' %
+                         (lane, self.format(mm)))
+        for lane, pairs in sorted(self.collisions.items()):
+            for a, b in pairs:
+                lines.append('lane %s: %s and %s have identical indexes' %
+                             (lane, a, b))
+        return(lines)
+
+def encode(seqs):
+    """Barcodes as a (n, longest) uint8 array, shorter ones padded with PAD."""
+    length = max([len(seq) for seq in seqs] + [0])
+    codes = np.full((len(seqs), length), PAD, dtype=np.uint8)
+    for i, seq in enumerate(seqs):
+        if seq:
+            raw = np.frombuffer(seq.encode('ascii'), dtype=np.uint8)
+            codes[i, :len(seq)] = BASE_CODES[raw]
+    return(codes)
+
+def hamming_block(a, b):
+    """
+    Hamming distances between every row of a (k, L) and b (n, L). Positions
+    padded in either barcode are not counted, so barcodes of different
+    lengths are compared over their common prefix.
+    """
+    # one position at a time keeps the temporaries at (k, n)
+    dist = np.zeros((len(a), len(b)), dtype=np.int16)
+    for pos in range(a.shape[1]):
+        x = a[:, pos, None]
+        y = b[None, :, pos]
+        dist += (x != y) & (x != PAD) & (y != PAD)
+    return(dist)
+
+def candidate_mismatches(dual):
+    """(index, index2) mismatch pairs, most permissive first."""
+    second = range(MAX_MISMATCHES + 1) if dual else [0]
+    pairs = itertools.product(range(MAX_MISMATCHES + 1), second)
+    return(sorted(pairs, key=lambda mm: (-sum(mm), -mm[0])))
+
+def is_prefix_match(a, b):
+    """Equal over their common prefix, as hamming_block compares them."""
+    n = min(len(a), len(b))
+    return(a[:n] == b[:n])
+
+def find_identical(samples, index1, index2):
+    """Pairs of samples whose indexes do not differ at any compared base."""
+    seqs = [(i1.upper(), i2.upper()) for i1, i2 in zip(index1, index2)]
+    shortest = [min([len(seq[k]) for seq in seqs] + [0]) for k in [0, 1]]
+    groups = {}
+    for i, seq in enumerate(seqs):
+        groups.setdefault((seq[0][:shortest[0]], seq[1][:shortest[1]]),
+                          []).append(i)
+    identical = []
+    for members in groups.values():
+        for a, b in itertools.combinations(members, 2):
+            if is_prefix_match(seqs[a][0], seqs[b][0]) and \
+               is_prefix_match(seqs[a][1], seqs[b][1]):
+                identical.append((samples[a], samples[b]))
+    return(identical)
+
+def analyze_lane(samples, index1, index2, candidates):
+    """
+    Safe candidates and identical pairs for one lane. A pair of samples is
+    ambiguous under (m1, m2) mismatches if their index distance is at most
+    2*m1 and their index2 distance at most 2*m2.
+    """
+    # identical pairs by hashing, the distance blocks are then only needed
+    # while a candidate other than no mismatches is still safe
+    identical = find_identical(samples, index1, index2)
+    c1 = encode(index1)
+    c2 = encode(index2)
+    n = len(samples)
+    safe = set(candidates)
+    for start in range(0, n, CHUNK):
+        if not safe - {(0, 0)}:
+            break
+        stop = min(n, start + CHUNK)
+        d1 = hamming_block(c1[start:stop], c1)
+        d2 = hamming_block(c2[start:stop], c2)
+        # each unordered pair once
+        upper = np.arange(n)[None, :] > np.arange(start, stop)[:, None]
+        for mm in list(safe):
+            if np.any(upper & (d1 <= 2 * mm[0]) & (d2 <= 2 * mm[1])):
+                safe.discard(mm)
+    if identical:
+        safe.discard((0, 0))
+    return(safe, identical)
+
+def analyze_sample_sheet(sheet, use_index2=True):
+    """
+    Pairwise index distances within each lane of a SampleSheet. Returns a
+    BarcodeReport holding the largest --barcode-mismatches safe in every
+    lane and any samples whose indexes are identical. Set use_index2 to
+    False when the index2 read is not demultiplexed on (e.g. a UMI).
+    """
+    lanes = {}
+    for row in sheet.rows:
+        lanes.setdefault(row.get('Lane', '1'), []).append(row)
+    dual = use_index2 and any(row.get('index2') for row in sheet.rows)
+    report = BarcodeReport(dual)
+    candidates = candidate_mismatches(dual)
+    safe_everywhere = set(candidates)
+    for lane, rows in lanes.items():
+        # single sample lanes are written without barcodes
+        if len(rows) < 2:
+            continue
+        safe, identical = analyze_lane([row['Sample_ID'] for row in rows],
+                                       [row.get('index', '') for row in rows],
+                                       [row.get('index2', '') if dual else ''
+                                        for row in rows],
+                                       candidates)
+        if identical:
+            report.collisions[lane] = identical
+        safe_everywhere &= safe
+        report.lane_mismatches[lane] = next((mm for mm in candidates
+                                             if mm in safe), (0, 0))
+    report.mismatches = next((mm for mm in candidates
+                              if mm in safe_everywhere), (0, 0))
+    return(report)
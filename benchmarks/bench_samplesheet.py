@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# bench_samplesheet.py - time IEMWriter.write_sample_sheet on synthetic
+# records to check that it scales linearly with the number of samples.
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from iemwriter import IEMWriter
+from runrecords import RunRecord
+
+BASES = 'ACGT'
+
+def barcode(i, length=8):
+    """Distinct barcode for sample number i."""
+    seq = ''
+    for _ in range(length):
+        seq += BASES[i % 4]
+        i //= 4
+    return(seq)
+
+def synthetic_records(n_samples, n_lanes=4, run_id='BENCH_RUN'):
+    """n_samples records spread evenly over n_lanes, ordered by lane."""
+    per_lane = max(1, n_samples // n_lanes)
+    records = []
+    for i in range(n_samples):
+        lane = min(n_lanes, i // per_lane + 1)
+        records.append(RunRecord('HBENCHXX', lane, '%dX%d' % (17000 + i // 96, i),
+                                 'GRCh38', barcode(i), 'First', 'Last',
+                                 '%dR1' % (17000 + i // 96), barcode(i * 7 + 3),
+                                 'TruSeq', run_id))
+    return(records)
+
+def time_write(n_samples, out_dir, repeat=3):
+    """Best wall time in seconds of writing a sheet with n_samples rows."""
+    records = synthetic_records(n_samples)
+    best = None
+    for _ in range(repeat):
+        iem = IEMWriter('BENCH_RUN', out_dir, records=records)
+        start = time.perf_counter()
+        iem.write_sample_sheet()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return(best)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', nargs='+', type=int,
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--max-ratio', type=float, default=2.5,
+                        help='''Fail if the time per row of the largest size
+                        exceeds the smallest by more than this factor.''')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as out_dir:
+        per_row = []
+        print('rows      seconds   us/row')
+        for n in args.sizes:
+            elapsed = time_write(n, out_dir)
+            per_row.append(elapsed / n)
+            print('%-9d %-9.4f %.2f' % (n, elapsed, 1e6 * elapsed / n))
+    ratio = per_row[-1] / per_row[0]
+    print('time per row ratio largest/smallest: %.2f' % ratio)
+    if ratio > args.max_ratio:
+        print('Sample sheet writing does not scale linearly.')
+        return(1)
+    return(0)
+
+if __name__ == "__main__":
+    sys.exit(main())
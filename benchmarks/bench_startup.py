@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# bench_startup.py - measure the import time of the alademux code path of each
+# run type with python -X importtime and fail when a budget is exceeded.
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(BENCH)
+
+# modules each run type imports between start-up and writing demuxer.sh;
+# DemuxScripter.features loads the estimator for every sample sheet run
+RUN_TYPE_IMPORTS = {
+    'nano': ['alademux', 'estimator'],
+    'standard': ['alademux', 'iemwriter', 'barcodes', 'estimator'],
+    'patchpcr': ['alademux', 'iemwriter', 'barcodes', 'estimator'],
+    '10x': ['alademux', 'iemwriter', 'estimator'],
+    '10x-atac': ['alademux', 'iemwriter', 'estimator'],
+}
+# loaded in addition once a demux history is configured, to fit the estimate
+HISTORY_IMPORTS = ['numpy']
+# written to stderr between the settings stand-in and the measured imports
+MARKER = 'alademux imports'
+
+# import time budget of each run type in ms, about twice the typical time so
+# that a busy host does not fail the check; numpy alone takes ~90 ms
+BUDGET_MS = {
+    'nano': 120,
+    'standard': 300,
+    'patchpcr': 300,
+    '10x': 150,
+    '10x-atac': 150,
+}
+
+# added to the budgets with a demux history for numpy, which standard and
+# Patch PCR runs load anyway for the barcode checks
+HISTORY_BUDGET_MS = {
+    'nano': 100,
+    '10x': 100,
+    '10x-atac': 100,
+}
+
+# heavy dependencies no run type should load
+FORBIDDEN = ['pandas', 'pyodbc']
+
+def import_profile(modules, work):
+    """
+    Total import time in seconds and the set of imported module names of a
+    fresh interpreter importing modules, parsed from -X importtime. The
+    settings come from bench_suite.setup_params, so no production
+    pipelineparams is needed; its own imports are not counted.
+    """
+    setup = ['from bench_suite import setup_params',
+             'setup_params(%r)' % work,
+             'import sys',
+             'sys.stderr.write(%r)' % (MARKER + '\n')]
+    code = '; '.join(setup + ['import %s' % module for module in modules])
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([REPO, BENCH] +
+                                        [path for path in
+                                         [env.get('PYTHONPATH')] if path])
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          cwd=REPO, env=env, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+    total = 0
+    imported = set()
+    lines = proc.stderr.splitlines()
+    for line in lines[lines.index(MARKER) + 1:]:
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        if not fields[0].strip().isdigit():
+            # column header
+            continue
+        name = fields[2]
+        imported.add(name.strip())
+        # top level imports carry the time of their nested imports
+        if not name[1:].startswith(' '):
+            total += int(fields[1])
+    return(total / 1e6, imported)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--types', nargs='+', default=sorted(RUN_TYPE_IMPORTS),
+                        choices=sorted(RUN_TYPE_IMPORTS))
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Interpreters started per run type, best is kept')
+    parser.add_argument('--max-ms', type=float,
+                        help='''Import time budget of every run type in ms
+                        (default: per run type, see BUDGET_MS)''')
+    parser.add_argument('--history', action='store_true',
+                        help='Include the imports of runs with a demux history')
+    args = parser.parse_args()
+    failed = False
+    work = tempfile.mkdtemp(prefix='alademux_startup_')
+    print('type       import ms  modules')
+    for run_type in args.types:
+        modules = RUN_TYPE_IMPORTS[run_type]
+        if args.history:
+            modules = modules + HISTORY_IMPORTS
+        best = None
+        for _ in range(args.repeat):
+            seconds, imported = import_profile(modules, work)
+            best = seconds if best is None else min(best, seconds)
+        print('%-10s %-10.1f %d' % (run_type, 1e3 * best, len(imported)))
+        heavy = [name for name in FORBIDDEN if name in imported]
+        if heavy:
+            print('  imports %s' % ', '.join(heavy))
+            failed = True
+        budget = args.max_ms or BUDGET_MS[run_type]
+        if args.history and not args.max_ms:
+            budget += HISTORY_BUDGET_MS.get(run_type, 0)
+        if 1e3 * best > budget:
+            print('  over the %.0f ms budget' % budget)
+            failed = True
+    shutil.rmtree(work)
+    return(1 if failed else 0)
+
+if __name__ == "__main__":
+    sys.exit(main())
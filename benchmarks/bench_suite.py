@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# bench_suite.py - time and measure the peak memory of the sample sheet and
+# script generation stages on synthetic runs against a SQLite GNomEx stand-in,
+# and compare the results with a stored baseline.
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH))
+sys.path.insert(0, BENCH)
+
+RUN_ID = '191001_A00421_0100_BHSYNTHXX'
+DEFAULT_BASELINE = os.path.join(BENCH, 'baseline.json')
+
+def setup_params(work):
+    """
+    Point the pipeline settings at the synthetic environment. A stand-in
+    settings module is used when pipelineparams is not installed.
+    """
+    try:
+        import pipelineparams as params
+    except ImportError:
+        params = types.ModuleType('pipelineparams')
+        sys.modules['pipelineparams'] = params
+    params.db_user = params.db_password = None
+    params.gnomex_sqlite = os.path.join(work, 'gnomex.sqlite')
+    params.gnomex_cache_path = None
+    params.alademux_path = work
+    params.illumina_run_path = os.path.join(work, 'runs')
+    params.demux_result_path = os.path.join(work, 'demux')
+    params.bcl2fastq_path = 'bcl2fastq'
+    for name in ['cellranger_path', 'cellranger_atac_path', 'longranger_path']:
+        setattr(params, name, name.split('_')[0])
+    os.environ['GNOMEX_SQLITE'] = params.gnomex_sqlite
+    os.environ['ALADEMUX_NO_CACHE'] = '1'
+    return(params)
+
+class Scale:
+    def __init__(self, work, lanes, samples):
+        self.lanes = lanes
+        self.samples = samples
+        self.name = '%dx%d' % (lanes, samples)
+        self.root = os.path.join(work, self.name)
+        self.run_folder = os.path.join(self.root, 'runs', RUN_ID)
+        self.out_path = os.path.join(self.root, 'out')
+        os.makedirs(self.out_path, exist_ok=True)
+        self.sheet = os.path.join(self.out_path, 'SampleSheet.csv')
+
+def measure(func, setup=None, repeat=3):
+    """Best wall time over repeat calls and the peak traced memory of one."""
+    best = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    if setup:
+        setup()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return({'seconds': round(best, 5), 'peak_bytes': peak})
+
+def run_scale(work, lanes, samples, repeat=3):
+    """Results of every stage at one scale, keyed by stage."""
+    from demuxscripter import DemuxScripter
+    from iemwriter import IEMWriter
+    from barcodes import analyze_sample_sheet
+    from samplesheet import read_sample_sheet
+    import gnomex
+    import runinfo
+    # imports the pipeline modules, so only once the settings are in place
+    import synthetic
+    scale = Scale(work, lanes, samples)
+    synthetic.create_gnomex(os.path.join(work, 'gnomex.sqlite'), RUN_ID,
+                            lanes, samples)
+    # pooled connections still point at the previous scale's database
+    gnomex.get_pool().close()
+    synthetic.create_run_folder(scale.run_folder, RUN_ID, lanes)
+    per_lane = max(1, (samples + lanes - 1) // lanes)
+    synthetic.create_tags(os.path.join(work, '10x_tags.tsv'), per_lane,
+                          synthetic.index_length(per_lane))
+    results = {}
+    records = []
+    def query():
+        records[:] = IEMWriter(RUN_ID, scale.out_path).execute_query()
+    results['gnomex_query'] = measure(query, repeat=repeat)
+    iem = IEMWriter(RUN_ID, scale.out_path, records=records)
+    results['write_sample_sheet'] = measure(
+        lambda: iem.write_sample_sheet(iem_header=False), repeat=repeat)
+    shutil.copy(scale.sheet, scale.sheet + '.orig')
+    def restore():
+        shutil.copy(scale.sheet + '.orig', scale.sheet)
+    def parse():
+        runinfo._load.cache_clear()
+        runinfo.load_run(scale.run_folder)
+    results['runinfo'] = measure(parse, repeat=repeat)
+    results['barcode_check'] = measure(
+        lambda: analyze_sample_sheet(read_sample_sheet(scale.sheet)),
+        restore, repeat)
+    tenx = DemuxScripter(RUN_ID, scale.run_folder, scale.out_path, '10x',
+                         False)
+    results['tag_swapper'] = measure(tenx.tag_swapper, restore, repeat)
+    def patchpcr():
+        DemuxScripter(RUN_ID, scale.run_folder, scale.out_path, 'patchpcr',
+                      False).patchpcr()
+    results['patchpcr'] = measure(patchpcr, restore, repeat)
+    return(scale.name, results)
+
+def compare(results, baseline, time_tolerance, memory_tolerance):
+    """Lines describing stages slower or larger than the baseline."""
+    regressions = []
+    for scale, stages in results.items():
+        for stage, now in stages.items():
+            before = baseline.get(scale, {}).get(stage)
+            if not before:
+                continue
+            if now['seconds'] > before['seconds'] * (1 + time_tolerance):
+                regressions.append('%s %s: %.4f s, baseline %.4f s' %
+                                   (scale, stage, now['seconds'],
+                                    before['seconds']))
+            if now['peak_bytes'] > before['peak_bytes'] * (1 + memory_tolerance):
+                regressions.append('%s %s: %.1f MB peak, baseline %.1f MB' %
+                                   (scale, stage, now['peak_bytes'] / 1e6,
+                                    before['peak_bytes'] / 1e6))
+    return(regressions)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', nargs='+', default=['1x96', '4x1536',
+                                                        '8x100000'],
+                        help='Scales as LANESxSAMPLES, samples in total')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save', action='store_true',
+                        help='Store these results as the baseline')
+    parser.add_argument('--time-tolerance', type=float, default=0.5,
+                        help='Allowed slowdown over the baseline, 0.5 = 50%%')
+    parser.add_argument('--memory-tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+    work = tempfile.mkdtemp(prefix='alademux_bench_')
+    try:
+        setup_params(work)
+        results = {}
+        print('%-10s %-20s %10s %10s' % ('scale', 'stage', 'seconds',
+                                          'peak MB'))
+        for scale in args.scales:
+            lanes, samples = [int(v) for v in scale.split('x')]
+            # the stages print progress meant for alademux users
+            with contextlib.redirect_stdout(io.StringIO()):
+                name, stages = run_scale(work, lanes, samples, args.repeat)
+            results[name] = stages
+            for stage, r in stages.items():
+                print('%-10s %-20s %10.4f %10.1f' % (name, stage, r['seconds'],
+                                                     r['peak_bytes'] / 1e6))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    if args.save:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as infile:
+                baseline = json.load(infile)
+        baseline.update(results)
+        with open(args.baseline, 'w') as outfile:
+            json.dump(baseline, outfile, indent=2, sort_keys=True)
+        print('Baseline written to %s' % args.baseline)
+        return(0)
+    if not os.path.exists(args.baseline):
+        # timings are host specific, so each host stores its own baseline
+        print('No baseline at %s, run with --save on this host to create one'
+              % args.baseline)
+        return(2)
+    with open(args.baseline) as infile:
+        baseline = json.load(infile)
+    regressions = compare(results, baseline, args.time_tolerance,
+                          args.memory_tolerance)
+    for line in regressions:
+        print('REGRESSION ' + line)
+    return(1 if regressions else 0)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# synthetic.py - synthetic GNomEx records in a SQLite stand-in schema, run
+# folders and 10x tag tables at configurable scale, for the benchmarks.
+
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_samplesheet import barcode
+
+# the tables and columns of GNomEx read by runrecords.RECORD_QUERY
+SCHEMA = """
+create table flowcell(idflowcell integer primary key, barcode text);
+create table flowcellchannel(idflowcellchannel integer primary key,
+    idflowcell integer, number integer, filename text);
+create table sequencelane(idsequencelane integer primary key,
+    idflowcellchannel integer, idsample integer,
+    idgenomebuildalignto integer, idrequest integer);
+create table sample(idsample integer primary key, number text,
+    barcodesequence text, barcodesequenceb text, idseqlibprotocol integer);
+create table genomebuild(idgenomebuild integer primary key,
+    genomebuildname text);
+create table request(idrequest integer primary key, number text,
+    idappuser integer);
+create table appuser(idappuser integer primary key, firstname text,
+    lastname text);
+create table seqlibprotocolapplication(idseqlibprotocol integer,
+    codeapplication text);
+create table application(codeapplication text, application text);
+create index flowcellchannel_filename on flowcellchannel(filename);
+create index sequencelane_channel on sequencelane(idflowcellchannel);
+"""
+
+# samples per GNomEx request, as in a 96 well plate
+PER_REQUEST = 96
+
+def index_length(per_lane):
+    """Shortest of 8 or 10 bases giving per_lane distinct indexes."""
+    return(8 if per_lane <= 4**8 else 10)
+
+def create_gnomex(fname, run_id, lanes, samples, application='TruSeq'):
+    """
+    SQLite stand-in holding one run of lanes lanes and samples samples in
+    total, spread evenly over the lanes with dual indexes unique per lane.
+    """
+    if os.path.exists(fname):
+        os.remove(fname)
+    db = sqlite3.connect(fname)
+    db.executescript(SCHEMA)
+    db.execute('insert into flowcell values (1, ?)', ('HSYNTHXX',))
+    db.executemany('insert into flowcellchannel values (?, 1, ?, ?)',
+                   [(lane, lane, run_id) for lane in range(1, lanes + 1)])
+    db.execute("insert into genomebuild values (1, 'GRCh38')")
+    db.execute("insert into appuser values (1, 'First', 'Last')")
+    db.execute("insert into seqlibprotocolapplication values (1, 'APP')")
+    db.execute("insert into application values ('APP', ?)", (application,))
+    n_requests = (samples + PER_REQUEST - 1) // PER_REQUEST
+    db.executemany('insert into request values (?, ?, 1)',
+                   [(i + 1, '%dR1' % (17000 + i)) for i in range(n_requests)])
+    per_lane = max(1, (samples + lanes - 1) // lanes)
+    length = index_length(per_lane)
+    sample_rows = []
+    lane_rows = []
+    for i in range(samples):
+        lane = min(lanes, i // per_lane + 1)
+        j = i - (lane - 1) * per_lane
+        sample_rows.append((i + 1, '%dX%d' % (17000 + i // PER_REQUEST, i + 1),
+                            barcode(j, length), barcode(j * 7 + 3, length), 1))
+        lane_rows.append((i + 1, lane, i + 1, 1, i // PER_REQUEST + 1))
+    db.executemany('insert into sample values (?, ?, ?, ?, ?)', sample_rows)
+    db.executemany('insert into sequencelane values (?, ?, ?, ?, ?)', lane_rows)
+    db.commit()
+    db.close()
+    return(fname)
+
+def create_run_folder(path, run_id, lanes, reads=(151, 8, 8, 151),
+                      surfaces=2, swaths=6, tiles=78):
+    """Run folder with a RunInfo.xml listing every tile of every lane."""
+    os.makedirs(path, exist_ok=True)
+    lines = ['<?xml version="1.0"?>',
+             '<RunInfo Version="5"><Run Id="%s" Number="1">' % run_id,
+             '<Flowcell>HSYNTHXX</Flowcell><Instrument>A00421</Instrument>',
+             '<Reads>']
+    for number, cycles in enumerate(reads, 1):
+        lines.append('<Read Number="%d" NumCycles="%d" IsIndexedRead="%s"/>' %
+                     (number, cycles, 'Y' if cycles < 20 else 'N'))
+    lines.append('</Reads>')
+    lines.append('<FlowcellLayout LaneCount="%d" SurfaceCount="%d" '
+                 'SwathCount="%d" TileCount="%d"><TileSet><Tiles>' %
+                 (lanes, surfaces, swaths, tiles))
+    for lane in range(1, lanes + 1):
+        for surface in range(1, surfaces + 1):
+            for swath in range(1, swaths + 1):
+                for tile in range(1, tiles + 1):
+                    lines.append('<Tile>%d_%d%d%02d</Tile>' %
+                                 (lane, surface, swath, tile))
+    lines.append('</Tiles></TileSet></FlowcellLayout></Run></RunInfo>')
+    with open(os.path.join(path, 'RunInfo.xml'), 'w') as outfile:
+        outfile.write('\n'.join(lines) + '\n')
+    return(path)
+
+def create_tags(fname, n, length=8):
+    """10x tag table mapping the first n synthetic barcodes to tag names."""
+    with open(fname, 'w') as outfile:
+        outfile.write('index\ttag\n')
+        for i in range(n):
+            outfile.write('%s\tSI-SYN-%d\n' % (barcode(i, length), i))
+    return(fname)
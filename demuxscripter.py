@@ -1,16 +1,25 @@
 #!/usr/bin/env python
 
-import multiprocessing
 import os
-import pandas as pd
 import stat
-import xml.dom.minidom
 import re
+import sys
+from runinfo import load_run
+from samplesheet import read_sample_sheet, write_sample_sheet
+from tenxtags import i5_reverse_complement, load_tags
+from threadplanner import plan_threads
+import timing
 import pipelineparams as params
 
+# fewest processing threads worth giving a lane shard
+MIN_SHARD_THREADS = 4
+# start of the current demuxer.sh stage, read by stage_timer()
+STAGE_START = 'STAGE_START=$(date +%s)\n'
+
 class DemuxScripter:
     def __init__(self, run_id, run_folder_path, out_path, demux_type,
-                 nextera, args_bcl2fastq=None):
+                 nextera, args_bcl2fastq=None, lanes_per_shard=None,
+                 history_file=None, previous_output=None):
         self.run_id = run_id
         self.in_path = run_folder_path
         self.out_path = out_path
@@ -23,48 +32,58 @@ class DemuxScripter:
         self.args = args_bcl2fastq
         # boolean True if nextera adapters used for miseq nano
         self.nextera = nextera
-        self.nprocs = str(multiprocessing.cpu_count() - 1)
-        transfer_path = os.path.join(params.alademux_path, 'templates')
-        self.transfer = {'standard': os.path.join(transfer_path,
-                                                  'standard_transfer.sh'),
-                         '10x': os.path.join(transfer_path,
-                                             '10x_transfer.sh'),
-                         '10x-atac': os.path.join(transfer_path,
-                                                  '10x_transfer.sh'),
-                         '10x-long': os.path.join(transfer_path,
-                                                  '10x_transfer.sh'),
-                         'patchpcr': os.path.join(transfer_path,
-                                                  'standard_transfer.sh'),
-                         'nano': os.path.join(transfer_path,
-                                                  'nano_report.sh')
-                         }
+        # past run timings used to tune the bcl2fastq thread counts
+        self.history_file = history_file
+        self.plan = None
+        self.barcode_report = None
+        # split bcl2fastq into concurrent jobs of this many lanes
+        self.lanes_per_shard = lanes_per_shard
+        # earlier output of the run whose unchanged lanes are reused
+        self.previous_output = previous_output
+        # lanes demultiplexed when only some of the sample sheet's are
+        self.demux_lanes = None
+        # MiSeq nano runs are reported rather than transferred
+        self.nano_report = os.path.join(params.alademux_path, 'templates',
+                                        'nano_report.sh')
+        # shell transfer templates, used until gnomex_fastq_path is set
+        template = '10x_transfer.sh' if demux_type.startswith('10x') \
+            else 'standard_transfer.sh'
+        self.transfer_template = os.path.join(params.alademux_path,
+                                              'templates', template)
         self.script = '#!/bin/bash\n\nset -e\n'
         self.script += 'IN_BCL2FASTQ=' + self.in_path + '\n'
         self.script += 'OUT_BCL2FASTQ=' + self.out_path + '\n'
-        self.script += 'RUN=' + self.run_id + '\n\n'
+        self.script += 'RUN=' + self.run_id + '\n'
+        # stage to run (demux, transfer or notify) as the scheduler does,
+        # all of them by default
+        self.script += 'STAGE=${1:-all}\n'
+        self.script += 'run_stage() { [ "$STAGE" = all ] || [ "$STAGE" = "$1" ]; }\n'
+        # peak memory of each demultiplexing command, for the history
+        self.script += ('measure() { if [ -x /usr/bin/time ]; then '
+                        '/usr/bin/time -f %%M -a -o %s "$@"; '
+                        'else "$@"; fi; }\n\n' %
+                        os.path.join('$OUT_BCL2FASTQ', timing.PEAK_RSS))
         self.script += 'cd $OUT_BCL2FASTQ\n\n'
         if self.type == 'nano':
             if self.nextera:
                 print("Trimming Nextera adapters...")
                 self.script += 'ADAPTER=CTGTCTCTTATACACATCT\n'
+                self.script += 'ADAPTER2=CTGTCTCTTATACACATCT\n'
             else:
                 print("Trimming Illumina adapters...")
                 self.script += 'ADAPTER=AGATCGGAAGAGCACACGTCTGAACTCCAGTCAC\n'
+                self.script += 'ADAPTER2=AGATCGGAAGAGCGTCGTGTAGGGAAAGAGTGT\n'
+    def run_descriptor(self):
+        run = load_run(self.in_path)
+        if run is None:
+            raise Exception('Flowcell File RunInfo.xml does not exist.')
+        return(run)
     def count_index_reads(self):
-        configfile = os.path.join(self.in_path, 'RunInfo.xml')
-        if not os.path.exists(configfile):
-          raise Exception('Flowcell File RunInfo.xml does not exist.')
-        doc = xml.dom.minidom.parse(configfile)
-        reads=doc.getElementsByTagName("Read")
-        key = 'IsIndexedRead'
-        n_index = 0
-        for read in reads:
-            if read.getAttribute(key) == 'Y':
-                n_index = n_index + 1
-        return(n_index)
+        return(len(self.run_descriptor().index_reads()))
     def tag_swapper(self):
+        """Replace the nucleotide index of each sample with its 10x tag."""
         fname_samples = os.path.join(self.out_path, 'SampleSheet.csv')
-        samples = pd.read_csv(fname_samples)
+        sheet = read_sample_sheet(fname_samples)
         # same barcodes for expression/VDJ as longranger
         if self.type == '10x' or self.type == '10x-long':
             fname_tags = os.path.join(params.alademux_path,'10x_tags.tsv')
@@ -72,49 +91,64 @@ class DemuxScripter:
             fname_tags = os.path.join(params.alademux_path,'10x_atac_tags.tsv')
         else:
             raise Exception('Only 10x tags should be swapped for indices.')
-        tags = pd.read_table(fname_tags)
-        # left join samples with tags
-        updated = pd.merge(samples,tags, on='index', how='left')
-        # report samples missing tags
-        missing = updated['tag'].isna()
-        if any(missing):
-            miss_samples=updated[missing]
+        tags = load_tags(fname_tags)
+        i5_reverse = i5_reverse_complement(load_run(self.in_path))
+        # look up each sample, reporting samples missing tags
+        missing = []
+        for row in sheet.rows:
+            name, notes = tags.resolve(row.get('index'), row.get('index2'),
+                                       i5_reverse)
+            for note in notes:
+                print('%s: %s' % (row['Sample_ID'], note))
+            if name is None:
+                missing.append(row['Sample_ID'])
+            row['index'] = name or ''
+        if missing:
             print('Samples missing 10x Genomics Barcodes are listed below: ')
-            for ms in miss_samples['Sample_ID']:
+            for ms in missing:
                 print(ms)
-        # the nucleotide information is no longer needed
-        updated = updated.drop(['index'], axis=1)
-        # rename the tag to index
-        updated.rename(columns={'tag': 'index'}, inplace=True)
-        # set to original order
-        cols=list(samples.columns)
-        updated = updated[cols]
         # re-name original IEM sample sheet
-        os.path.basename
         fname_previous = os.path.join(self.out_path, 'GNomEx_SampleSheet.csv')
         os.rename(fname_samples, fname_previous)
         # over-write filename
-        updated.to_csv(path_or_buf=fname_samples, index=False)
+        write_sample_sheet(sheet, fname_samples)
     def check_use_bases(self):
-        """Make sure the use-bases-mask argument has been specified."""
-        if self.args:
-            patt = '--use-bases-mask='
-            is_matched = [re.search(patt, arg) for arg in self.args]
-            if not any(is_matched):
-                raise Exception("""User must specify --use-bases-mask=
-                                for demultiplexing 10x data.""")
-        else:
-            raise Exception("""User must specify --use-bases-mask=
-                            for demultiplexing 10x data.""")
+        """
+        Make sure the use-bases-mask argument has been specified, deriving
+        it from RunInfo.xml and the sample sheet index lengths if not.
+        """
+        patt = '--use-bases-mask='
+        if self.args and any(re.search(patt, arg) for arg in self.args):
+            return(None)
+        if self.index_groups():
+            # each index geometry pass gets its own mask
+            return(None)
+        sheet = read_sample_sheet(os.path.join(self.out_path,
+                                               'SampleSheet.csv'))
+        index_lengths = [max([len(row.get(col, '')) for row in sheet.rows]
+                             + [0]) for col in ['index', 'index2']]
+        mask = self.run_descriptor().use_bases_mask(self.type, index_lengths)
+        print('Derived --use-bases-mask=%s' % mask)
+        self.args = (self.args or []) + [patt + mask]
         return(None)
+    def thread_plan(self):
+        """Loading, processing and writing threads for bcl2fastq."""
+        if self.plan is None:
+            fname = os.path.join(self.out_path, 'SampleSheet.csv')
+            n_samples = None
+            if os.path.exists(fname):
+                n_samples = len(read_sample_sheet(fname).rows)
+            self.plan = plan_threads(self.in_path, self.out_path, n_samples,
+                                     self.history_file)
+        return(self.plan)
     def standard(self):
         cmd = [params.bcl2fastq_path,
                '--runfolder-dir', '$IN_BCL2FASTQ',
                '--sample-sheet', os.path.join('$OUT_BCL2FASTQ',
                                               'SampleSheet.csv'),
                '--output-dir', '$OUT_BCL2FASTQ',
-               '--processing-threads', self.nprocs,
                ]
+        cmd.extend(self.thread_plan().args())
         return(cmd)
     def tenx(self):
         """Demultiplexing 10x Genomics libraries."""
@@ -144,7 +178,8 @@ class DemuxScripter:
         # check for required argument
         self.check_use_bases()
         # swap the 1st nucleotide index with the 10x tag
-        self.tag_swapper()
+        with timing.span('tag_swapper', demux_type=self.type):
+            self.tag_swapper()
         return(cmd)
     def keep_short_reads(self):
         """Add bcl2fastq options to keep short read lengths."""
@@ -154,17 +189,16 @@ class DemuxScripter:
         cmd.extend(short)
         return(cmd)
     def patchpcr(self):
+        # remove the NNNN placeholders of the UMI from the index columns
+        fname_samples = os.path.join(self.out_path,'SampleSheet.csv')
+        sheet = read_sample_sheet(fname_samples)
+        for row in sheet.rows:
+            for col in ['index', 'index2']:
+                if col in row:
+                    row[col] = re.sub('NNNN+', '', row[col])
+        write_sample_sheet(sheet, fname_samples)
         # check for required argument
         self.check_use_bases()
-        # remove NNNNs from SampleSheet index2
-        fname_samples = os.path.join(self.out_path,'SampleSheet.csv')
-        f = open(fname_samples,'r')
-        filedata = f.read()
-        f.close()
-        newdata = re.sub("NNNN+", "", filedata)
-        f = open(fname_samples,'w')
-        f.write(newdata)
-        f.close()
         return(self.keep_short_reads())
     def nano(self):
         return(self.keep_short_reads())
@@ -178,19 +212,386 @@ class DemuxScripter:
             cmd = self.patchpcr()
         elif self.type == 'nano':
             cmd = self.nano()
+        if self.type in ['standard', 'patchpcr']:
+            self.check_barcodes(cmd)
         # add the additional arguments to the command.
         if self.args:
             cmd.extend(self.args)
         return(cmd)
+    def check_barcodes(self, cmd):
+        """
+        Stop on samples with identical indexes in a lane and add the largest
+        safe --barcode-mismatches unless the user already chose one.
+        """
+        # numpy is only loaded for the runs checked here
+        from barcodes import BarcodeCollisionError, analyze_sample_sheet
+        fname = os.path.join(self.out_path, 'SampleSheet.csv')
+        # patchpcr reads index2 as a UMI
+        report = analyze_sample_sheet(read_sample_sheet(fname),
+                                      use_index2=self.type != 'patchpcr')
+        self.barcode_report = report
+        for line in report.summary():
+            print(line)
+        if report.collisions:
+            raise BarcodeCollisionError('Samples share indexes, correct '
+                                        'GNomEx before demultiplexing.')
+        user_set = self.args and any(re.search('--barcode-mismatches', arg)
+                                     for arg in self.args)
+        if not user_set:
+            cmd.extend(['--barcode-mismatches', report.option()])
+    def set_option(self, cmd, flag, value):
+        """Replace the value following flag in cmd, or append both."""
+        cmd = list(cmd)
+        if flag in cmd:
+            cmd[cmd.index(flag) + 1] = value
+        else:
+            cmd.extend([flag, value])
+        return(cmd)
+    def index_groups(self):
+        """
+        Rows of the sample sheet grouped by index geometry, the lengths of
+        index and index2, as a list of (name, lengths, rows). None unless the
+        sheet mixes geometries that no single --use-bases-mask can read and
+        the user did not give a mask.
+        """
+        if self.type not in ['standard', 'patchpcr']:
+            return(None)
+        if self.args and any(re.search('--use-bases-mask', arg)
+                             for arg in self.args):
+            return(None)
+        fname = os.path.join(self.out_path, 'SampleSheet.csv')
+        if not os.path.exists(fname):
+            return(None)
+        groups = {}
+        for row in read_sample_sheet(fname).rows:
+            # patchpcr reads index2 as a UMI
+            lengths = (len(row.get('index', '')),
+                       len(row.get('index2', ''))
+                       if self.type != 'patchpcr' else 0)
+            groups.setdefault(lengths, []).append(row)
+        if len(groups) < 2:
+            return(None)
+        return([('I%d' % lengths[0] + ('_I%d' % lengths[1]
+                                        if lengths[1] else ''),
+                 lengths, rows)
+                for lengths, rows in sorted(groups.items())])
+    def shard_lanes(self):
+        """Lanes of the sample sheet grouped into shards, None if unsharded."""
+        if not self.lanes_per_shard or self.type not in ['standard',
+                                                         'patchpcr']:
+            return(None)
+        sheet = read_sample_sheet(os.path.join(self.out_path,
+                                               'SampleSheet.csv'))
+        lanes = sorted(sheet.lanes())
+        n = self.lanes_per_shard
+        shards = [lanes[i:i + n] for i in range(0, len(lanes), n)]
+        if len(shards) < 2:
+            return(None)
+        return(shards)
+    def shard_cmds(self, cmd, shards):
+        """
+        One bcl2fastq command per shard, each restricted to its lanes with
+        --tiles and reading its own slice of the sample sheet. Returns a list
+        of (name, cmd) and the number of shards to run at a time.
+        """
+        sheet = read_sample_sheet(os.path.join(self.out_path,
+                                               'SampleSheet.csv'))
+        passes = [('L' + ''.join(map(str, lanes)), sheet.lane_rows(lanes),
+                   lanes, None) for lanes in shards]
+        return(self.pass_cmds(cmd, sheet, passes))
+    def geometry_cmds(self, cmd, groups):
+        """
+        One bcl2fastq command per index geometry group, over the lanes of
+        its samples with the mask derived for its index lengths.
+        """
+        sheet = read_sample_sheet(os.path.join(self.out_path,
+                                               'SampleSheet.csv'))
+        run = self.run_descriptor()
+        passes = []
+        for name, lengths, rows in groups:
+            lanes = sorted(set(int(row.get('Lane') or 1) for row in rows))
+            mask = run.use_bases_mask(self.type, lengths)
+            print('Index geometry %s, lanes %s: --use-bases-mask=%s' %
+                  (name, ' '.join(map(str, lanes)), mask))
+            passes.append((name, rows, lanes, mask))
+        return(self.pass_cmds(cmd, sheet, passes))
+    def pass_cmds(self, cmd, sheet, passes):
+        """
+        Commands of concurrent bcl2fastq passes given as (name, rows, lanes,
+        mask or None), each reading its own sample sheet and writing to its
+        own folder under shards/, with the threads of the plan shared out.
+        """
+        plan = self.thread_plan()
+        jobs = max(1, min(len(passes), plan.processing // MIN_SHARD_THREADS))
+        threads = {'--loading-threads': plan.loading,
+                   '--processing-threads': plan.processing,
+                   '--writing-threads': plan.writing}
+        pass_cmds = []
+        for name, rows, lanes, mask in passes:
+            fname = 'SampleSheet_%s.csv' % name
+            write_sample_sheet(sheet.subset(rows),
+                               os.path.join(self.out_path, fname))
+            pass_cmd = self.set_option(cmd, '--sample-sheet',
+                                       os.path.join('$OUT_BCL2FASTQ', fname))
+            pass_cmd = self.set_option(pass_cmd, '--output-dir',
+                                       os.path.join('$OUT_BCL2FASTQ',
+                                                    'shards', name))
+            for flag, total in threads.items():
+                pass_cmd = self.set_option(pass_cmd, flag,
+                                           str(max(1, total // jobs)))
+            pass_cmd = self.set_option(pass_cmd, '--tiles',
+                                       "'s_[%s]'" % ''.join(map(str, lanes)))
+            if mask:
+                pass_cmd.append("--use-bases-mask='%s'" % mask)
+            pass_cmds.append((name, pass_cmd))
+        return(pass_cmds, jobs)
+    def sharded_script(self, shard_cmds, jobs):
+        """Shell code running shard commands concurrently, then merging them."""
+        shard_dir = os.path.join('$OUT_BCL2FASTQ', 'shards')
+        lines = ['# Passes: %s, %d at a time' %
+                 (', '.join(name for name, cmd in shard_cmds), jobs),
+                 'mkdir -p ' + shard_dir,
+                 'run_shard() {',
+                 '  name=$1; shift',
+                 '  set +e',
+                 '  measure "$@" > %s/$name.log 2>&1' % shard_dir,
+                 '  echo $? > %s/$name.status' % shard_dir,
+                 '}']
+        for name, cmd in shard_cmds:
+            lines.append('while [ $(jobs -rp | wc -l) -ge %d ]; do sleep 30; done'
+                         % jobs)
+            lines.append('run_shard %s %s &' % (name, ' '.join(cmd)))
+        lines.append('wait')
+        for name, cmd in shard_cmds:
+            lines.append('[ "$(cat %s/%s.status)" = 0 ] || '
+                         '{ echo "Shard %s failed, see %s/%s.log"; exit 1; }'
+                         % (shard_dir, name, name, shard_dir, name))
+        merge = [sys.executable,
+                 os.path.join(params.alademux_path, 'shardmerge.py'),
+                 '$OUT_BCL2FASTQ']
+        merge.extend(os.path.join(shard_dir, name) for name, cmd in shard_cmds)
+        lines.append(' '.join(merge))
+        return('\n'.join(lines))
+    def incremental_script(self, cmd):
+        """
+        Shell code demultiplexing only the lanes whose sample sheet rows
+        changed since previous_output. The FASTQs and Stats of the other
+        lanes are linked from it and merged in as a lane shard.
+        """
+        from incremental import link_lanes, plan_incremental
+        changed, unchanged = plan_incremental(self.previous_output,
+                                              self.out_path)
+        self.demux_lanes = changed
+        print('Incremental: lanes changed since %s: %s' %
+              (self.previous_output, ' '.join(map(str, changed)) or 'none'))
+        shard_dir = os.path.join('$OUT_BCL2FASTQ', 'shards')
+        lines = ['# Incremental from %s' % self.previous_output,
+                 '#   demultiplexed lanes: %s, reused lanes: %s' %
+                 (' '.join(map(str, changed)) or '-',
+                  ' '.join(map(str, unchanged)) or '-')]
+        names = []
+        if changed:
+            name = 'L' + ''.join(map(str, changed))
+            fname = 'SampleSheet_%s.csv' % name
+            sheet = read_sample_sheet(os.path.join(self.out_path,
+                                                   'SampleSheet.csv'))
+            write_sample_sheet(sheet.subset(sheet.lane_rows(changed)),
+                               os.path.join(self.out_path, fname))
+            lane_cmd = self.set_option(cmd, '--sample-sheet',
+                                       os.path.join('$OUT_BCL2FASTQ', fname))
+            lane_cmd = self.set_option(lane_cmd, '--output-dir',
+                                       os.path.join(shard_dir, name))
+            lane_cmd = self.set_option(lane_cmd, '--tiles',
+                                       "'s_[%s]'" % ''.join(map(str, changed)))
+            lines.append('measure ' + ' '.join(lane_cmd))
+            names.append(name)
+        if unchanged:
+            n = link_lanes(self.previous_output,
+                           os.path.join(self.out_path, 'shards', 'previous'),
+                           unchanged)
+            print('Linked %d FASTQs of lanes %s' %
+                  (n, ' '.join(map(str, unchanged))))
+            # the linked FASTQs carry the S numbers of the previous sheet,
+            # shardmerge maps them to those of the new one
+            write_sample_sheet(read_sample_sheet(
+                os.path.join(self.previous_output, 'SampleSheet.csv')),
+                os.path.join(self.out_path, 'SampleSheet_previous.csv'))
+            names.append('previous')
+        merge = [sys.executable,
+                 os.path.join(params.alademux_path, 'shardmerge.py'),
+                 '$OUT_BCL2FASTQ']
+        merge.extend(os.path.join(shard_dir, name) for name in names)
+        lines.append(' '.join(merge))
+        return('\n'.join(lines))
+    def stage_timer(self, name, fields=None, history=False):
+        """Shell line recording a span for the stage begun at STAGE_START."""
+        cmd = [sys.executable, os.path.join(params.alademux_path, 'timing.py'),
+               os.path.join('$OUT_BCL2FASTQ', timing.TIMINGS), '$RUN', name,
+               '$STAGE_START']
+        cmd.extend('%s=%s' % item for item in sorted((fields or {}).items()))
+        if history and self.history_file:
+            cmd.extend(['--history', self.history_file])
+        return(' '.join(cmd) + '\n')
+    def demux_fields(self):
+        """
+        Geometry of the lanes demultiplexed and thread counts, recorded with
+        the demux stage. Lanes are those of the sample sheet, so a run of
+        some lanes is not taken for a whole flowcell in the history.
+        """
+        fields = {'demux_type': self.type}
+        features = self.features()
+        if features:
+            fields.update((key, value) for key, value in features.items()
+                          if value is not None and key != 'demux_type')
+        elif self.plan is not None:
+            fields.update({'loading': self.plan.loading,
+                           'processing': self.plan.processing,
+                           'writing': self.plan.writing})
+        return(fields)
+    def features(self):
+        """
+        Geometry, sample count and thread counts of the lanes demultiplexed,
+        as recorded in the history and read by the estimator. None without
+        RunInfo.xml or a sample sheet.
+        """
+        run = load_run(self.in_path)
+        fname = os.path.join(self.out_path, 'SampleSheet.csv')
+        if run is None or not run.lanes or not os.path.exists(fname):
+            return(None)
+        sheet = read_sample_sheet(fname)
+        lanes = self.demux_lanes
+        if lanes is None:
+            lanes = sheet.lanes()
+        if not lanes:
+            return(None)
+        samples = len(sheet.lane_rows(lanes))
+        from estimator import run_features
+        return(run_features(run, self.type, samples, self.plan, len(lanes)))
+    def estimate(self):
+        """Lines predicting the wall time, memory and output of the run."""
+        from estimator import estimate, format_estimate
+        features = self.features()
+        if features is None:
+            return([])
+        return(format_estimate(estimate(features, self.history_file)))
+    def trim_script(self):
+        """Trim the adapters of the nano run's FASTQs into Trimmed/."""
+        trim = [sys.executable,
+                os.path.join(params.alademux_path, 'adaptertrim.py'),
+                '$OUT_BCL2FASTQ', '-a', '$ADAPTER', '-A', '$ADAPTER2']
+        return(STAGE_START + ' '.join(trim) + '\n' +
+               self.stage_timer('adapter_trim'))
+    def qc_script(self):
+        """
+        Summarize the read statistics of the sample FASTQs into QC/. Like
+        the yield report, a failing QC must not hold up the transfer.
+        """
+        qc = [sys.executable, os.path.join(params.alademux_path, 'fastqqc.py'),
+              '$OUT_BCL2FASTQ']
+        script = STAGE_START + ' '.join(qc)
+        script += ' || echo "FASTQ QC failed, continuing"\n'
+        return(script + self.stage_timer('fastq_qc'))
+    def report_script(self):
+        """
+        Write the yield report. A failing report must not keep the FASTQs
+        from reaching GNomEx, so its errors are only printed.
+        """
+        report = [sys.executable,
+                  os.path.join(params.alademux_path, 'demuxstats.py'),
+                  '$OUT_BCL2FASTQ', '$RUN']
+        script = STAGE_START + ' '.join(report)
+        script += ' || echo "Yield report failed, continuing"\n'
+        return(script + self.stage_timer('report'))
+    def transfer_script(self):
+        """Write the yield report, then copy the project folders to GNomEx."""
+        if not getattr(params, 'gnomex_fastq_path', None):
+            # the shell templates copy and notify on their own
+            script = self.report_script()
+            with open(self.transfer_template) as infile:
+                return(script + infile.read())
+        transfer = [sys.executable,
+                    os.path.join(params.alademux_path, 'transfer.py'),
+                    '$OUT_BCL2FASTQ', '$RUN']
+        script = self.report_script()
+        script += STAGE_START + ' '.join(transfer) + '\n'
+        return(script + self.stage_timer('transfer'))
+    def notify_script(self):
+        """
+        Send the notification with the yield report and QC summary attached.
+        The shell templates and the nano report notify on their own, without
+        attachments, so with them a message only delivers the QC summary.
+        """
+        notify = [sys.executable,
+                  os.path.join(params.alademux_path, 'send_email.py'), '$RUN']
+        # fastqqc.QC_DIR and SUMMARY_FILE
+        files = ['QC/qc_summary.tsv']
+        send = ' '.join(notify + ['$ATTACH'])
+        if self.type == 'nano' or \
+           not getattr(params, 'gnomex_fastq_path', None):
+            send = 'if [ -n "$ATTACH" ]; then %s; fi' % send
+        else:
+            files.insert(0, 'demux_report.txt')
+        lines = ['ATTACH=""',
+                 'for f in %s; do' % ' '.join(files),
+                 '  if [ -f $f ]; then ATTACH="$ATTACH $f"; fi',
+                 'done',
+                 send]
+        return('\n'.join(lines) + '\n')
+    def stage_block(self, stage, script):
+        """Shell code running script when demuxer.sh runs stage."""
+        return('if run_stage %s; then\n%s\nfi\n' % (stage, script.rstrip('\n')))
     def write_demux_script(self):
         """Combine demultiplexing command with the appropriate transfer script."""
-        self.script += ' '.join(self.get_cmd())
+        cmd = self.get_cmd()
+        if self.plan is not None:
+            self.script += self.plan.comment()
+        if self.barcode_report is not None:
+            self.script += ''.join('# %s\n' % line
+                                   for line in self.barcode_report.summary())
+        demux = STAGE_START
+        groups = None if self.previous_output else self.index_groups()
+        shards = None if self.previous_output or groups \
+            else self.shard_lanes()
+        if self.previous_output:
+            demux += self.incremental_script(cmd)
+        elif groups:
+            demux += self.sharded_script(*self.geometry_cmds(cmd, groups))
+        elif shards:
+            demux += self.sharded_script(*self.shard_cmds(cmd, shards))
+        else:
+            demux += 'measure ' + ' '.join(cmd)
+        tool = 'mkfastq' if self.type.startswith('10x') else 'bcl2fastq'
+        demux += '\n' + self.stage_timer(tool, self.demux_fields(),
+                                         history=True)
+        if self.type == 'nano':
+            demux += self.trim_script()
+        # after incremental_script, which may narrow the lanes
+        for line in self.estimate():
+            print('Estimate: ' + line)
+            self.script += '# Estimate: %s\n' % line
+        self.script += self.stage_block('demux', demux)
         with open(self.out_file, 'w+') as outfile:
             outfile.write(self.script)
-            outfile.write('\n\n# Transfer data to GNomEx\n')
-            with open(self.transfer[self.type]) as infile:
-                for line in infile:
-                    outfile.write(line)
+            outfile.write('\n# Transfer data to GNomEx\n')
+            if self.type == 'nano':
+                with open(self.nano_report) as infile:
+                    report = self.qc_script() + STAGE_START + infile.read()
+                report += '\n' + self.stage_timer('report')
+                outfile.write(self.stage_block('transfer', report))
+            else:
+                outfile.write(self.stage_block('transfer',
+                                               self.qc_script() +
+                                               self.transfer_script()))
+            outfile.write(self.stage_block('notify', self.notify_script()))
         # change to executible file
         st = os.stat(self.out_file)
         os.chmod(self.out_file, st.st_mode | stat.S_IEXEC)
+    def submit(self, priority=0):
+        """
+        Queue the stages of demuxer.sh with the scheduler daemon instead of
+        running it by hand. Returns the job ids.
+        """
+        from scheduler import submit_run
+        threads = self.plan.loading + self.plan.processing + \
+            self.plan.writing if self.plan is not None else None
+        return(submit_run(self.run_id, self.out_path, threads, priority))
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# demuxstats.py - per lane and sample yield, %PF and Q30 of a bcl2fastq run
+# from Stats.json and ConversionStats.xml, streamed so NovaSeq sized files stay
+# cheap, joined with the GNomEx records of the run.
+
+import argparse
+import json
+import os
+import sys
+import xml.etree.ElementTree as ET
+
+READ_SIZE = 1024**2
+WHITESPACE = ' \t\r\n'
+REPORT = 'demux_report.txt'
+SUMMARY = 'demux_summary.json'
+
+class JsonStream:
+    """
+    Incremental reader of a JSON object whose values may be long arrays.
+    items() yields (key, value) for the top level keys, and (key, element)
+    for every element of a top level array, so only one element at a time
+    is held in memory.
+    """
+    def __init__(self, infile):
+        self.infile = infile
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+    def fill(self):
+        """Read more text; the consumed part of the buffer is dropped."""
+        if self.eof:
+            return(False)
+        # grow reads so a large element is not decoded over and over
+        data = self.infile.read(max(READ_SIZE, len(self.buf) - self.pos))
+        if not data:
+            self.eof = True
+            return(False)
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return(True)
+    def peek(self):
+        """Next non-whitespace character, without consuming it."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return(self.buf[self.pos])
+            if not self.fill():
+                return('')
+    def expect(self, chars):
+        char = self.peek()
+        if char not in chars:
+            raise ValueError('Expected %s at %r' % (chars, self.buf[self.pos:
+                                                                     self.pos + 20]))
+        self.pos += 1
+        return(char)
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if self.fill():
+                    continue
+                raise
+            # a number may continue in the next read
+            if end == len(self.buf) and not self.eof and self.fill():
+                continue
+            self.pos = end
+            return(value)
+    def items(self):
+        self.expect('{')
+        if self.peek() == '}':
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            if self.peek() == '[':
+                self.pos += 1
+                if self.peek() == ']':
+                    self.pos += 1
+                else:
+                    while True:
+                        yield key, self.value()
+                        if self.expect(',]') == ']':
+                            break
+            else:
+                yield key, self.value()
+            if self.expect(',}') == '}':
+                return
+
+def read_metrics(metrics):
+    """Yield and Q30 yield summed over the reads of a ReadMetrics list."""
+    return((sum(m.get('Yield', 0) for m in metrics),
+            sum(m.get('YieldQ30', 0) for m in metrics)))
+
+def parse_stats_json(fname, top=10):
+    """
+    Per lane sample results, undetermined reads and the most frequent
+    unknown barcodes of a Stats.json, as a dict.
+    """
+    stats = {'lanes': {}, 'run': {}}
+    with open(fname) as infile:
+        for key, value in JsonStream(infile).items():
+            if key == 'ConversionResults':
+                lane = stats['lanes'].setdefault(value['LaneNumber'], {})
+                lane['clusters_raw'] = value.get('TotalClustersRaw')
+                lane['clusters_pf'] = value.get('TotalClustersPF')
+                lane['yield'] = value.get('Yield')
+                samples = lane.setdefault('samples', {})
+                for result in value.get('DemuxResults', []):
+                    yield_, q30 = read_metrics(result.get('ReadMetrics', []))
+                    perfect = sum(m.get('MismatchCounts', {}).get('0', 0)
+                                  for m in result.get('IndexMetrics', []))
+                    samples[result['SampleId']] = {
+                        'sample_name': result.get('SampleName'),
+                        'reads': result.get('NumberReads', 0),
+                        'yield': yield_, 'yield_q30': q30,
+                        'perfect_index_reads': perfect}
+                undetermined = value.get('Undetermined') or {}
+                yield_, q30 = read_metrics(undetermined.get('ReadMetrics', []))
+                lane['undetermined'] = {
+                    'reads': undetermined.get('NumberReads', 0),
+                    'yield': yield_, 'yield_q30': q30}
+            elif key == 'UnknownBarcodes':
+                lane = stats['lanes'].setdefault(value['Lane'], {})
+                barcodes = sorted(value.get('Barcodes', {}).items(),
+                                  key=lambda kv: -kv[1])
+                lane['unknown_barcodes'] = barcodes[:top]
+            elif key == 'ReadInfosForLanes':
+                continue
+            else:
+                stats['run'][key] = value
+    return(stats)
+
+def parse_conversion_stats(fname):
+    """
+    Raw and passing filter cluster counts per (lane, sample) summed over
+    tiles, from ConversionStats.xml. Sample 'Undetermined' is kept as is.
+    """
+    counts = {}
+    project = sample = barcode = lane = None
+    kind = None
+    for event, elem in ET.iterparse(fname, events=('start', 'end')):
+        tag = elem.tag
+        if event == 'start':
+            if tag == 'Project':
+                project = elem.get('name')
+            elif tag == 'Sample':
+                sample = elem.get('name')
+            elif tag == 'Barcode':
+                barcode = elem.get('name')
+            elif tag == 'Lane':
+                lane = int(elem.get('number'))
+            elif tag in ['Raw', 'Pf']:
+                kind = tag.lower()
+            continue
+        if tag == 'ClusterCount' and kind and barcode == 'all' \
+           and project != 'all' and sample != 'all':
+            entry = counts.setdefault((lane, sample), {'raw': 0, 'pf': 0})
+            entry[kind] += int(elem.text or 0)
+        elif tag in ['Raw', 'Pf']:
+            kind = None
+        if tag in ['Tile', 'Lane', 'Barcode', 'Sample', 'Project']:
+            elem.clear()
+    return(counts)
+
+def percent(part, whole):
+    return(round(100.0 * part / whole, 2) if whole else None)
+
+def summarize(out_path, run_id, records=None, top=10):
+    """
+    Summary of a demultiplexing output directory. records are RunRecords of
+    the run (e.g. from IEMWriter) joined on lane and sample id.
+    """
+    stats_dir = os.path.join(out_path, 'Stats')
+    stats = parse_stats_json(os.path.join(stats_dir, 'Stats.json'), top)
+    conversion = {}
+    fname = os.path.join(stats_dir, 'ConversionStats.xml')
+    if os.path.exists(fname):
+        conversion = parse_conversion_stats(fname)
+    gnomex = {(rec.lane, rec.sample_id): rec for rec in records or []}
+    lanes = []
+    for lane_number, lane in sorted(stats['lanes'].items()):
+        samples = []
+        total_reads = sum(s['reads'] for s in lane.get('samples', {}).values())
+        total_reads += lane.get('undetermined', {}).get('reads', 0)
+        for sample_id, s in sorted(lane.get('samples', {}).items()):
+            clusters = conversion.get((lane_number, sample_id), {})
+            rec = gnomex.get((lane_number, sample_id))
+            samples.append({
+                'sample_id': sample_id,
+                'project': rec.project if rec else None,
+                'investigator': ('%s %s' % (rec.first_name, rec.last_name)
+                                 if rec else None),
+                'application': rec.application if rec else None,
+                'genome_build': rec.genome_build if rec else None,
+                'reads': s['reads'],
+                'percent_of_lane': percent(s['reads'], total_reads),
+                'yield_mbases': round(s['yield'] / 1e6, 1),
+                'percent_pf': percent(clusters.get('pf', 0),
+                                      clusters.get('raw', 0)),
+                'percent_q30': percent(s['yield_q30'], s['yield']),
+                'percent_perfect_index': percent(s['perfect_index_reads'],
+                                                 s['reads'])})
+        undetermined = lane.get('undetermined', {})
+        lanes.append({
+            'lane': lane_number,
+            'clusters_raw': lane.get('clusters_raw'),
+            'clusters_pf': lane.get('clusters_pf'),
+            'percent_pf': percent(lane.get('clusters_pf') or 0,
+                                  lane.get('clusters_raw') or 0),
+            'undetermined_reads': undetermined.get('reads', 0),
+            'percent_undetermined': percent(undetermined.get('reads', 0),
+                                            total_reads),
+            'top_unknown_barcodes': lane.get('unknown_barcodes', []),
+            'samples': samples})
+    missing = sorted('%s (lane %s)' % (key[1], key[0]) for key in gnomex
+                     if key[0] in stats['lanes'] and
+                     key[1] not in stats['lanes'][key[0]].get('samples', {}))
+    return({'run_id': run_id, 'flowcell': stats['run'].get('Flowcell'),
+            'lanes': lanes, 'missing_samples': missing})
+
+def format_report(summary):
+    def fmt(value):
+        return('-' if value is None else '%.1f' % value)
+    lines = ['Demultiplexing report for %s' % summary['run_id'], '']
+    for lane in summary['lanes']:
+        lines.append('Lane %d: %s PF clusters (%s%% PF), %s%% undetermined' %
+                     (lane['lane'], '{:,}'.format(lane['clusters_pf'] or 0),
+                      fmt(lane['percent_pf']),
+                      fmt(lane['percent_undetermined'])))
+        lines.append('  %-16s %-8s %12s %7s %9s %6s %6s' %
+                     ('Sample', 'Project', 'Reads', '%Lane', 'Mbases',
+                      '%PF', '%Q30'))
+        for s in lane['samples']:
+            lines.append('  %-16s %-8s %12s %7s %9.1f %6s %6s' %
+                         (s['sample_id'], s['project'] or '-',
+                          '{:,}'.format(s['reads']), fmt(s['percent_of_lane']),
+                          s['yield_mbases'], fmt(s['percent_pf']),
+                          fmt(s['percent_q30'])))
+        if lane['top_unknown_barcodes']:
+            lines.append('  Top undetermined barcodes:')
+            for barcode, count in lane['top_unknown_barcodes']:
+                lines.append('    %-24s %12s' % (barcode, '{:,}'.format(count)))
+        lines.append('')
+    if summary['missing_samples']:
+        lines.append('GNomEx samples without results: %s' %
+                     ', '.join(summary['missing_samples']))
+    return(lines)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('out_path', help='Demultiplexing output directory')
+    parser.add_argument('run_id', help='Illumina run ID')
+    parser.add_argument('--top', type=int, default=10,
+                        help='Undetermined barcodes listed per lane')
+    parser.add_argument('--no-gnomex', action='store_true',
+                        help='Do not join the results with GNomEx records')
+    args = parser.parse_args()
+    if not os.path.exists(os.path.join(args.out_path, 'Stats', 'Stats.json')):
+        print('No Stats/Stats.json in %s, no report written' % args.out_path)
+        return(0)
+    records = None
+    if not args.no_gnomex:
+        from runrecords import fetch_run_records
+        try:
+            records = fetch_run_records([args.run_id])[args.run_id]
+        except Exception as err:
+            # the report is still useful without the GNomEx columns
+            print('GNomEx records unavailable (%s), reporting without them'
+                  % err)
+    summary = summarize(args.out_path, args.run_id, records, args.top)
+    lines = format_report(summary)
+    with open(os.path.join(args.out_path, REPORT), 'w') as outfile:
+        outfile.write('\n'.join(lines) + '\n')
+    with open(os.path.join(args.out_path, SUMMARY), 'w') as outfile:
+        json.dump(summary, outfile, indent=2)
+    print('\n'.join(lines))
+    return(0)
+
+if __name__ == "__main__":
+    sys.exit(main())
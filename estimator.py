@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# estimator.py - predict the wall time, peak memory and output size of a
+# demultiplexing from the run geometry, fitted on the demux history.
+
+import argparse
+import os
+import sys
+from functools import lru_cache
+from threadplanner import (MEM_PER_LOADING, MEM_PER_PROCESSING,
+                           MEM_PER_WRITING, read_history)
+
+# one-sided 95% quantiles of Student's t by degrees of freedom, for 90%
+# prediction intervals; 1.645 beyond the table
+T_QUANTILES = [(1, 6.314), (2, 2.920), (3, 2.353), (4, 2.132), (5, 2.015),
+               (6, 1.943), (7, 1.895), (8, 1.860), (9, 1.833), (10, 1.812),
+               (15, 1.753), (20, 1.725), (30, 1.697), (60, 1.671)]
+
+def tile_cycles(run):
+    return(run['lanes'] * run['tiles'] * run['cycles'])
+
+def threads(run):
+    return(run.get('processing') or max(1, (run.get('cpus') or 2) - 1))
+
+# models of each target, richest first; a model is used once the history
+# holds two more runs than it has terms
+MODELS = {
+    'wall_seconds': [
+        ('tile cycles per thread, tile cycles, samples',
+         lambda r: [1.0, tile_cycles(r) / threads(r), tile_cycles(r),
+                    r['samples']]),
+        ('tile cycles per thread', lambda r: [1.0, tile_cycles(r) / threads(r)]),
+    ],
+    'output_bytes': [
+        ('sequenced tile cycles, samples',
+         lambda r: [1.0, r['lanes'] * r['tiles'] * r['data_cycles'],
+                    r['samples']]),
+        ('sequenced tile cycles',
+         lambda r: [1.0, r['lanes'] * r['tiles'] * r['data_cycles']]),
+    ],
+    'peak_rss': [
+        ('loading, processing and writing threads',
+         lambda r: [1.0, r['loading'], r['processing'], r['writing']]),
+        ('processing threads', lambda r: [1.0, threads(r)]),
+    ],
+}
+
+class Prediction:
+    def __init__(self, value, low=None, high=None, runs=0, model=None):
+        self.value = value
+        self.low = low
+        self.high = high
+        # past runs the model was fitted on, 0 for a rule of thumb
+        self.runs = runs
+        self.model = model
+
+def t_quantile(dof):
+    quantile = 1.645
+    for limit, value in reversed(T_QUANTILES):
+        if dof <= limit:
+            quantile = value
+    return(quantile)
+
+def fit(rows, targets):
+    """
+    Least squares coefficients, residual variance and (X'X)^-1 of a model,
+    for the prediction interval of new runs.
+    """
+    import numpy as np
+    X = np.array(rows, dtype=float)
+    y = np.array(targets, dtype=float)
+    beta = np.linalg.lstsq(X, y, rcond=None)[0]
+    dof = len(y) - X.shape[1]
+    variance = float(((y - X @ beta) ** 2).sum()) / dof
+    return(beta, variance, np.linalg.pinv(X.T @ X), dof)
+
+@lru_cache(maxsize=8)
+def _history(fname, mtime, size):
+    return(tuple(read_history(fname)))
+
+def load_history(fname):
+    """Past runs of the history file, parsed again once it grows."""
+    if not fname or not os.path.exists(fname):
+        return(())
+    stat = os.stat(fname)
+    return(_history(fname, stat.st_mtime, stat.st_size))
+
+def predict(run, history, target):
+    """
+    Prediction of target for run, fitted on the past runs of the same demux
+    type, or of any type when too few were recorded. None without enough
+    history.
+    """
+    if not history:
+        return(None)
+    # numpy is only loaded once there is a history to fit
+    import numpy as np
+    same = [r for r in history if r.get('demux_type') == run.get('demux_type')]
+    for pool in [same, history]:
+        for name, features in MODELS[target]:
+            try:
+                x = np.array(features(run), dtype=float)
+            except (KeyError, TypeError, ZeroDivisionError):
+                # e.g. no thread counts for 10x runs
+                continue
+            records = []
+            for r in pool:
+                try:
+                    if r.get(target):
+                        records.append((features(r), r[target]))
+                except (KeyError, TypeError, ZeroDivisionError):
+                    continue
+            if len(records) < len(x) + 2:
+                continue
+            beta, variance, inverse, dof = fit([row for row, y in records],
+                                               [y for row, y in records])
+            value = float(x @ beta)
+            spread = t_quantile(dof) * (variance *
+                                        (1 + float(x @ inverse @ x))) ** 0.5
+            return(Prediction(max(0.0, value), max(0.0, value - spread),
+                              value + spread, len(records), name))
+    return(None)
+
+def thread_memory(run):
+    """Peak memory of the thread plan by the threadplanner rule of thumb."""
+    if not run.get('processing'):
+        return(None)
+    return(Prediction(run.get('loading', 1) * MEM_PER_LOADING +
+                      run['processing'] * MEM_PER_PROCESSING +
+                      run.get('writing', 1) * MEM_PER_WRITING,
+                      model='threadplanner memory per thread'))
+
+def estimate(run, history_file):
+    """
+    Predictions of wall_seconds, peak_rss and output_bytes of a run given
+    as a dict of lanes, tiles, cycles, data_cycles, index_reads, samples,
+    demux_type and the thread counts, as in the demux history.
+    """
+    history = load_history(history_file)
+    predictions = {target: predict(run, history, target)
+                   for target in MODELS}
+    if predictions['peak_rss'] is None:
+        predictions['peak_rss'] = thread_memory(run)
+    return(predictions)
+
+def run_features(run, demux_type, samples, plan=None, lanes=None):
+    """Estimator input from a RunDescriptor, sample count and ThreadPlan."""
+    features = {'demux_type': demux_type, 'lanes': lanes or run.lanes,
+                'tiles': run.tiles,
+                'cycles': sum(read.cycles for read in run.reads),
+                'data_cycles': sum(read.cycles for read in run.data_reads()),
+                'index_reads': len(run.index_reads()),
+                'samples': samples, 'cpus': os.cpu_count()}
+    if plan is not None:
+        features.update({'loading': plan.loading,
+                         'processing': plan.processing,
+                         'writing': plan.writing})
+    return(features)
+
+def format_value(value, target):
+    if target == 'wall_seconds':
+        if value < 5400:
+            return('%.0f min' % (value / 60))
+        return('%.1f h' % (value / 3600))
+    return('%.1f GB' % (value / 1e9))
+
+def format_estimate(predictions):
+    """Lines describing the predictions, with their 90% intervals."""
+    labels = {'wall_seconds': 'Wall time', 'peak_rss': 'Peak memory',
+              'output_bytes': 'Output'}
+    if not any(predictions.values()):
+        return(['unknown, too few past runs in the demux history'])
+    lines = []
+    for target in ['wall_seconds', 'peak_rss', 'output_bytes']:
+        p = predictions.get(target)
+        if p is None:
+            lines.append('%-12s unknown, too few past runs recorded' %
+                         labels[target])
+        elif p.runs:
+            lines.append('%-12s %s (90%% interval %s - %s, %d past runs)' %
+                         (labels[target], format_value(p.value, target),
+                          format_value(p.low, target),
+                          format_value(p.high, target), p.runs))
+        else:
+            lines.append('%-12s %s (%s)' % (labels[target],
+                                            format_value(p.value, target),
+                                            p.model))
+    return(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description='''Estimate a
+                        demultiplexing from its geometry and a demux history
+                        file.''')
+    parser.add_argument('history', help='Demux history JSON lines file')
+    parser.add_argument('--type', default='standard')
+    parser.add_argument('--lanes', type=int, required=True)
+    parser.add_argument('--tiles', type=int, required=True)
+    parser.add_argument('--cycles', type=int, required=True,
+                        help='Cycles of all reads')
+    parser.add_argument('--data-cycles', type=int,
+                        help='Cycles of the non-index reads')
+    parser.add_argument('--samples', type=int, required=True)
+    parser.add_argument('--threads', type=int, nargs=3,
+                        metavar=('LOADING', 'PROCESSING', 'WRITING'))
+    args = parser.parse_args()
+    run = {'demux_type': args.type, 'lanes': args.lanes, 'tiles': args.tiles,
+           'cycles': args.cycles, 'samples': args.samples,
+           'data_cycles': args.data_cycles or args.cycles,
+           'cpus': os.cpu_count()}
+    if args.threads:
+        run.update(zip(['loading', 'processing', 'writing'], args.threads))
+    for line in format_estimate(estimate(run, args.history)):
+        print(line)
+    return(0)
+
+if __name__ == "__main__":
+    sys.exit(main())
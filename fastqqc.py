@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# fastqqc.py - read statistics of the sample FASTQs of a demultiplexing
+# output, reading each file once and summarizing chunks in a process pool.
+
+import argparse
+import json
+import os
+import sys
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from adaptertrim import CHUNK_READS, CHUNKS_IN_FLIGHT, fastq_files
+from redemux import read_records
+from samplesheet import read_sample_sheet
+
+QC_DIR = 'QC'
+SUMMARY_FILE = 'qc_summary.tsv'
+SUMMARY_COLUMNS = ['project', 'sample', 'read', 'reads', 'mean_length',
+                   'mean_quality', 'percent_q30', 'percent_n', 'top_prefix',
+                   'top_prefix_percent']
+# bases of the read start counted as its prefix
+PREFIX_LENGTH = 20
+# prefixes kept per sample, bounds the memory of the prefix counts
+PREFIX_CAPACITY = 1000
+TOP_PREFIXES = 10
+PHRED_OFFSET = 33
+
+def qc_chunk(records, prefix_length=PREFIX_LENGTH, capacity=PREFIX_CAPACITY):
+    """Counts of a chunk of raw 4-line records, mergeable with merge_qc."""
+    seqs = []
+    quals = []
+    for record in records:
+        header, seq, plus, qual = record.split(b'\n', 3)
+        seqs.append(seq)
+        quals.append(qual.rstrip(b'\n'))
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    qual = np.frombuffer(b''.join(quals), dtype=np.uint8).astype(np.int64) \
+        - PHRED_OFFSET
+    # cycle of every base, counting from 0 at each read start
+    starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    cycles = np.arange(len(qual)) - starts
+    n_cycles = int(lengths.max()) if len(lengths) else 0
+    prefixes = Counter(seq[:prefix_length] for seq in seqs)
+    return({'reads': len(records),
+            'bases': int(lengths.sum()),
+            'q30_bases': int((qual >= 30).sum()),
+            'n_bases': sum(seq.count(b'N') for seq in seqs),
+            'lengths': Counter(lengths.tolist()),
+            'cycle_quality': np.bincount(cycles, weights=qual,
+                                         minlength=n_cycles),
+            'cycle_bases': np.bincount(cycles, minlength=n_cycles),
+            'prefixes': dict(prefixes.most_common(capacity))})
+
+def add_cycles(total, part):
+    if len(part) > len(total):
+        total, part = part.copy(), total
+    total[:len(part)] += part
+    return(total)
+
+def merge_prefixes(counts, part, capacity=PREFIX_CAPACITY):
+    """
+    Misra-Gries merge: counts stay within capacity entries and undercount
+    any prefix by at most the reads merged divided by capacity.
+    """
+    for prefix, count in part.items():
+        counts[prefix] = counts.get(prefix, 0) + count
+    if len(counts) > capacity:
+        cut = sorted(counts.values(), reverse=True)[capacity]
+        for prefix in list(counts):
+            counts[prefix] -= cut
+            if counts[prefix] <= 0:
+                del counts[prefix]
+    return(counts)
+
+def new_qc():
+    return({'reads': 0, 'bases': 0, 'q30_bases': 0, 'n_bases': 0,
+            'lengths': Counter(), 'cycle_quality': np.zeros(0),
+            'cycle_bases': np.zeros(0, dtype=np.int64), 'prefixes': {}})
+
+def merge_qc(total, part):
+    for key in ['reads', 'bases', 'q30_bases', 'n_bases']:
+        total[key] += part[key]
+    total['lengths'].update(part['lengths'])
+    for key in ['cycle_quality', 'cycle_bases']:
+        total[key] = add_cycles(total[key], part[key])
+    merge_prefixes(total['prefixes'], part['prefixes'])
+    return(total)
+
+def percent(part, whole):
+    return(round(100.0 * part / whole, 3) if whole else 0.0)
+
+def sample_project(path, projects):
+    """
+    Sample_Project of a FASTQ from its folder: the first one named after a
+    project of the sample sheet (under the flowcell folder for cellranger
+    mkfastq), else the top folder.
+    """
+    folders = os.path.dirname(path).split(os.sep)
+    for folder in folders:
+        if folder in projects:
+            return(folder)
+    return(folders[0])
+
+def sample_report(project, sample, read, qc):
+    """Compact JSON-ready summary of one sample read."""
+    bases = qc['cycle_bases']
+    mean_quality = np.divide(qc['cycle_quality'], bases,
+                             out=np.zeros(len(bases)), where=bases > 0)
+    top = sorted(qc['prefixes'].items(), key=lambda kv: -kv[1])
+    return({'project': project, 'sample': sample, 'read': read,
+            'reads': qc['reads'], 'bases': qc['bases'],
+            'mean_length': round(qc['bases'] / qc['reads'], 2)
+            if qc['reads'] else 0.0,
+            'mean_quality': round(float(qc['cycle_quality'].sum()) /
+                                  qc['bases'], 2) if qc['bases'] else 0.0,
+            'percent_q30': percent(qc['q30_bases'], qc['bases']),
+            'percent_n': percent(qc['n_bases'], qc['bases']),
+            'length_distribution': {str(length): count for length, count
+                                    in sorted(qc['lengths'].items())},
+            'cycle_mean_quality': [round(float(q), 2) for q in mean_quality],
+            # counts are lower bounds, see merge_prefixes
+            'top_prefixes': [{'prefix': prefix.decode('ascii'),
+                              'reads': count,
+                              'percent': percent(count, qc['reads'])}
+                             for prefix, count in top[:TOP_PREFIXES]]})
+
+class QCRunner:
+    def __init__(self, out_path, processes=None, chunk_reads=CHUNK_READS):
+        self.out_path = out_path
+        self.processes = processes or os.cpu_count() or 1
+        self.chunk_reads = chunk_reads
+    def run(self, files):
+        """
+        QC counts per (project, sample, read), each file read once; samples
+        of the same name in different projects are kept apart.
+        """
+        fname = os.path.join(self.out_path, 'SampleSheet.csv')
+        projects = set(row.get('Sample_Project') for row in
+                       read_sample_sheet(fname).rows) \
+            if os.path.exists(fname) else set()
+        totals = {}
+        pending = deque()
+        def finish():
+            key, future = pending.popleft()
+            merge_qc(totals[key], future.result())
+        with ProcessPoolExecutor(self.processes) as pool:
+            for path, sample, read in files:
+                key = (sample_project(path, projects), sample, read)
+                totals.setdefault(key, new_qc())
+                for chunk in read_records(os.path.join(self.out_path, path),
+                                          self.chunk_reads):
+                    pending.append((key, pool.submit(qc_chunk, chunk)))
+                    while len(pending) > CHUNKS_IN_FLIGHT * self.processes:
+                        finish()
+            while pending:
+                finish()
+        return(totals)
+
+def main():
+    parser = argparse.ArgumentParser(description='''Read statistics of the
+                    sample FASTQs of a demultiplexing output, written to
+                    %s/.''' % QC_DIR)
+    parser.add_argument('out_path', help='Demultiplexing output directory')
+    parser.add_argument('-p', '--processes', type=int,
+                        help='Worker processes (default: all cores)')
+    parser.add_argument('--chunk', type=int, default=CHUNK_READS,
+                        help='Reads sent to a worker at a time')
+    args = parser.parse_args()
+    files = fastq_files(args.out_path)
+    if not files:
+        print('No sample FASTQs to check in %s' % args.out_path)
+        return(0)
+    totals = QCRunner(args.out_path, args.processes, args.chunk).run(files)
+    qc_dir = os.path.join(args.out_path, QC_DIR)
+    os.makedirs(qc_dir, exist_ok=True)
+    rows = []
+    for (project, sample, read), qc in sorted(totals.items()):
+        report = sample_report(project, sample, read, qc)
+        fname = '%s_%s_%s.json' % (project, sample, read)
+        with open(os.path.join(qc_dir, fname), 'w') as outfile:
+            json.dump(report, outfile, separators=(',', ':'))
+        top = report['top_prefixes'][0] if report['top_prefixes'] else {}
+        report['top_prefix'] = top.get('prefix', '')
+        report['top_prefix_percent'] = top.get('percent', 0.0)
+        rows.append([report[col] for col in SUMMARY_COLUMNS])
+    with open(os.path.join(qc_dir, SUMMARY_FILE), 'w') as outfile:
+        outfile.write('\t'.join(SUMMARY_COLUMNS) + '\n')
+        for row in rows:
+            outfile.write('\t'.join(map(str, row)) + '\n')
+    for row in rows:
+        print('%-10s %-24s %s %10d reads, %6.2f%% Q30, %5.2f%% N' %
+              (row[0], row[1], row[2], row[3], row[6], row[7]))
+    return(0)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 
-import pyodbc
-import re
+import argparse
+import atexit
 import os
+import pickle
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 import pipelineparams as params
 
 class GNomExConnection:
@@ -16,8 +22,16 @@ class GNomExConnection:
     Returns a database connection. Next step is to call its
     cursor() method, then cursor.execute(query) and cursor.fetchall()
     for example.
+
+    If GNOMEX_SQLITE (environment) or params.gnomex_sqlite names a SQLite
+    file, that local stand-in for GNomEx is opened instead of SQL Server.
     '''
+    standin = os.environ.get('GNOMEX_SQLITE',
+                             getattr(params, 'gnomex_sqlite', None))
+    if standin:
+      return sqlite3.connect(standin, check_same_thread=False)
 
+    import pyodbc
     try:
       host=os.environ['DBHOST']
     except KeyError:
@@ -25,6 +39,205 @@ class GNomExConnection:
     database='GNomEx'
     return pyodbc.connect(DRIVER='{ODBC Driver 17 for SQL Server}',server=host,uid=db_user,pwd=db_password,database=database)
 
+class ConnectionPool:
+  """
+  Keeps idle GNomEx connections open for reuse, so a process issuing
+  several queries pays for the login handshake once.
+  """
+  def __init__( self, maxsize=4 ):
+    self.maxsize = maxsize
+    self.idle = []
+    self.lock = threading.Lock()
+
+  def acquire( self ):
+    with self.lock:
+      if self.idle:
+        return self.idle.pop()
+    return GNomExConnection().GnConnect(params.db_user,params.db_password)
+
+  def release( self, connection, broken=False ):
+    with self.lock:
+      if not broken and len(self.idle) < self.maxsize:
+        self.idle.append(connection)
+        return
+    connection.close()
+
+  @contextmanager
+  def connection( self ):
+    """Borrow a connection; it is discarded if the block raises."""
+    connection = self.acquire()
+    try:
+      yield connection
+    except Exception:
+      self.release(connection, broken=True)
+      raise
+    self.release(connection)
+
+  def close( self ):
+    with self.lock:
+      idle, self.idle = self.idle, []
+    for connection in idle:
+      connection.close()
+
+class QueryCache:
+  """
+  Persistent cache of query results on disk, keyed by query kind and run
+  id. Entries older than ttl seconds are ignored and dropped; once the
+  cache grows beyond max_bytes the least recently used entries are
+  evicted.
+  """
+  def __init__( self, path, ttl=3600, max_bytes=64*1024*1024 ):
+    self.ttl = ttl
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock()
+    dirname = os.path.dirname(path)
+    if dirname:
+      os.makedirs(dirname, exist_ok=True)
+    self.db = sqlite3.connect(path, check_same_thread=False)
+    self.db.execute("""create table if not exists cache (
+        kind text, run_id text, created real, used real, size integer,
+        payload blob, primary key (kind, run_id))""")
+    self.db.commit()
+
+  def get( self, kind, run_id ):
+    """Cached rows, or None if missing or expired."""
+    now = time.time()
+    with self.lock:
+      row = self.db.execute(
+          "select created, payload from cache where kind = ? and run_id = ?",
+          (kind, run_id)).fetchone()
+      if row is None:
+        return None
+      if now - row[0] > self.ttl:
+        self.db.execute("delete from cache where kind = ? and run_id = ?",
+                        (kind, run_id))
+        self.db.commit()
+        return None
+      self.db.execute("update cache set used = ? where kind = ? and run_id = ?",
+                      (now, kind, run_id))
+      self.db.commit()
+    return pickle.loads(row[1])
+
+  def put( self, kind, run_id, rows ):
+    payload = pickle.dumps([tuple(row) for row in rows])
+    now = time.time()
+    with self.lock:
+      self.db.execute("insert or replace into cache values (?,?,?,?,?,?)",
+                      (kind, run_id, now, now, len(payload), payload))
+      self.evict()
+      self.db.commit()
+
+  def evict( self ):
+    """Drop expired entries, then least recently used ones over max_bytes."""
+    self.db.execute("delete from cache where created < ?",
+                    (time.time() - self.ttl,))
+    total = self.db.execute("select coalesce(sum(size), 0) from cache").fetchone()[0]
+    if total <= self.max_bytes:
+      return
+    entries = self.db.execute(
+        "select kind, run_id, size from cache order by used").fetchall()
+    for kind, run_id, size in entries:
+      if total <= self.max_bytes:
+        break
+      self.db.execute("delete from cache where kind = ? and run_id = ?",
+                      (kind, run_id))
+      total -= size
+
+  def invalidate( self, run_id=None, kind=None ):
+    """Forget entries of a run and/or query kind; everything if neither given."""
+    clauses, values = [], []
+    if run_id is not None:
+      clauses.append("run_id = ?")
+      values.append(run_id)
+    if kind is not None:
+      clauses.append("kind = ?")
+      values.append(kind)
+    query = "delete from cache"
+    if clauses:
+      query += " where " + " and ".join(clauses)
+    with self.lock:
+      self.db.execute(query, values)
+      self.db.commit()
+
+# rows per round trip when streaming query results
+FETCH_SIZE = 1000
+
+_pool = None
+_cache = None
+
+def get_pool():
+  global _pool
+  if _pool is None:
+    _pool = ConnectionPool()
+    atexit.register(_pool.close)
+  return _pool
+
+def get_cache():
+  """
+  The shared result cache, or None if caching is disabled with
+  ALADEMUX_NO_CACHE or params.gnomex_cache_path = None.
+  """
+  global _cache
+  if os.environ.get('ALADEMUX_NO_CACHE'):
+    return None
+  if _cache is None:
+    default = os.path.join(os.path.expanduser('~'), '.cache', 'alademux',
+                           'gnomex_cache.sqlite')
+    path = getattr(params, 'gnomex_cache_path', default)
+    if not path:
+      return None
+    _cache = QueryCache(path,
+                        ttl=getattr(params, 'gnomex_cache_ttl', 3600),
+                        max_bytes=getattr(params, 'gnomex_cache_max_bytes',
+                                          64*1024*1024))
+  return _cache
+
+def fetch_by_run( kind, run_ids, build_query, refresh=False ):
+  '''
+  Rows for each run id, grouped on the last column of the result (which
+  must hold the run id). Runs found in the cache skip the database; the
+  rest are fetched together with one query built by build_query(run_ids)
+  over a pooled connection and then cached. build_query returns either the
+  SQL text or a (SQL, parameters) pair; rows are streamed with fetchmany.
+  '''
+  cache = get_cache()
+  results = {}
+  missing = []
+  for run_id in run_ids:
+    rows = None
+    if cache is not None:
+      if refresh:
+        cache.invalidate(run_id, kind)
+      else:
+        rows = cache.get(kind, run_id)
+    if rows is None:
+      missing.append(run_id)
+    else:
+      results[run_id] = rows
+  if not missing:
+    return results
+
+  fetched = {run_id: [] for run_id in missing}
+  with get_pool().connection() as connection:
+    c = connection.cursor()
+    query = build_query(missing)
+    if isinstance(query, tuple):
+      c.execute(*query)
+    else:
+      c.execute(query)
+    while True:
+      rows = c.fetchmany(FETCH_SIZE)
+      if not rows:
+        break
+      for row in rows:
+        fetched[row[-1]].append(tuple(row))
+  for run_id, rows in fetched.items():
+    # an empty result usually means GNomEx is not filled in yet
+    if cache is not None and rows:
+      cache.put(kind, run_id, rows)
+    results[run_id] = rows
+  return results
+
 def test():
   g = GNomExConnection()
   connection = g.GnConnect(db_user=params.db_user,db_password=params.db_password,asdict=False)
@@ -38,5 +251,20 @@ def test():
     print("results=",results)
     raise
 
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--invalidate', nargs='*', metavar='run',
+      help='Drop cached query results of the given runs, or of all runs.')
+  args = parser.parse_args()
+  if args.invalidate is None:
+    test()
+    return
+  cache = get_cache()
+  if cache is None:
+    print("GNomEx result cache is disabled.")
+    return
+  for run_id in args.invalidate or [None]:
+    cache.invalidate(run_id)
+
 if __name__ == "__main__":
-  test()
+  main()
@@ -2,78 +2,44 @@
 # create_samplesheet.py - given the name of a run folder, create the sample
 # sheet for the run.
 
-import os
-import sys
+import csv
+from collections import Counter
 import datetime as dt
-import gnomex
-import pipelineparams as params
+from runrecords import fetch_run_records
+import timing
 
 class MissingBarcodeError(LookupError):
     '''Barcode missing in lane where required for demultiplexing.'''
 
 class IEMWriter:
-    def __init__(self, run_id, file_path, lanes= None):
+    def __init__(self, run_id, file_path, lanes= None, records=None,
+                 refresh=False):
         self.run_id = run_id
         self.file_path = '/'.join([file_path,'SampleSheet.csv'])
         self.lanes = lanes
-        self.query = """select flowcell.barcode,
-        flowcellchannel.number,
-        sample.number,
-        genomebuild.genomebuildname,
-        sample.barcodesequence,
-        appuser.firstname,
-        appuser.lastname,
-        request.number,
-        sample.barcodesequenceb
-        from flowcell
-        join flowcellchannel on flowcellchannel.idflowcell=flowcell.idflowcell
-        join sequencelane on sequencelane.idflowcellchannel =
-        flowcellchannel.idflowcellchannel
-        join sample on sequencelane.idsample = sample.idsample
-        left outer join genomebuild on sequencelane.idgenomebuildalignto =
-        genomebuild.idgenomebuild
-        join request on sequencelane.idrequest = request.idrequest
-        join appuser on request.idappuser = appuser.idappuser
-        where flowcellchannel.filename = '%s'\n""" % self.run_id
-        if self.lanes:
-            self.query += "and flowcellchannel.number in (%s)\n" % \
-            str(','.join(list(map(str,self.lanes))))
-            self.query += "order by flowcellchannel.number, sample.number;"
+        # RunRecords already fetched for this run, e.g. by fetch_run_records()
+        self.records = records
+        # bypass the GNomEx result cache
+        self.refresh = refresh
     def execute_query(self):
-        g = gnomex.GNomExConnection()
-        connection = g.GnConnect(params.db_user,params.db_password,asdict=False)
-        c = connection.cursor()
-        # if self.lanes:
-        #    # Append lane selection to where clause.
-        #    self.query += "and flowcellchannel.number in (%s)\n" % str(','.join(map(str,self.lanes)))
-        #    self.query += "order by flowcellchannel.number, sample.number;"
-        try:
-            c.execute(self.query)
-        except pymssql.OperationError:
-            sys.stderr.write( self.query )
-            raise
-        records = c.fetchall()
-        connection.close()
-        return(records)
-    def transform_records(self, records):
-        # Count how many samples are in each lane.
-        sample_count = {}
+        if self.records is None:
+            with timing.span('execute_query') as span:
+                self.records = fetch_run_records([self.run_id], self.lanes,
+                                                 self.refresh)[self.run_id]
+                span['records'] = len(self.records)
+        return(self.records)
+    def count_samples(self, records):
+        """Number of samples in each lane, counted in a single pass."""
+        sample_count = Counter()
         for rec in records:
-            try:
-                lane = rec[1]
-            except KeyError:
-                print(rec)
-                raise
-            try:
-                sample_count[lane]+=1
-            except KeyError:
-                sample_count[lane] = 1
-        # Write the records.
-        csv_rows = ''
-        for i,rec in enumerate(records):
-            row = self.clean_row(rec, sample_count)
-            csv_rows += ','.join(row) + '\n'
-        return(csv_rows)
+            sample_count[rec.lane] += 1
+        return(sample_count)
+    def iter_rows(self, records, sample_count=None):
+        """Cleaned sample sheet rows, generated one record at a time."""
+        if sample_count is None:
+            sample_count = self.count_samples(records)
+        for rec in records:
+            yield self.clean_row(rec, sample_count)
     def erase_commas(self, field):
         """Removes all commas."""
         if field:
@@ -84,11 +50,11 @@ class IEMWriter:
         """
         Handle edge cases in records.
         """
-        dr = {'Lane' : self.erase_commas(str(rec[1])),
-        'Sample_ID' : self.erase_commas(rec[2]),
-        'Sample_Project' : self.erase_commas(rec[7]),
-        'index' : self.erase_commas(rec[4]),
-        'index2' : self.erase_commas(rec[8])
+        dr = {'Lane' : self.erase_commas(str(rec.lane)),
+        'Sample_ID' : self.erase_commas(rec.sample_id),
+        'Sample_Project' : self.erase_commas(rec.project),
+        'index' : self.erase_commas(rec.index),
+        'index2' : self.erase_commas(rec.index2)
         }
         # replace nones with emptry string
         # no trailing white space
@@ -97,7 +63,7 @@ class IEMWriter:
                 dr[k] = ''
             dr[k] = dr[k].strip()
         # If lane has a single sample, don't write its barcode.
-        lane = rec[1]
+        lane = rec.lane
         if sample_count[lane] == 1:
             dr['index'] = ''
             dr['index2'] = ''
@@ -143,12 +109,13 @@ class IEMWriter:
             print("No GNomEx records found for run id: %s\n" % self.run_id)
             return(False)
 
-        records = self.transform_records(db_records)
         if iem_header:
             header = self.generate_header()
         else:
             header = self.generate_header(iem_header=False)
-        sample_sheet_content = header + records
-        with open(self.file_path, "w") as file:
-            file.write(sample_sheet_content)
+        with timing.span('write_sample_sheet', records=len(db_records)):
+            with open(self.file_path, "w", newline='') as file:
+                file.write(header)
+                writer = csv.writer(file, lineterminator='\n')
+                writer.writerows(self.iter_rows(db_records))
         return(True)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# incremental.py - find the lanes whose sample sheet rows changed since the
+# last demultiplexing of a run, and link the outputs of the unchanged lanes
+# from that demultiplexing into a new output directory.
+
+import os
+import re
+from samplesheet import read_sample_sheet
+from shardmerge import filter_stats_xml, merge_stats_json
+
+# lane number in bcl2fastq output names, e.g. S1_S1_L002_R1_001.fastq.gz
+LANE_PATTERN = re.compile(r'_L(\d{3})_')
+# output folders that are not FASTQ projects
+SKIPPED_DIRS = ['Stats', 'Reports', 'shards']
+STATS_XML = ['ConversionStats.xml', 'DemultiplexingStats.xml']
+
+def latest_output(run_path, exclude=None):
+    """
+    Most recent finished demultiplexing of a run: the newest timestamped
+    folder under run_path, other than exclude, with a sample sheet and
+    Stats/Stats.json. None if there is none.
+    """
+    if not os.path.isdir(run_path):
+        return(None)
+    for name in sorted(os.listdir(run_path), reverse=True):
+        path = os.path.join(run_path, name)
+        if name == exclude or not os.path.isdir(path):
+            continue
+        if os.path.exists(os.path.join(path, 'SampleSheet.csv')) and \
+           os.path.exists(os.path.join(path, 'Stats', 'Stats.json')):
+            return(path)
+    return(None)
+
+def lane_rows(sheet):
+    """Rows of each lane as a set of tuples over the sheet's columns."""
+    columns = sorted(sheet.columns)
+    lanes = {}
+    for row in sheet.rows:
+        lanes.setdefault(int(row.get('Lane') or 1), set()).add(
+            tuple(row.get(col, '') for col in columns))
+    return(lanes)
+
+def changed_lanes(old_sheet, new_sheet):
+    """
+    Lanes of new_sheet to demultiplex again, and lanes whose previous
+    outputs can be reused. A lane is unchanged if its rows are identical.
+    """
+    if sorted(old_sheet.columns) != sorted(new_sheet.columns):
+        return(sorted(new_sheet.lanes()), [])
+    old = lane_rows(old_sheet)
+    new = lane_rows(new_sheet)
+    changed = sorted(lane for lane in new if old.get(lane) != new[lane])
+    unchanged = sorted(lane for lane in new if lane not in changed)
+    return(changed, unchanged)
+
+def lane_of(fname):
+    match = LANE_PATTERN.search(os.path.basename(fname))
+    return(int(match.group(1)) if match else None)
+
+def link(src, dest):
+    """Hard link dest to src, or symlink across filesystems."""
+    try:
+        os.link(src, dest)
+    except OSError:
+        os.symlink(os.path.abspath(src), dest)
+
+def link_lanes(previous, dest, lanes):
+    """
+    Fill dest with links to the FASTQs of lanes in the previous output, in
+    the same layout, and its Stats restricted to those lanes. dest can then
+    be merged like a lane shard. Returns the number of files linked.
+    """
+    linked = 0
+    for root, dirs, files in os.walk(previous):
+        if root == previous:
+            dirs[:] = [d for d in dirs if d not in SKIPPED_DIRS]
+        for fname in files:
+            if not fname.endswith('.fastq.gz') or lane_of(fname) not in lanes:
+                continue
+            target = os.path.join(dest, os.path.relpath(root, previous))
+            os.makedirs(target, exist_ok=True)
+            link(os.path.join(root, fname), os.path.join(target, fname))
+            linked += 1
+    stats = os.path.join(previous, 'Stats')
+    os.makedirs(os.path.join(dest, 'Stats'), exist_ok=True)
+    merge_stats_json([os.path.join(stats, 'Stats.json')],
+                     os.path.join(dest, 'Stats', 'Stats.json'), lanes)
+    for name in STATS_XML:
+        fname = os.path.join(stats, name)
+        if os.path.exists(fname):
+            filter_stats_xml(fname, os.path.join(dest, 'Stats', name), lanes)
+    return(linked)
+
+def plan_incremental(previous, out_path, sheet_name='SampleSheet.csv'):
+    """
+    Changed and unchanged lanes of the sample sheet in out_path compared
+    with the one of the previous output.
+    """
+    old_sheet = read_sample_sheet(os.path.join(previous, sheet_name))
+    new_sheet = read_sample_sheet(os.path.join(out_path, sheet_name))
+    return(changed_lanes(old_sheet, new_sheet))
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# indexpeek.py - sample the index cycles of a few tiles per lane straight from
+# the BCL/CBCL base calls and compare observed barcodes with the sample sheet.
+
+import gzip
+import os
+import struct
+import zlib
+import numpy as np
+
+BASES = np.array(list('ACGTN'))
+N_CODE = 4
+COMPLEMENT = str.maketrans('ACGTN', 'TGCAN')
+
+def reverse_complement(seq):
+    return(seq.translate(COMPLEMENT)[::-1])
+
+def read_filter(fname):
+    """Passing-filter flags of a tile's .filter file."""
+    data = np.fromfile(fname, dtype=np.uint8)
+    # 12 byte header: zero, version, cluster count
+    return((data[12:] & 1).astype(bool))
+
+def decode_bcl_bytes(raw):
+    """Base codes 0-3 for ACGT and 4 for no call from BCL bytes."""
+    return(np.where(raw == 0, N_CODE, raw & 3).astype(np.uint8))
+
+class CbclFile:
+    """Header of a NovaSeq CBCL file and access to its per-tile blocks."""
+    def __init__(self, fname):
+        self.fname = fname
+        self.data = np.memmap(fname, dtype=np.uint8, mode='r')
+        version, header_size = struct.unpack_from('<HI', self.data[:6].tobytes())
+        header = self.data[:header_size].tobytes()
+        nbins = struct.unpack_from('<I', header, 8)[0]
+        offset = 12 + 8 * nbins
+        ntiles = struct.unpack_from('<I', header, offset)[0]
+        offset += 4
+        # tile -> (clusters, offset of compressed block, compressed size)
+        self.tiles = {}
+        start = header_size
+        for _ in range(ntiles):
+            tile, clusters, usize, csize = struct.unpack_from('<IIII', header,
+                                                              offset)
+            offset += 16
+            self.tiles[tile] = (clusters, start, csize)
+            start += csize
+        # 1 if clusters failing filter were left out of the blocks
+        self.pf_only = header[offset] == 1
+    def tile_codes(self, tile):
+        clusters, start, csize = self.tiles[tile]
+        block = zlib.decompress(self.data[start:start + csize].tobytes(), 31)
+        packed = np.frombuffer(block, dtype=np.uint8)
+        # two clusters per byte, low nibble first: 2 bits base, 2 bits qscore
+        nibbles = np.empty(packed.size * 2, dtype=np.uint8)
+        nibbles[0::2] = packed & 0x0F
+        nibbles[1::2] = packed >> 4
+        nibbles = nibbles[:clusters]
+        return(np.where((nibbles >> 2) == 0, N_CODE,
+                        nibbles & 3).astype(np.uint8))
+
+class LaneCalls:
+    """Base calls of one lane, from per-tile BCL or per-surface CBCL files."""
+    def __init__(self, run_folder, lane):
+        self.lane = lane
+        self.lane_dir = os.path.join(run_folder, 'Data', 'Intensities',
+                                     'BaseCalls', 'L%03d' % lane)
+        self.basecalls = os.path.dirname(self.lane_dir)
+        self.cbcl = {}
+    def cycle_dir(self, cycle):
+        return(os.path.join(self.lane_dir, 'C%d.1' % cycle))
+    def cbcl_file(self, cycle, surface):
+        fname = os.path.join(self.cycle_dir(cycle),
+                             'L%03d_%d.cbcl' % (self.lane, surface))
+        if fname not in self.cbcl:
+            self.cbcl[fname] = CbclFile(fname)
+        return(self.cbcl[fname])
+    def tiles(self, cycle):
+        """Tiles present at a cycle, as (surface or None, tile number)."""
+        tiles = []
+        for name in sorted(os.listdir(self.cycle_dir(cycle))):
+            if name.endswith('.cbcl'):
+                surface = int(name.split('_')[1].split('.')[0])
+                tiles.extend((surface, tile) for tile in
+                             self.cbcl_file(cycle, surface).tiles)
+            elif name.startswith('s_%d_' % self.lane) and '.bcl' in name:
+                tiles.append((None, int(name.split('_')[2].split('.')[0])))
+        return(tiles)
+    def filter_flags(self, tile):
+        for directory in [self.lane_dir, self.basecalls]:
+            fname = os.path.join(directory, 's_%d_%d.filter' % (self.lane, tile))
+            if os.path.exists(fname):
+                return(read_filter(fname))
+        return(None)
+    def bcl_codes(self, cycle, tile):
+        prefix = os.path.join(self.cycle_dir(cycle), 's_%d_%d.bcl' % (self.lane, tile))
+        if os.path.exists(prefix):
+            # memory-mapped, past the uint32 cluster count
+            return(decode_bcl_bytes(np.memmap(prefix, dtype=np.uint8,
+                                              mode='r', offset=4)))
+        with gzip.open(prefix + '.gz', 'rb') as infile:
+            raw = np.frombuffer(infile.read(), dtype=np.uint8)[4:]
+        return(decode_bcl_bytes(raw))
+    def read_cycles(self, cycles, surface, tile, max_clusters):
+        """(clusters, len(cycles)) base codes of passing clusters of a tile."""
+        columns = []
+        pf = None
+        for cycle in cycles:
+            if surface is None:
+                codes = self.bcl_codes(cycle, tile)
+                keep_all = False
+            else:
+                cbcl = self.cbcl_file(cycle, surface)
+                codes = cbcl.tile_codes(tile)
+                keep_all = cbcl.pf_only
+            if pf is None and not keep_all:
+                pf = self.filter_flags(tile)
+            if pf is not None and len(pf) == len(codes):
+                codes = codes[pf]
+            columns.append(codes[:max_clusters])
+        n = min(len(col) for col in columns)
+        return(np.stack([col[:n] for col in columns], axis=1))
+
+def index_cycles(run, lengths):
+    """Cycle numbers of the first lengths[i] bases of each index read."""
+    cycles = []
+    first = 1
+    n_index = 0
+    for read in run.reads:
+        if read.is_index:
+            length = min(lengths[n_index], read.cycles) if n_index < len(lengths) else 0
+            cycles.append(list(range(first, first + length)))
+            n_index += 1
+        first += read.cycles
+    return(cycles)
+
+def sample_lane(run, lane, lengths, tiles_per_lane=4, max_clusters=250000):
+    """
+    Observed index and index2 sequences of a sample of tiles in a lane, as
+    two (clusters, length) arrays of base codes.
+    """
+    calls = LaneCalls(run.run_folder, lane)
+    cycles = index_cycles(run, lengths)
+    all_cycles = [c for read_cycles in cycles for c in read_cycles]
+    if not all_cycles:
+        return(None)
+    tiles = calls.tiles(all_cycles[0])
+    if not tiles:
+        return(None)
+    step = max(1, len(tiles) // tiles_per_lane)
+    chosen = tiles[::step][:tiles_per_lane]
+    per_tile = max(1, max_clusters // len(chosen))
+    blocks = [calls.read_cycles(all_cycles, surface, tile, per_tile)
+              for surface, tile in chosen]
+    codes = np.concatenate(blocks, axis=0)
+    split = len(cycles[0]) if cycles else 0
+    return((codes[:, :split], codes[:, split:]))
+
+def sequence_keys(codes):
+    """One integer per row, base 5 over the row's base codes."""
+    keys = np.zeros(len(codes), dtype=np.int64)
+    for col in range(codes.shape[1]):
+        keys = keys * 5 + codes[:, col]
+    return(keys)
+
+def key_sequence(key, length):
+    bases = []
+    for _ in range(length):
+        key, code = divmod(int(key), 5)
+        bases.append(BASES[code])
+    return(''.join(reversed(bases)))
+
+def summarize_lane(index1, index2, expected, top=10):
+    """
+    Compare observed barcodes with the expected (sample, index, index2)
+    rows of a lane. Returns a dict with per sample counts, the most common
+    unexpected barcodes, the undetermined fraction and index2 orientation
+    counts.
+    """
+    total = len(index1)
+    len1 = index1.shape[1]
+    len2 = index2.shape[1]
+    keys = sequence_keys(np.concatenate([index1, index2], axis=1))
+    uniq, counts = np.unique(keys, return_counts=True)
+    observed = dict(zip(uniq.tolist(), counts.tolist()))
+    def pair_key(i1, i2):
+        seq = (i1 or '')[:len1].ljust(len1, 'N') + (i2 or '')[:len2].ljust(len2, 'N')
+        codes = np.array([['ACGTN'.find(b) % 5 for b in seq.upper()]],
+                         dtype=np.int64)
+        return(int(sequence_keys(codes)[0]) if len(seq) else 0)
+    samples = []
+    matched = 0
+    forward = 0
+    reverse = 0
+    expected_keys = set()
+    for sample_id, i1, i2 in expected:
+        key = pair_key(i1, i2)
+        expected_keys.add(key)
+        count = observed.get(key, 0)
+        matched += count
+        samples.append((sample_id, i1, i2, count))
+        if i2 and len2:
+            forward += count
+            reverse += observed.get(pair_key(i1, reverse_complement(i2)), 0)
+    unexpected = sorted(((count, key) for key, count in observed.items()
+                         if key not in expected_keys), reverse=True)[:top]
+    unexpected = [(key_sequence(key, len1 + len2), count)
+                  for count, key in unexpected]
+    unexpected = [(seq[:len1], seq[len1:], count) for seq, count in unexpected]
+    return({'clusters': total,
+            'samples': samples,
+            'unexpected': unexpected,
+            'undetermined': 1 - matched / total if total else None,
+            'index2_forward': forward,
+            'index2_reverse': reverse})
+
+def format_summary(lane, summary):
+    lines = ['Lane %s: %d passing clusters sampled' % (lane, summary['clusters'])]
+    if not summary['clusters']:
+        return(lines)
+    lines.append('  Sample_ID            index        index2       observed')
+    for sample_id, i1, i2, count in summary['samples']:
+        lines.append('  %-20s %-12s %-12s %6.2f%%' %
+                     (sample_id, i1 or '-', i2 or '-',
+                      100.0 * count / summary['clusters']))
+    lines.append('  Estimated undetermined: %.1f%%' %
+                 (100 * summary['undetermined']))
+    if summary['index2_reverse'] > summary['index2_forward']:
+        lines.append('  WARNING index2 is mostly observed reverse complemented '
+                     '(%d vs %d clusters)' % (summary['index2_reverse'],
+                                              summary['index2_forward']))
+    lines.append('  Top unexpected barcodes:')
+    for i1, i2, count in summary['unexpected']:
+        lines.append('  %-12s %-12s %6.2f%%' %
+                     (i1, i2, 100.0 * count / summary['clusters']))
+    return(lines)
+
+def peek_run(run, rows, tiles_per_lane=4, max_clusters=250000):
+    """
+    Sample every lane with barcoded rows, where rows are the sample sheet
+    rows [Lane, Sample_ID, Sample_Name, Sample_Project, index, index2] as
+    written by IEMWriter. Returns a list of report lines.
+    """
+    lanes = {}
+    for row in rows:
+        lanes.setdefault(int(row[0]), []).append((row[1], row[4], row[5]))
+    lines = []
+    for lane, expected in sorted(lanes.items()):
+        lengths = [max(len(e[1] or '') for e in expected),
+                   max(len(e[2] or '') for e in expected)]
+        if not lengths[0]:
+            lines.append('Lane %d: single sample, no barcode to check' % lane)
+            continue
+        sampled = sample_lane(run, lane, lengths, tiles_per_lane, max_clusters)
+        if sampled is None:
+            lines.append('Lane %d: no base calls found' % lane)
+            continue
+        lines.extend(format_summary(lane, summarize_lane(sampled[0],
+                                                         sampled[1],
+                                                         expected)))
+    return(lines)
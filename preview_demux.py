@@ -1,67 +1,50 @@
 #!/usr/bin/env python
 # execute_pipeline.py - top level code to run hci_demux pipelines.
-import sys
+import argparse
+import json
 import os
-import xml.dom.minidom
+import time
 
 from logger import Logger
+from runinfo import load_run
+from runrecords import fetch_run_records
 import pipelineparams as params
-import gnomex
 
 def SummarizeRunInfo(run_full_path):
   """
-  Given the full path name of a run folder, this function returns the
-  number of data reads for the sequencing run by parsing the RunInfo.xml
-  file.
+  Given the full path name of a run folder, this function logs the
+  read structure of the sequencing run from its RunInfo.xml file.
   """
-  # Parse the RunInfo.xml file.
-  configfile = os.path.join(run_full_path, "RunInfo.xml")
-
-  if not os.path.exists(configfile):
-    Log().Log('File %s does not exist!' %s)
+  run = load_run(run_full_path)
+  if run is None:
+    Logger().Log('File %s does not exist!' %
+                 os.path.join(run_full_path, "RunInfo.xml"))
     return None
-  doc = xml.dom.minidom.parse(configfile)
-
 
   Logger().Log("Flow cell configuration: ")
-  # Get the Read elements from the document.
-  reads=doc.getElementsByTagName("Read")
-  keys = ['Number', 'NumCycles', 'IsIndexedRead']
+  if run.lanes:
+    Logger().Log("%s, %d lanes x %d tiles" %
+                 (run.instrument(), run.lanes, run.tiles))
   Logger().Log('Number | NumCycles | IndexRead')
-  for read in reads:
-    vals = [read.getAttribute(key) for key in keys]
-    Logger().Log("%s      | %s       | %s" %  (vals[0],vals[1],vals[2]))
+  for read in run.reads:
+    Logger().Log("%s      | %s       | %s" %
+                 (read.number, read.cycles, 'Y' if read.is_index else 'N'))
 
-  return None
+  return run
 
-def IdentifyPipeline(run_id):
+def IdentifyPipeline(run_id, refresh=False):
   """
   IdentifyPipeline(run_id) - given id of a sequencing run (which is the
   directory name of the run folder, not full path) returns
   the class that is to process the run, or None of the type of run
-  isn't recognized.
+  isn't recognized. Cached GNomEx results are used unless refresh is set.
   """
-  # Connect to GNomex.
-  connection = gnomex.GNomExConnection().GnConnect(params.db_user,params.db_password)
-  c = connection.cursor()
   # Select the sequencing application name(s) in use on the flow cell.
-  query="""select distinct fcc.number as Lane, app.application as Application, req.number as Sample_Project
-                from application as app
-                join seqlibprotocolapplication as slpapp
-                    on app.codeapplication = slpapp.codeapplication
-                join seqlibprotocol as slp
-                    on slp.idseqlibprotocol = slpapp.idseqlibprotocol
-                join sample
-                    on sample.idseqlibprotocol = slp.idseqlibprotocol
-                join request as req
-                    on sample.idRequest = req.idRequest
-                join sequencelane as seqlane
-                    on seqlane.idsample = sample.idsample
-                join flowcellchannel as fcc
-                    on seqlane.idflowcellchannel = fcc.idflowcellchannel
-                    where fcc.filename = '%s'\n""" % run_id
-  c.execute(query)
-  recs=c.fetchall()
+  records = fetch_run_records([run_id], refresh=refresh)[run_id]
+  recs = list(dict.fromkeys((rec.lane, application, rec.project)
+                            for rec in records
+                            for application in rec.applications or
+                            (rec.application,)))
   if len(recs) == 0:
     Logger().Log("No records found for run id: %s" % run_id)
     return None
@@ -79,18 +62,266 @@ def IdentifyPipeline(run_id):
 
   return None
 
+def PeekIndexReads(run, run_id, tiles_per_lane=4, refresh=False):
+  """
+  PeekIndexReads(run, run_id) - prints the barcodes observed in a sample of
+  tiles per lane next to those of the sample sheet IEMWriter would write.
+  Cached GNomEx results are used unless refresh is set.
+  """
+  from indexpeek import peek_run
+  from iemwriter import IEMWriter, MissingBarcodeError
+  records = fetch_run_records([run_id], refresh=refresh)[run_id]
+  if not records:
+    return None
+  iem = IEMWriter(run_id, run.run_folder, records=records)
+  sample_count = iem.count_samples(records)
+  try:
+    rows = list(iem.iter_rows(records, sample_count))
+  except MissingBarcodeError:
+    missing = sorted(set('%s (lane %s)' % (rec.sample_id, rec.lane)
+                         for rec in records if sample_count[rec.lane] > 1
+                         and not (rec.index or '').strip()))
+    Logger().Log("Cannot peek at the index reads, samples without a "
+                 "barcode: %s" % ', '.join(missing))
+    return None
+  for line in peek_run(run, rows, tiles_per_lane):
+    print(line)
+  return None
+
+def DemuxType(application):
+  """
+  DemuxType(application) - alademux demultiplexing type suited to a GNomEx
+  application name.
+  """
+  app = (application or '').lower()
+  if '10x' in app:
+    if 'atac' in app:
+      return '10x-atac'
+    if 'genome' in app or 'exome' in app or 'linked' in app:
+      return '10x-long'
+    return '10x'
+  if 'patch pcr' in app:
+    return 'patchpcr'
+  return 'standard'
+
+def DemuxTypes(run_id, refresh=False, records=None):
+  """
+  DemuxTypes(run_id) - returns a dict of demultiplexing type to the sorted
+  lanes needing it, and a list of lanes mixing several types (which cannot
+  be demultiplexed in one pass). Both are empty if GNomEx has no records.
+  records, the run's RunRecords, saves the query when already fetched.
+  """
+  if records is None:
+    records = fetch_run_records([run_id], refresh=refresh)[run_id]
+  lane_types = {}
+  for rec in records:
+    kinds = lane_types.setdefault(rec.lane, set())
+    for application in rec.applications or (rec.application,):
+      kinds.add(DemuxType(application))
+  types = {}
+  mixed = []
+  for lane, kinds in sorted(lane_types.items()):
+    if len(kinds) > 1:
+      mixed.append(lane)
+    else:
+      types.setdefault(kinds.pop(), []).append(lane)
+  return types, mixed
+
+def EstimateDemux(run, run_id, history_file=None, refresh=False):
+  """
+  EstimateDemux(run, run_id) - prints the predicted wall time, memory and
+  output of demultiplexing each library type of the run, from the GNomEx
+  records, the thread plan alademux would choose and the demux history.
+  Cached GNomEx results are used unless refresh is set.
+  """
+  from estimator import estimate, format_estimate, run_features
+  from threadplanner import plan_threads
+  records = fetch_run_records([run_id], refresh=refresh)[run_id]
+  types, mixed = DemuxTypes(run_id, records=records)
+  for demux_type, lanes in sorted(types.items()):
+    samples = len(set((rec.lane, rec.sample_id) for rec in records
+                      if rec.lane in lanes))
+    plan = None
+    if not demux_type.startswith('10x'):
+      plan = plan_threads(run.run_folder, params.demux_result_path, samples,
+                          history_file)
+    features = run_features(run, demux_type, samples, plan, len(lanes))
+    print("%s, lanes %s:" % (demux_type, ' '.join(map(str, lanes))))
+    for line in format_estimate(estimate(features, history_file)):
+      print("  " + line)
+  return None
+
+class ScanCache:
+  """
+  Summaries of run folders persisted as JSON, each valid while the folder's
+  modification time is unchanged (a new completion marker changes it).
+  """
+  def __init__(self, fname):
+    self.fname = fname
+    self.runs = {}
+    if fname and os.path.exists(fname):
+      try:
+        with open(fname) as infile:
+          self.runs = json.load(infile)
+      except ValueError:
+        self.runs = {}
+
+  def get(self, run_id, mtime):
+    entry = self.runs.get(run_id)
+    if entry and entry['mtime'] == mtime:
+      return entry
+    return None
+
+  def save(self):
+    if not self.fname:
+      return
+    dirname = os.path.dirname(self.fname)
+    if dirname:
+      os.makedirs(dirname, exist_ok=True)
+    tmp = self.fname + '.tmp'
+    with open(tmp, 'w') as outfile:
+      json.dump(self.runs, outfile, sort_keys=True)
+    os.replace(tmp, self.fname)
+
+def SummarizeFolder(run_path, mtime):
+  """
+  SummarizeFolder(run_path, mtime) - instrument, lanes, read structure and
+  completion of a run folder, as stored in the scan cache.
+  """
+  from watcher import COMPLETION_MARKERS
+  entry = {'mtime': mtime, 'instrument': None, 'lanes': None, 'reads': None,
+           'complete': any(os.path.exists(os.path.join(run_path, marker))
+                           for marker in COMPLETION_MARKERS)}
+  try:
+    run = load_run(run_path)
+  except Exception:
+    # RunInfo.xml still being written
+    run = None
+  if run is not None:
+    entry.update({'instrument': run.instrument(), 'lanes': run.lanes,
+                  'reads': '+'.join('%d%s' % (read.cycles,
+                                              'i' if read.is_index else '')
+                                    for read in run.reads)})
+  return entry
+
+def ScanRuns(run_path, out_path, days=14, refresh=False, jobs=8,
+             cache_file=None):
+  """
+  ScanRuns(run_path, out_path) - prints a table of the runs under run_path
+  changed in the last days with their lanes, library types and readiness.
+  Folders are summarized by a thread pool, unchanged folders come from the
+  cache, and the GNomEx records of every pending run are fetched at once.
+  """
+  from concurrent.futures import ThreadPoolExecutor
+  from incremental import latest_output
+  cache = ScanCache(cache_file)
+  since = time.time() - days * 86400 if days else 0
+  folders = []
+  present = set()
+  with os.scandir(run_path) as it:
+    for entry in it:
+      if entry.is_dir():
+        present.add(entry.name)
+        mtime = entry.stat().st_mtime
+        if mtime >= since:
+          folders.append((entry.name, entry.path, mtime))
+  stale = [(name, path, mtime) for name, path, mtime in folders
+           if cache.get(name, mtime) is None]
+  with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+    summaries = pool.map(lambda f: SummarizeFolder(f[1], f[2]), stale)
+    for (name, path, mtime), summary in zip(stale, summaries):
+      cache.runs[name] = summary
+  # folders gone from the repository are dropped from the cache
+  cache.runs = {name: entry for name, entry in cache.runs.items()
+                if name in present}
+  names = set(name for name, path, mtime in folders)
+  cache.save()
+  Logger().Log('Scanned %d runs, %d new or changed' %
+               (len(folders), len(stale)))
+
+  status = {}
+  for name in names:
+    summary = cache.runs[name]
+    if not summary['complete']:
+      status[name] = 'sequencing'
+    elif latest_output(os.path.join(out_path, name)):
+      status[name] = 'done'
+    elif os.path.isdir(os.path.join(out_path, name)):
+      status[name] = 'set up'
+  pending = sorted(name for name in names if name not in status)
+  records = fetch_run_records(pending, refresh=refresh) if pending else {}
+  types = {}
+  for name in pending:
+    lane_types, mixed = DemuxTypes(name, records=records[name])
+    types[name] = ' '.join('%s:%s' % (demux_type,
+                                      ','.join(map(str, lanes)))
+                           for demux_type, lanes in sorted(lane_types.items()))
+    if not records[name]:
+      status[name] = 'no records'
+    elif mixed:
+      status[name] = 'mixed lanes %s' % ','.join(map(str, mixed))
+    else:
+      status[name] = 'ready'
+
+  row = '%-36s %-10s %5s %-16s %-28s %s'
+  print(row % ('Run', 'Instrument', 'Lanes', 'Reads', 'Types', 'Status'))
+  for name in sorted(names, reverse=True):
+    summary = cache.runs[name]
+    print(row % (name, summary['instrument'] or '-',
+                 summary['lanes'] or '-', summary['reads'] or '-',
+                 types.get(name, '') or '-', status[name]))
+  return None
+
 def main():
   """
   main() function for previewing demultiplexing requirements.
   """
-  run_id=sys.argv[1]
-  run_full_path='/Repository/SeqStore04/IlluminaRuns/' + run_id
+  parser = argparse.ArgumentParser()
+  parser.add_argument("run_id", help="Illumina run ID", type=str, nargs="?")
+  parser.add_argument("--scan", action="store_true",
+      help="List the recent runs of the run repository and their readiness.")
+  parser.add_argument("--days", type=int, default=14,
+      help="Runs changed in the last days listed by --scan, 0 for all.")
+  parser.add_argument("-j", "--jobs", type=int, default=8,
+      help="Run folders summarized concurrently by --scan.")
+  parser.add_argument("-i", "--run_path", default=params.illumina_run_path,
+      help="Path to directory with Illumina Instrument Runs.")
+  parser.add_argument("--refresh", action="store_true",
+      help="Query GNomEx even if cached results exist.")
+  parser.add_argument("--peek", action="store_true",
+      help="Sample index reads from the base calls and compare them with the sample sheet.")
+  parser.add_argument("--tiles", type=int, default=4,
+      help="Tiles per lane sampled by --peek.")
+  parser.add_argument("--estimate", action="store_true",
+      help="Predict the wall time, memory and output of demultiplexing.")
+  parser.add_argument("--history", type=str,
+      default=getattr(params, 'demux_history', None),
+      help="Demux history file the estimate is fitted on.")
+  args = parser.parse_args()
+  if args.scan:
+    default = os.path.join(os.path.expanduser('~'), '.cache', 'alademux',
+                           'scan_cache.json')
+    ScanRuns(args.run_path, params.demux_result_path, args.days,
+             args.refresh, args.jobs,
+             getattr(params, 'scan_cache_path', default))
+    return
+  if not args.run_id:
+    parser.error("a run ID is required unless --scan is given")
+  run_id = args.run_id
+  run_full_path = os.path.join(args.run_path, run_id)
+  run = None
   if os.path.isdir(run_full_path):
-    SummarizeRunInfo(run_full_path)
+    run = SummarizeRunInfo(run_full_path)
   else:
     Logger().Log("Directory %s does not exist." % run_full_path)
   print("\n")
-  IdentifyPipeline(run_id)
+  IdentifyPipeline(run_id, args.refresh)
+  if args.peek and run is not None:
+    print("\n")
+    PeekIndexReads(run, run_id, args.tiles, args.refresh)
+  if args.estimate and run is not None:
+    print("\n")
+    EstimateDemux(run, run_id, args.history, args.refresh)
 
 if __name__ == "__main__":
   main()
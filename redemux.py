@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# redemux.py - assign the reads of bcl2fastq Undetermined FASTQs to samples of
+# a corrected sample sheet, without running bcl2fastq again.
+
+import argparse
+import gzip
+import itertools
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from samplesheet import read_sample_sheet
+
+# bcl2fastq's default --fastq-compression-level
+COMPRESSION_LEVEL = 4
+# reads handed to a worker at a time
+CHUNK_READS = 100000
+# chunks per worker process read but not yet written, over all lanes;
+# bounds memory
+CHUNKS_IN_FLIGHT = 2
+UNDETERMINED = 'Undetermined_S0_L%03d_%s_001.fastq.gz'
+READ_NAMES = ['R1', 'R2', 'R3', 'R4', 'I1', 'I2']
+
+def parse_mismatches(value):
+    """(index, index2) tolerance from a bcl2fastq style 'm' or 'm1,m2'."""
+    values = [int(v) for v in value.split(',')]
+    if len(values) == 1:
+        values.append(values[0])
+    if any(v < 0 or v > 2 for v in values[:2]):
+        raise argparse.ArgumentTypeError('mismatches must be 0, 1 or 2')
+    return(tuple(values[:2]))
+
+def variants(seq, mismatches):
+    """Every sequence within mismatches substitutions of seq, with distance."""
+    found = {seq: 0}
+    frontier = [seq]
+    for distance in range(1, mismatches + 1):
+        following = []
+        for base_seq in frontier:
+            for i, base in enumerate(base_seq):
+                for other in 'ACGTN':
+                    if other == base:
+                        continue
+                    variant = base_seq[:i] + other + base_seq[i + 1:]
+                    if variant not in found:
+                        found[variant] = distance
+                        following.append(variant)
+        frontier = following
+    return(found)
+
+class LaneMatcher:
+    """
+    Index lookups of the samples of one lane. Like bcl2fastq, a read goes to
+    a sample when every index read is within the tolerated mismatches; reads
+    matching several samples are left undetermined unless one of them is the
+    unique closest.
+    """
+    def __init__(self, samples, mismatches):
+        # samples: list of (key, index, index2)
+        self.dual = any(index2 for key, index, index2 in samples)
+        self.index1 = {}
+        self.index2 = {}
+        for key, index, index2 in samples:
+            for seq, distance in variants(index, mismatches[0]).items():
+                self.index1.setdefault(seq, {})[key] = distance
+            if self.dual:
+                for seq, distance in variants(index2, mismatches[1]).items():
+                    self.index2.setdefault(seq, {})[key] = distance
+        self.lengths1 = sorted(set(len(s[1]) for s in samples))
+        self.lengths2 = sorted(set(len(s[2]) for s in samples))
+        self.cache = {}
+    def lookup(self, table, lengths, observed):
+        hits = {}
+        for length in lengths:
+            for key, distance in table.get(observed[:length], {}).items():
+                hits[key] = distance
+        return(hits)
+    def match(self, barcode):
+        """(sample key, mismatches) of an observed 'index+index2', or None."""
+        if barcode in self.cache:
+            return(self.cache[barcode])
+        observed = barcode.split('+')
+        hits = self.lookup(self.index1, self.lengths1, observed[0])
+        if self.dual:
+            second = self.lookup(self.index2, self.lengths2,
+                                 observed[1] if len(observed) > 1 else '')
+            hits = {key: distance + second[key] for key, distance in
+                    hits.items() if key in second}
+        result = None
+        if hits:
+            best = min(hits.values())
+            closest = [key for key, distance in hits.items()
+                       if distance == best]
+            if len(closest) == 1:
+                result = (closest[0], best)
+        self.cache[barcode] = result
+        return(result)
+
+def header_barcode(header):
+    """Index sequence(s) from the comment of a bcl2fastq read header."""
+    return(header.rstrip().rsplit(b':', 1)[-1].decode('ascii'))
+
+_matchers = {}
+
+def init_worker(lane_samples, mismatches):
+    for lane, samples in lane_samples.items():
+        _matchers[lane] = LaneMatcher(samples, mismatches)
+
+def assign_chunk(lane, chunk):
+    """
+    Split a chunk of records, one list of 4-line records per read file, by
+    sample. Returns gzip members per sample and read file, and per sample
+    counts by number of mismatches. Undetermined reads have key None.
+    """
+    matcher = _matchers[lane]
+    records = {}
+    counts = {}
+    for i, record in enumerate(chunk[0]):
+        hit = matcher.match(header_barcode(record[:record.index(b'\n')]))
+        key, distance = hit if hit else (None, 0)
+        records.setdefault(key, []).append(i)
+        by_distance = counts.setdefault(key, {})
+        by_distance[distance] = by_distance.get(distance, 0) + 1
+    members = {}
+    for key, indices in records.items():
+        members[key] = [gzip.compress(b''.join(read[i] for i in indices),
+                                      COMPRESSION_LEVEL)
+                        for read in chunk]
+    return(members, counts)
+
+def read_records(fname, n):
+    """Chunks of n raw 4-line FASTQ records of a gzipped file."""
+    with gzip.open(fname, 'rb') as infile:
+        while True:
+            lines = list(itertools.islice(infile, 4 * n))
+            if not lines:
+                return
+            yield [b''.join(lines[i:i + 4]) for i in range(0, len(lines), 4)]
+
+class Redemultiplexer:
+    def __init__(self, sheet, in_path, out_path, mismatches=(1, 1),
+                 processes=None, chunk_reads=CHUNK_READS):
+        self.sheet = sheet
+        self.in_path = in_path
+        self.out_path = out_path
+        self.mismatches = mismatches
+        self.processes = processes or os.cpu_count() or 1
+        self.chunk_reads = chunk_reads
+        # permits for chunks read and not yet written, shared by the lanes
+        self.in_flight = threading.BoundedSemaphore(CHUNKS_IN_FLIGHT *
+                                                    self.processes)
+        # Sample_ID -> (sample number, Sample_Name, Sample_Project), numbered
+        # in sample sheet order as bcl2fastq does
+        self.samples = {}
+        for row in sheet.rows:
+            if row['Sample_ID'] not in self.samples:
+                self.samples[row['Sample_ID']] = (len(self.samples) + 1,
+                                                  row.get('Sample_Name') or
+                                                  row['Sample_ID'],
+                                                  row.get('Sample_Project', ''))
+    def lane_samples(self, lanes=None):
+        """Barcoded samples of each lane as (Sample_ID, index, index2)."""
+        lane_samples = {}
+        for row in self.sheet.rows:
+            lane = int(row.get('Lane') or 1)
+            if lanes and lane not in lanes:
+                continue
+            if row.get('index'):
+                lane_samples.setdefault(lane, []).append(
+                    (row['Sample_ID'], row['index'].upper(),
+                     row.get('index2', '').upper()))
+        return(lane_samples)
+    def read_files(self, lane):
+        """Undetermined FASTQs of a lane, R1 first."""
+        fnames = []
+        for read in READ_NAMES:
+            fname = os.path.join(self.in_path, UNDETERMINED % (lane, read))
+            if os.path.exists(fname):
+                fnames.append((read, fname))
+        return(fnames)
+    def out_file(self, key, lane, read):
+        if key is None:
+            return(os.path.join(self.out_path, UNDETERMINED % (lane, read)))
+        number, name, project = self.samples[key]
+        return(os.path.join(self.out_path, project, key,
+                            '%s_S%d_L%03d_%s_001.fastq.gz' %
+                            (name, number, lane, read)))
+    def run_lane(self, pool, lane):
+        """Stream the lane through the pool; returns counts per sample."""
+        reads = self.read_files(lane)
+        if not reads:
+            print('Lane %d: no Undetermined FASTQ in %s' % (lane, self.in_path))
+            return({})
+        names = [read for read, fname in reads]
+        targets = {}
+        counts = {}
+        def write(members, chunk_counts):
+            for key, data in members.items():
+                if key not in targets:
+                    targets[key] = [self.out_file(key, lane, read)
+                                    for read in names]
+                    for fname in targets[key]:
+                        os.makedirs(os.path.dirname(fname), exist_ok=True)
+                        # outputs are appended to, start them empty
+                        open(fname, 'wb').close()
+                for fname, member in zip(targets[key], data):
+                    with open(fname, 'ab') as outfile:
+                        outfile.write(member)
+            for key, by_distance in chunk_counts.items():
+                total = counts.setdefault(key, {})
+                for distance, n in by_distance.items():
+                    total[distance] = total.get(distance, 0) + n
+        pending = []
+        def finish():
+            # write in submission order; concatenated gzip members are valid
+            write(*pending.pop(0).result())
+            self.in_flight.release()
+        chunks = zip(*[read_records(fname, self.chunk_reads)
+                       for read, fname in reads])
+        while True:
+            # while every permit is taken, write this lane's own results so
+            # that lanes waiting for each other cannot deadlock
+            while not self.in_flight.acquire(blocking=False):
+                if not pending:
+                    self.in_flight.acquire()
+                    break
+                finish()
+            chunk = next(chunks, None)
+            if chunk is None:
+                self.in_flight.release()
+                break
+            pending.append(pool.submit(assign_chunk, lane, chunk))
+        while pending:
+            finish()
+        return(counts)
+    def run(self, lanes=None):
+        """Re-demultiplex every lane; returns {lane: {Sample_ID: counts}}."""
+        lane_samples = self.lane_samples(lanes)
+        os.makedirs(self.out_path, exist_ok=True)
+        with ProcessPoolExecutor(self.processes, initializer=init_worker,
+                                 initargs=(lane_samples,
+                                           self.mismatches)) as pool:
+            # one reader thread per lane keeps the workers fed
+            with ThreadPoolExecutor(len(lane_samples) or 1) as readers:
+                futures = {lane: readers.submit(self.run_lane, pool, lane)
+                           for lane in sorted(lane_samples)}
+                return({lane: future.result()
+                        for lane, future in futures.items()})
+    def stats(self, results):
+        """Per lane results in the layout of bcl2fastq Stats.json."""
+        conversion = []
+        for lane, counts in sorted(results.items()):
+            demux = []
+            for key, (number, name, project) in self.samples.items():
+                if key not in counts:
+                    continue
+                by_distance = counts[key]
+                demux.append({'SampleId': key, 'SampleName': name,
+                              'NumberReads': sum(by_distance.values()),
+                              'IndexMetrics': [{'MismatchCounts': {
+                                  str(d): n for d, n in
+                                  sorted(by_distance.items())}}]})
+            undetermined = counts.get(None, {})
+            conversion.append({'LaneNumber': lane,
+                               'DemuxResults': demux,
+                               'Undetermined': {'NumberReads':
+                                                sum(undetermined.values())}})
+        return({'ConversionResults': conversion})
+
+def format_counts(results):
+    lines = []
+    for lane, counts in sorted(results.items()):
+        lines.append('Lane %d' % lane)
+        for key, by_distance in sorted(counts.items(),
+                                       key=lambda kv: (kv[0] is None,
+                                                       kv[0] or '')):
+            lines.append('  %-20s %12d' % (key or 'Undetermined',
+                                           sum(by_distance.values())))
+    return(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description='''Assign reads of bcl2fastq
+                    Undetermined FASTQs to the samples of a corrected sample
+                    sheet (standard runs).''')
+    parser.add_argument('-r', '--run_id', type=str,
+                        help='Run whose corrected sample sheet is written from GNomEx')
+    parser.add_argument('-s', '--sample_sheet', type=str,
+                        help='Corrected sample sheet to use instead of GNomEx')
+    parser.add_argument('-u', '--undetermined', required=True,
+                        help='bcl2fastq output directory holding Undetermined FASTQs')
+    parser.add_argument('-o', '--out_path', required=True,
+                        help='Directory for the re-demultiplexed FASTQs')
+    parser.add_argument('-l', '--lanes', nargs='*', type=int, metavar='lane')
+    parser.add_argument('-m', '--barcode-mismatches', type=parse_mismatches,
+                        default=(1, 1), dest='mismatches',
+                        help='Mismatches allowed per index, e.g. 1 or 1,0')
+    parser.add_argument('-p', '--processes', type=int,
+                        help='Worker processes (default: all cores)')
+    parser.add_argument('--chunk', type=int, default=CHUNK_READS,
+                        help='Reads sent to a worker at a time')
+    args = parser.parse_args()
+    if os.path.realpath(args.undetermined) == os.path.realpath(args.out_path):
+        parser.error('output directory must differ from the input directory')
+    os.makedirs(args.out_path, exist_ok=True)
+    if args.sample_sheet:
+        fname = args.sample_sheet
+    elif args.run_id:
+        from iemwriter import IEMWriter
+        iem = IEMWriter(args.run_id, args.out_path, args.lanes, refresh=True)
+        if not iem.write_sample_sheet(iem_header=False):
+            return(1)
+        fname = iem.file_path
+    else:
+        parser.error('either --run_id or --sample_sheet is required')
+    redemux = Redemultiplexer(read_sample_sheet(fname), args.undetermined,
+                              args.out_path, args.mismatches, args.processes,
+                              args.chunk)
+    results = redemux.run(args.lanes)
+    with open(os.path.join(args.out_path, 'Redemux_Stats.json'), 'w') as outfile:
+        json.dump(redemux.stats(results), outfile, indent=4)
+    for line in format_counts(results):
+        print(line)
+    return(0)
+
+if __name__ == "__main__":
+    sys.exit(main())
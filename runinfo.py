@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# runinfo.py - read structure, flowcell layout and instrument of a run folder
+# from RunInfo.xml and RunParameters.xml, parsed once and cached.
+
+import os
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+from functools import lru_cache
+
+Read = namedtuple('Read', ['number', 'cycles', 'is_index'])
+
+# instrument id prefixes, see the Illumina run folder naming conventions
+INSTRUMENT_PREFIXES = [('FS', 'iSeq'), ('MN', 'MiniSeq'), ('NB', 'NextSeq'),
+                       ('NS', 'NextSeq'), ('SN', 'HiSeq2500'),
+                       ('A', 'NovaSeq'), ('M', 'MiSeq'), ('K', 'HiSeq4000'),
+                       ('J', 'HiSeq3000'), ('E', 'HiSeqX'),
+                       ('D', 'HiSeq2500')]
+
+# RunParameters.xml fields kept by the parser
+RUN_PARAMETERS = ['InstrumentType', 'ApplicationName', 'ApplicationVersion',
+                  'RTAVersion', 'RtaVersion', 'SbsConsumableVersion',
+                  'ReagentKitVersion', 'WorkflowType']
+
+class RunDescriptor:
+    def __init__(self, run_folder):
+        self.run_folder = run_folder
+        self.run_id = None
+        self.flowcell = None
+        self.instrument_id = None
+        self.reads = []
+        self.lanes = None
+        # tiles per lane from the FlowcellLayout
+        self.tiles = None
+        # tile names (e.g. 1_1101) when RunInfo.xml lists them
+        self.tile_names = []
+        self.parameters = {}
+    def index_reads(self):
+        return([read for read in self.reads if read.is_index])
+    def data_reads(self):
+        return([read for read in self.reads if not read.is_index])
+    def instrument(self):
+        """Instrument model, from RunParameters.xml or the instrument id."""
+        if self.parameters.get('InstrumentType'):
+            return(self.parameters['InstrumentType'])
+        for prefix, name in INSTRUMENT_PREFIXES:
+            if self.instrument_id and self.instrument_id.startswith(prefix):
+                return(name)
+        return('unknown')
+    def use_bases_mask(self, demux_type, index_lengths=(), r1_length=28):
+        """
+        --use-bases-mask for the demultiplexing type. index_lengths holds
+        the longest index (and index2) in the sample sheet; r1_length is the
+        10x cell barcode/UMI read length (28 for 3' v3, 26 for 5' and VDJ).
+        """
+        lengths = list(index_lengths) + [0] * 2
+        masks = []
+        n_index = 0
+        n_data = 0
+        for read in self.reads:
+            if read.is_index:
+                length = lengths[n_index]
+                n_index += 1
+                if demux_type == 'patchpcr' and n_index == 2:
+                    # index2 carries the UMI
+                    masks.append('Y%d' % read.cycles)
+                elif demux_type == '10x-atac' and n_index == 2:
+                    # index2 carries the cell barcode
+                    masks.append('Y%d' % read.cycles)
+                elif demux_type in ['10x', '10x-long'] and n_index == 2:
+                    masks.append('n*')
+                else:
+                    masks.append(index_mask(length, read.cycles))
+            else:
+                n_data += 1
+                if demux_type == '10x' and n_data == 1:
+                    length = min(r1_length, read.cycles)
+                    masks.append('Y%d' % length + trailing(read.cycles - length))
+                elif demux_type in ['10x-atac', 'standard']:
+                    # standard runs keep every cycle, as without a mask
+                    masks.append('Y%d' % read.cycles)
+                else:
+                    # the last cycle is generally of lower quality
+                    masks.append('Y%dn' % (read.cycles - 1))
+        return(','.join(masks))
+
+def trailing(cycles):
+    return('n*' if cycles > 0 else '')
+
+def index_mask(length, cycles):
+    if length <= 0:
+        return('n*')
+    length = min(length, cycles)
+    return('I%d' % length + 'n' * (cycles - length))
+
+def parse_run_info(fname, run):
+    for event, elem in ET.iterparse(fname, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == 'Run':
+                run.run_id = elem.get('Id')
+            continue
+        if elem.tag == 'Read':
+            run.reads.append(Read(int(elem.get('Number')),
+                                  int(elem.get('NumCycles')),
+                                  elem.get('IsIndexedRead') == 'Y'))
+        elif elem.tag == 'Flowcell':
+            run.flowcell = elem.text
+        elif elem.tag == 'Instrument':
+            run.instrument_id = elem.text
+        elif elem.tag == 'FlowcellLayout':
+            run.lanes = int(elem.get('LaneCount', 1))
+            run.tiles = 1
+            for key in ['SurfaceCount', 'SwathCount', 'TileCount']:
+                run.tiles *= int(elem.get(key, 1))
+        elif elem.tag == 'Tile':
+            run.tile_names.append(elem.text)
+        # elements are not needed once read, keeps big Tiles lists cheap
+        if elem.tag != 'Run':
+            elem.clear()
+    run.reads.sort(key=lambda read: read.number)
+
+def parse_run_parameters(fname, run):
+    for event, elem in ET.iterparse(fname):
+        if elem.tag in RUN_PARAMETERS and elem.tag not in run.parameters:
+            run.parameters[elem.tag] = (elem.text or '').strip()
+        elem.clear()
+
+@lru_cache(maxsize=64)
+def _load(run_folder, info_mtime, parameters_file, parameters_mtime):
+    run = RunDescriptor(run_folder)
+    parse_run_info(os.path.join(run_folder, 'RunInfo.xml'), run)
+    if parameters_file:
+        parse_run_parameters(parameters_file, run)
+    return(run)
+
+def load_run(run_folder):
+    """
+    RunDescriptor of a run folder, or None without RunInfo.xml. Parsed
+    results are reused until the files change.
+    """
+    info = os.path.join(run_folder, 'RunInfo.xml')
+    if not os.path.exists(info):
+        return(None)
+    parameters_file = None
+    parameters_mtime = None
+    # MiSeq and HiSeq name it runParameters.xml
+    for name in ['RunParameters.xml', 'runParameters.xml']:
+        fname = os.path.join(run_folder, name)
+        if os.path.exists(fname):
+            parameters_file = fname
+            parameters_mtime = os.path.getmtime(fname)
+            break
+    return(_load(run_folder, os.path.getmtime(info), parameters_file,
+                 parameters_mtime))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# runrecords.py - fetch the GNomEx sample records of sequencing runs, shared
+# by the sample sheet writer and the run preview.
+
+from collections import namedtuple
+import gnomex
+
+# Field order follows the columns of RECORD_QUERY; the run id must stay last
+# as gnomex.fetch_by_run groups rows on the last column. applications is not
+# a column, it holds every application of the sample (see unique_records).
+RunRecord = namedtuple('RunRecord', ['flowcell', 'lane', 'sample_id',
+                                     'genome_build', 'index', 'first_name',
+                                     'last_name', 'project', 'index2',
+                                     'application', 'run_id', 'applications'],
+                       defaults=[()])
+
+RECORD_QUERY = """select flowcell.barcode,
+        flowcellchannel.number,
+        sample.number,
+        genomebuild.genomebuildname,
+        sample.barcodesequence,
+        appuser.firstname,
+        appuser.lastname,
+        request.number,
+        sample.barcodesequenceb,
+        application.application,
+        flowcellchannel.filename
+        from flowcell
+        join flowcellchannel on flowcellchannel.idflowcell=flowcell.idflowcell
+        join sequencelane on sequencelane.idflowcellchannel =
+        flowcellchannel.idflowcellchannel
+        join sample on sequencelane.idsample = sample.idsample
+        left outer join genomebuild on sequencelane.idgenomebuildalignto =
+        genomebuild.idgenomebuild
+        join request on sequencelane.idrequest = request.idrequest
+        join appuser on request.idappuser = appuser.idappuser
+        left outer join seqlibprotocolapplication on
+        seqlibprotocolapplication.idseqlibprotocol = sample.idseqlibprotocol
+        left outer join application on
+        application.codeapplication = seqlibprotocolapplication.codeapplication
+        where flowcellchannel.filename in (%s)
+        order by flowcellchannel.filename, flowcellchannel.number,
+        sample.number, application.application"""
+
+def build_query(run_ids):
+    """Parameterized record query for the given runs."""
+    placeholders = ','.join(['?'] * len(run_ids))
+    return((RECORD_QUERY % placeholders, list(run_ids)))
+
+def unique_records(rows):
+    """
+    One typed record per sample and lane. A sample whose protocol maps to
+    several applications is repeated in the rows; its record keeps the
+    first as application and all of them, in order, as applications.
+    """
+    rec = None
+    applications = []
+    for row in rows:
+        current = RunRecord(*row)
+        if rec is None or (current.run_id, current.lane, current.sample_id) \
+           != (rec.run_id, rec.lane, rec.sample_id):
+            if rec is not None:
+                yield rec._replace(applications=tuple(applications))
+            rec = current
+            applications = []
+        if current.application is not None and \
+           current.application not in applications:
+            applications.append(current.application)
+    if rec is not None:
+        yield rec._replace(applications=tuple(applications))
+
+def fetch_run_records(run_ids, lanes=None, refresh=False):
+    """
+    Records of several runs fetched in one round trip, ordered by lane and
+    sample. Returns a dict of run id to a list of RunRecord; runs without
+    records map to an empty list. All lanes of a run are fetched and
+    cached, lanes only filters what is returned. Cached results are used
+    unless refresh is set.
+    """
+    rows = gnomex.fetch_by_run('runrecords', run_ids, build_query,
+                               refresh=refresh)
+    records = {}
+    for run_id in run_ids:
+        recs = unique_records(rows.get(run_id, []))
+        if lanes:
+            recs = (rec for rec in recs if rec.lane in lanes)
+        records[run_id] = list(recs)
+    return(records)
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# samplesheet.py - read and write the sample sheets produced by IEMWriter,
+# with or without the IEM [Header]/[Settings] preamble.
+
+import csv
+
+class SampleSheet:
+    def __init__(self, preamble, columns, rows):
+        # lines up to and including '[Data]', empty without an IEM header
+        self.preamble = preamble
+        self.columns = columns
+        # one dict per sample, keyed by column name
+        self.rows = rows
+    def lanes(self):
+        """Lanes in order of first appearance."""
+        return(list(dict.fromkeys(int(row['Lane']) for row in self.rows
+                                  if row.get('Lane'))))
+    def subset(self, rows):
+        """A sheet with the same preamble and columns holding rows."""
+        return(SampleSheet(list(self.preamble), list(self.columns),
+                           list(rows)))
+    def lane_rows(self, lanes):
+        return([row for row in self.rows if int(row['Lane']) in lanes])
+
+def read_sample_sheet(fname):
+    preamble = []
+    with open(fname, newline='') as infile:
+        lines = infile.read().splitlines()
+    start = 0
+    if lines and lines[0].startswith('['):
+        for i, line in enumerate(lines):
+            if line.strip().rstrip(',') == '[Data]':
+                start = i + 1
+                break
+        preamble = lines[:start]
+    reader = csv.reader(line for line in lines[start:] if line.strip())
+    columns = next(reader, [])
+    rows = [dict(zip(columns, values)) for values in reader]
+    return(SampleSheet(preamble, columns, rows))
+
+def write_sample_sheet(sheet, fname):
+    with open(fname, 'w', newline='') as outfile:
+        for line in sheet.preamble:
+            outfile.write(line + '\n')
+        writer = csv.writer(outfile, lineterminator='\n')
+        writer.writerow(sheet.columns)
+        for row in sheet.rows:
+            writer.writerow([row.get(col, '') for col in sheet.columns])
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# scheduler.py - persistent queue of demultiplexing jobs run by a local daemon
+# within a budget of CPU threads and concurrent I/O heavy stages.
+
+import argparse
+import os
+import re
+import signal
+import sqlite3
+import subprocess
+import sys
+import time
+from logger import Logger
+import pipelineparams as params
+
+DEFAULT_DB = os.path.join(os.path.expanduser('~'), '.cache', 'alademux',
+                          'scheduler.sqlite')
+# stages of a run in order, each running `demuxer.sh <stage>` once the
+# previous one succeeded
+STAGES = ['demux', 'transfer', 'notify']
+# I/O slots taken by a stage, demux and transfer contend for the same disks
+STAGE_IO = {'demux': 1, 'transfer': 1, 'notify': 0}
+# threads of the other stages; demux takes the loading, processing and
+# writing threads of its thread plan, or the whole budget (None) without one
+STAGE_THREADS = {'transfer': 1, 'notify': 0}
+THREAD_PLAN = re.compile(r'^# Thread plan: -r (\d+) -p (\d+) -w (\d+)')
+# states of a job no longer waiting or running
+FINISHED = ['done', 'failed', 'cancelled']
+# exit status of a stage, written by its wrapper in the run's folder so a
+# restarted daemon can tell how a stage it did not start ended
+STATUS_FILE = 'scheduler_job%d.status'
+
+def db_path():
+    return(os.environ.get('ALADEMUX_SCHEDULER_DB',
+                          getattr(params, 'scheduler_db', DEFAULT_DB)))
+
+def connect(fname=None):
+    fname = fname or db_path()
+    dirname = os.path.dirname(fname)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    # the daemon and submitters share the file, waits out their writes
+    db = sqlite3.connect(fname, timeout=60)
+    db.row_factory = sqlite3.Row
+    db.execute("""create table if not exists jobs (
+        id integer primary key autoincrement,
+        run_id text not null,
+        out_path text not null,
+        stage text not null,
+        depends_on integer,
+        priority integer not null default 0,
+        threads integer,
+        io integer not null default 0,
+        state text not null default 'queued',
+        pid integer,
+        returncode integer,
+        submitted real not null,
+        started real,
+        finished real)""")
+    db.commit()
+    return(db)
+
+def cpu_budget():
+    return(getattr(params, 'scheduler_threads', None) or os.cpu_count() or 1)
+
+def io_budget():
+    return(getattr(params, 'scheduler_io_jobs', 2))
+
+def script_threads(out_path):
+    """bcl2fastq threads of all pools of a demuxer.sh thread plan, or None."""
+    fname = os.path.join(out_path, 'demuxer.sh')
+    if not os.path.exists(fname):
+        return(None)
+    with open(fname) as infile:
+        for line in infile:
+            match = THREAD_PLAN.match(line)
+            if match:
+                return(sum(int(n) for n in match.groups()))
+    return(None)
+
+def submit_run(run_id, out_path, demux_threads=None, priority=0, db=None):
+    """
+    Queue the stages of a set-up run; each stage waits for the previous
+    one. Returns the job ids in stage order.
+    """
+    db = db or connect()
+    ids = []
+    previous = None
+    now = time.time()
+    with db:
+        for stage in STAGES:
+            threads = demux_threads if stage == 'demux' \
+                else STAGE_THREADS[stage]
+            cursor = db.execute(
+                """insert into jobs (run_id, out_path, stage, depends_on,
+                priority, threads, io, submitted) values (?,?,?,?,?,?,?,?)""",
+                (run_id, os.path.abspath(out_path), stage, previous,
+                 priority, threads, STAGE_IO[stage], now))
+            previous = cursor.lastrowid
+            ids.append(previous)
+    return(ids)
+
+def set_priority(db, run_id, priority):
+    """Change the priority of the queued jobs of a run; returns their count."""
+    with db:
+        return(db.execute("""update jobs set priority = ? where run_id = ?
+                          and state = 'queued'""",
+                          (priority, run_id)).rowcount)
+
+def cancel_run(db, run_id):
+    """Cancel the queued jobs of a run; running stages finish."""
+    with db:
+        return(db.execute("""update jobs set state = 'cancelled', finished = ?
+                          where run_id = ? and state = 'queued'""",
+                          (time.time(), run_id)).rowcount)
+
+def read_status(out_path, job_id):
+    """Exit status a stage's wrapper recorded, None if it wrote none."""
+    fname = os.path.join(out_path, STATUS_FILE % job_id)
+    try:
+        with open(fname) as infile:
+            return(int(infile.read().strip()))
+    except (OSError, ValueError):
+        return(None)
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return(False)
+    except PermissionError:
+        pass
+    return(True)
+
+class Scheduler(Logger):
+    def __init__(self, db, threads, io):
+        self.db = db
+        self.threads = threads
+        self.io = io
+        # job id: Popen of the stages started by this daemon
+        self.procs = {}
+        self.stopping = False
+    def demand(self, job):
+        """Threads of a job, at most the whole budget so it can run alone."""
+        if job['threads'] is None:
+            return(self.threads)
+        return(min(job['threads'], self.threads))
+    def finish(self, job_id, state, returncode=None):
+        with self.db:
+            self.db.execute("""update jobs set state = ?, returncode = ?,
+                            finished = ? where id = ?""",
+                            (state, returncode, time.time(), job_id))
+    def reap(self):
+        """Record the stages that ended since the last pass."""
+        for job_id, proc in list(self.procs.items()):
+            returncode = proc.poll()
+            if returncode is None:
+                continue
+            del self.procs[job_id]
+            self.finish(job_id, 'done' if returncode == 0 else 'failed',
+                        returncode)
+            job = self.db.execute('select * from jobs where id = ?',
+                                  (job_id,)).fetchone()
+            self.Log('%s %s finished with status %d' %
+                     (job['run_id'], job['stage'], returncode))
+        # stages left running by an earlier daemon are followed by pid,
+        # and their status read back from the wrapper's status file
+        for job in self.db.execute("""select * from jobs where
+                                   state = 'running'""").fetchall():
+            if job['id'] in self.procs or pid_alive(job['pid']):
+                continue
+            returncode = read_status(job['out_path'], job['id'])
+            if returncode is None:
+                self.Log('%s %s ended while the scheduler was down, status '
+                         'unknown' % (job['run_id'], job['stage']))
+                self.finish(job['id'], 'failed')
+            else:
+                self.Log('%s %s finished with status %d while the scheduler '
+                         'was down' % (job['run_id'], job['stage'],
+                                       returncode))
+                self.finish(job['id'], 'done' if returncode == 0
+                            else 'failed', returncode)
+        # stages whose previous stage failed will never run
+        with self.db:
+            self.db.execute("""update jobs set state = 'cancelled',
+                            finished = ? where state = 'queued' and
+                            depends_on in (select id from jobs where
+                            state in ('failed', 'cancelled'))""",
+                            (time.time(),))
+    def start(self, job):
+        log = open(os.path.join(job['out_path'], 'nohup.out'), 'ab')
+        status = STATUS_FILE % job['id']
+        wrapper = ('./demuxer.sh %s; rc=$?; echo $rc > %s.tmp; '
+                   'mv %s.tmp %s; exit $rc' % (job['stage'], status, status,
+                                               status))
+        try:
+            # own session, so stopping the daemon leaves the stage running
+            proc = subprocess.Popen(['sh', '-c', wrapper],
+                                    cwd=job['out_path'], stdout=log,
+                                    stderr=subprocess.STDOUT,
+                                    start_new_session=True)
+        except OSError as err:
+            self.Log('Cannot start %s %s: %s' % (job['run_id'], job['stage'],
+                                                 err))
+            self.finish(job['id'], 'failed')
+            return
+        finally:
+            log.close()
+        self.procs[job['id']] = proc
+        with self.db:
+            self.db.execute("""update jobs set state = 'running', pid = ?,
+                            started = ? where id = ?""",
+                            (proc.pid, time.time(), job['id']))
+        self.Log('Started %s %s (%s threads) in %s' %
+                 (job['run_id'], job['stage'], self.demand(job),
+                  job['out_path']))
+    def dispatch(self):
+        """
+        Start queued jobs whose previous stage is done, highest priority
+        first, while they fit the budgets. A job that does not fit keeps
+        its share reserved, so smaller jobs behind it cannot starve it.
+        """
+        running = self.db.execute("""select * from jobs where
+                                  state = 'running'""").fetchall()
+        free_threads = max(0, self.threads -
+                           sum(self.demand(job) for job in running))
+        free_io = max(0, self.io - sum(job['io'] for job in running))
+        ready = self.db.execute("""select j.* from jobs j left join jobs d
+                                on j.depends_on = d.id
+                                where j.state = 'queued' and
+                                (j.depends_on is null or d.state = 'done')
+                                order by j.priority desc, j.submitted, j.id
+                                """).fetchall()
+        for job in ready:
+            threads = self.demand(job)
+            if threads <= free_threads and job['io'] <= free_io:
+                self.start(job)
+            # zero-thread jobs (notify) still start behind a reservation
+            free_threads = max(0, free_threads - threads)
+            free_io = max(0, free_io - job['io'])
+    def stop(self, signum, frame):
+        self.stopping = True
+    def run(self, poll):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.Log('Scheduling with %d threads and %d I/O slots' %
+                 (self.threads, self.io))
+        while not self.stopping:
+            self.reap()
+            self.dispatch()
+            time.sleep(poll)
+        self.Log('Stopping, %d running stages continue' % len(self.procs))
+
+def format_status(db, show_all=False):
+    """Lines of the status table, unfinished jobs only unless show_all."""
+    query = 'select * from jobs'
+    if not show_all:
+        query += ' where state not in (%s)' % ','.join('?' * len(FINISHED))
+    jobs = db.execute(query + ' order by id',
+                      [] if show_all else FINISHED).fetchall()
+    running = [job for job in jobs if job['state'] == 'running']
+    lines = ['%d running, %d queued; budget %d threads, %d I/O slots' %
+             (len(running), sum(job['state'] == 'queued' for job in jobs),
+              cpu_budget(), io_budget()),
+             '%-5s %-32s %-9s %-9s %4s %7s %8s  %s' %
+             ('id', 'run', 'stage', 'state', 'prio', 'threads', 'elapsed',
+              'output')]
+    now = time.time()
+    for job in jobs:
+        elapsed = ''
+        if job['started']:
+            seconds = (job['finished'] or now) - job['started']
+            elapsed = '%d:%02d' % (seconds // 3600, seconds % 3600 // 60)
+        threads = 'all' if job['threads'] is None else str(job['threads'])
+        lines.append('%-5d %-32s %-9s %-9s %4d %7s %8s  %s' %
+                     (job['id'], job['run_id'], job['stage'], job['state'],
+                      job['priority'], threads, elapsed, job['out_path']))
+    return(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description='''Queue and run the
+                        demuxer.sh stages of set-up runs within CPU and I/O
+                        budgets.''')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+    daemon = sub.add_parser('daemon', help='Run queued jobs')
+    daemon.add_argument('--threads', type=int, default=cpu_budget(),
+                        help='CPU threads shared by the running stages')
+    daemon.add_argument('--io', type=int, default=io_budget(),
+                        help='Demux and transfer stages run at once')
+    daemon.add_argument('--poll', type=float, default=10,
+                        help='Seconds between scheduling passes')
+    submit = sub.add_parser('submit', help='Queue a set-up run')
+    submit.add_argument('out_path', help='Folder holding demuxer.sh')
+    submit.add_argument('--run', help='Run id (default: from the path)')
+    submit.add_argument('-p', '--priority', type=int, default=0,
+                        help='Higher priorities start first')
+    status = sub.add_parser('status', help='List queued and running jobs')
+    status.add_argument('-a', '--all', action='store_true',
+                        help='Include finished jobs')
+    prio = sub.add_parser('priority', help='Reprioritise the queued jobs '
+                          'of a run')
+    prio.add_argument('run')
+    prio.add_argument('priority', type=int)
+    cancel = sub.add_parser('cancel', help='Cancel the queued jobs of a run')
+    cancel.add_argument('run')
+    args = parser.parse_args()
+    db = connect()
+    if args.command == 'daemon':
+        Scheduler(db, max(1, args.threads), max(1, args.io)).run(args.poll)
+    elif args.command == 'submit':
+        out_path = os.path.abspath(args.out_path)
+        if not os.path.exists(os.path.join(out_path, 'demuxer.sh')):
+            print('No demuxer.sh in %s' % out_path)
+            return(1)
+        # out_path is <demux_result_path>/<run>/<date>
+        run_id = args.run or os.path.basename(os.path.dirname(out_path))
+        ids = submit_run(run_id, out_path, script_threads(out_path),
+                         args.priority, db)
+        print('Queued %s as jobs %s' % (run_id, ', '.join(map(str, ids))))
+    elif args.command == 'status':
+        for line in format_status(db, args.all):
+            print(line)
+    elif args.command == 'priority':
+        print('%d jobs reprioritised' % set_priority(db, args.run,
+                                                     args.priority))
+    elif args.command == 'cancel':
+        print('%d jobs cancelled' % cancel_run(db, args.run))
+    return(0)
+
+if __name__ == "__main__":
+    sys.exit(main())
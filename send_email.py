@@ -1,42 +1,255 @@
 import os
 import sys
+import glob
+import gzip
+import json
 import smtplib
 import string
 import argparse
+import tempfile
+import time
 import pipelineparams as params
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
 
+SMTP_HOST = getattr(params, 'smtp_host', 'hci-mail.hci.utah.edu')
+# attachments larger than this are gzipped while read
+COMPRESS_OVER = 1024**2
+# attachments still larger than this after compression are left out
+MAX_ATTACHMENT = getattr(params, 'max_attachment_bytes', 10 * 1024**2)
+# notifications held for a digest, one JSON file each
+HOLD_PATH = getattr(params, 'mail_hold_path',
+                    os.path.join(os.path.expanduser('~'), '.cache', 'alademux',
+                                 'mail_hold'))
+READ_SIZE = 1024**2
+
+class Notification:
+  """A message waiting to be sent; attachments are read when it is sent."""
+
+  def __init__( self, from_addr, to_addr, subject, message, attachments=[],
+                msgtype="plain" ):
+    self.from_addr = from_addr
+    self.to_addr = list(to_addr)
+    self.subject = subject
+    self.message = message
+    self.attachments = list(attachments)
+    self.msgtype = msgtype
+
+  def to_dict( self ):
+    return dict(self.__dict__)
+
+  @classmethod
+  def from_dict( cls, d ):
+    return cls(d['from_addr'], d['to_addr'], d['subject'], d['message'],
+               d.get('attachments', []), d.get('msgtype', 'plain'))
+
+def read_attachment( fname, max_bytes=MAX_ATTACHMENT ):
+  """
+  (name, data) of an attachment. Files over COMPRESS_OVER are gzipped as
+  they are read, so only the compressed data is held. Returns (name, None)
+  if the result still exceeds max_bytes.
+  """
+  name = os.path.basename(fname)
+  size = os.path.getsize(fname)
+  if size <= COMPRESS_OVER or fname.endswith('.gz'):
+    if size > max_bytes:
+      return name, None
+    with open(fname, "rb") as fp:
+      return name, fp.read()
+  with tempfile.SpooledTemporaryFile(max_size=max_bytes) as spool:
+    with open(fname, "rb") as fp:
+      with gzip.GzipFile(filename=name, mode='wb', fileobj=spool) as gz:
+        while True:
+          block = fp.read(READ_SIZE)
+          if not block:
+            break
+          gz.write(block)
+          if spool.tell() > max_bytes:
+            return name + '.gz', None
+    if spool.tell() > max_bytes:
+      return name + '.gz', None
+    spool.seek(0)
+    return name + '.gz', spool.read()
+
+def build_msg( note, max_bytes=MAX_ATTACHMENT ):
+  msg = MIMEMultipart()
+  msg['Subject'] = note.subject
+  msg['From'] = note.from_addr
+  msg['To'] = ', '.join(note.to_addr)
+  message = note.message
+  parts = []
+  for f in note.attachments:
+    name, data = read_attachment(f, max_bytes)
+    if data is None:
+      message += "\n\n%s was not attached, it exceeds %.0f MB." % (
+        name, max_bytes / 1024.0**2)
+      continue
+    parts.append(MIMEApplication(data,
+      Content_Disposition='attachment; filename="%s"' % name,
+      Name=name))
+  msg.attach(MIMEText(message, note.msgtype))
+  for part in parts:
+    msg.attach(part)
+  return msg
+
+def digest( notes ):
+  """One notification combining several with the same sender and recipients."""
+  if len(notes) == 1:
+    return notes[0]
+  subject = "[Demux digest] %d notifications" % len(notes)
+  sections = []
+  attachments = []
+  for note in notes:
+    sections.append("== %s ==\n%s" % (note.subject, note.message))
+    attachments.extend(note.attachments)
+  return Notification(notes[0].from_addr, notes[0].to_addr, subject,
+                      "\n\n".join(sections), attachments, notes[0].msgtype)
+
+class SMTPTransport:
+  """Sends messages over one SMTP session, reconnecting if it drops."""
+
+  def __init__( self, host=SMTP_HOST, port=0 ):
+    self.host = host
+    self.port = port
+    self.smtp = None
+
+  def __enter__( self ):
+    return self
+
+  def __exit__( self, *exc ):
+    self.close()
+
+  def send( self, msg, from_addr, to_addr ):
+    for attempt in range(2):
+      if self.smtp is None:
+        self.smtp = smtplib.SMTP(self.host, self.port)
+      try:
+        return self.smtp.sendmail(from_addr, to_addr, msg.as_string())
+      except smtplib.SMTPServerDisconnected:
+        self.smtp = None
+        if attempt:
+          raise
+
+  def close( self ):
+    if self.smtp is not None:
+      try:
+        self.smtp.quit()
+      except smtplib.SMTPException:
+        pass
+      self.smtp = None
+
+class FileSpool:
+  """Writes messages as .eml files instead of sending them, for testing."""
+
+  def __init__( self, path ):
+    self.path = path
+    os.makedirs(path, exist_ok=True)
+
+  def __enter__( self ):
+    return self
+
+  def __exit__( self, *exc ):
+    pass
+
+  def send( self, msg, from_addr, to_addr ):
+    fname = os.path.join(self.path, '%s_%d.eml' % (
+      time.strftime('%Y%m%d-%H%M%S'), len(os.listdir(self.path))))
+    with open(fname, 'w') as outfile:
+      outfile.write(msg.as_string())
+    return {}
+
+def get_transport():
+  """
+  File spool if ALADEMUX_MAIL_SPOOL or params.mail_spool names a directory,
+  else SMTP on ALADEMUX_SMTP (host[:port], e.g. a local debugging server)
+  or params.smtp_host.
+  """
+  spool = os.environ.get('ALADEMUX_MAIL_SPOOL',
+                         getattr(params, 'mail_spool', None))
+  if spool:
+    return FileSpool(spool)
+  host = os.environ.get('ALADEMUX_SMTP', SMTP_HOST)
+  port = 0
+  if ':' in host:
+    host, port = host.rsplit(':', 1)
+  return SMTPTransport(host, int(port))
+
+class NotificationQueue:
+  """Collects notifications and sends them over a single transport session."""
+
+  def __init__( self, transport=None ):
+    self.transport = transport
+    self.notes = []
+
+  def add( self, note ):
+    self.notes.append(note)
+
+  def flush( self, as_digest=False ):
+    """Send queued notifications, combined per recipient list if as_digest."""
+    notes, self.notes = self.notes, []
+    if as_digest:
+      groups = {}
+      for note in notes:
+        groups.setdefault((note.from_addr, tuple(note.to_addr)), []).append(note)
+      notes = [digest(group) for group in groups.values()]
+    results = []
+    transport = self.transport or get_transport()
+    with transport:
+      for note in notes:
+        results.append(transport.send(build_msg(note), note.from_addr,
+                                      note.to_addr))
+    return results
+
+def hold( note, path=HOLD_PATH ):
+  """Keep a notification on disk until flush_held() sends the digest."""
+  os.makedirs(path, exist_ok=True)
+  fd, tmp = tempfile.mkstemp(dir=path, suffix='.tmp')
+  with os.fdopen(fd, 'w') as outfile:
+    json.dump(note.to_dict(), outfile)
+  os.replace(tmp, tmp[:-len('.tmp')] + '.json')
+
+def flush_held( path=HOLD_PATH, transport=None ):
+  """Send every held notification as one digest per recipient list."""
+  fnames = sorted(glob.glob(os.path.join(path, '*.json')),
+                  key=os.path.getmtime)
+  if not fnames:
+    return []
+  queue = NotificationQueue(transport)
+  for fname in fnames:
+    with open(fname) as infile:
+      queue.add(Notification.from_dict(json.load(infile)))
+  results = queue.flush(as_digest=True)
+  for fname in fnames:
+    os.remove(fname)
+  return results
+
 class Emailer:
   """Base class for objects that need to email stuff."""
 
   def send_msg( self, from_addr, to_addr, subject, message, attachments=[], msgtype="plain" ):
-    msg = MIMEMultipart()
-    msg['Subject'] = subject
-    msg['From'] = from_addr
-    msg['To'] = ', '.join(to_addr)
-    msg.attach(MIMEText(message))
-
-    for f in attachments:
-      fp=open(f,"rb")
-      msg.attach(MIMEApplication(fp.read(),
-        Content_Disposition='attachment; filename="%s"' % os.path.basename(f),
-        Name=os.path.basename(f)))
-
-    s = smtplib.SMTP('hci-mail.hci.utah.edu')
-    # Send the message.
-    retval = s.sendmail( from_addr, to_addr, msg.as_string() )
-    s.quit()
-    return retval
+    queue = NotificationQueue()
+    queue.add(Notification(from_addr, to_addr, subject, message, attachments,
+                           msgtype))
+    return queue.flush()[0]
 
 # Example of use:
 def main():
   parser = argparse.ArgumentParser()
-  parser.add_argument("runid", help="Illumina run ID",
+  parser.add_argument("runid", help="Illumina run ID", nargs='?',
       type=str)
   parser.add_argument('attachments', nargs='*', type=str)
+  parser.add_argument('--hold', action='store_true',
+      default=bool(os.environ.get('ALADEMUX_MAIL_HOLD')),
+      help="Hold the message for a digest instead of sending it.")
+  parser.add_argument('--flush', action='store_true',
+      help="Send held messages as a digest.")
   args = parser.parse_args()
+  if args.flush:
+    flush_held()
+    return
+  if not args.runid:
+    parser.error("runid is required unless --flush is given")
   flowcell = args.runid
   attachments = args.attachments
   for file in attachments:
@@ -46,10 +259,15 @@ def main():
   from_addr = params.from_addr
   subject = "[Demux complete] %s" % flowcell
   message = "Demultiplexed output was copied to GNomEx."
-  to_addr = params.to_addr 
+  to_addr = params.to_addr
   unsubscribe = 'If you no longer wish to receive this automated email message'
   unsubscribe+= ' please email ' + params.unsubscribe_addr
-  message = message +  "\n\n" + unsubscribe 
+  message = message +  "\n\n" + unsubscribe
+  if args.hold:
+    # held attachments are read at flush time, keep absolute paths
+    hold(Notification(from_addr, to_addr, subject, message,
+                      [os.path.abspath(f) for f in attachments]))
+    return
   Emailer().send_msg( from_addr, to_addr, subject, message, attachments )
 
 if __name__ == "__main__":
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# shardmerge.py - merge the outputs of bcl2fastq jobs that each processed a
+# subset of lanes into a single demultiplexing output directory.
+
+import argparse
+import json
+import os
+import re
+import shutil
+import xml.etree.ElementTree as ET
+from samplesheet import read_sample_sheet
+
+# per-lane lists in Stats.json and the key holding their lane number
+STATS_LANE_LISTS = {'ReadInfosForLanes': 'LaneNumber',
+                    'ConversionResults': 'LaneNumber',
+                    'UnknownBarcodes': 'Lane'}
+# sample number in bcl2fastq output names, e.g. S1_S1_L002_R1_001.fastq.gz
+SAMPLE_NUMBER = re.compile(r'^(.+)_S(\d+)((?:_L\d{3})?_[RI]\d_\d{3}\.fastq\.gz)$')
+
+def merge_stats_json(fnames, out_file, lanes=None):
+    """
+    Combine Stats.json files of jobs over disjoint lanes, or of index
+    geometry passes over the same lanes. Run level fields come from the
+    first file; per-lane entries are sorted by lane, and entries of a lane
+    found in several files are combined. If lanes is given, only those
+    lanes are kept from each file.
+    """
+    merged = None
+    for fname in fnames:
+        with open(fname) as infile:
+            stats = json.load(infile)
+        if merged is None:
+            merged = {k: v for k, v in stats.items()
+                      if k not in STATS_LANE_LISTS}
+            for key in STATS_LANE_LISTS:
+                merged[key] = {}
+        for key, lane_key in STATS_LANE_LISTS.items():
+            for entry in stats.get(key, []):
+                if lanes is None or entry[lane_key] in lanes:
+                    merged[key].setdefault(entry[lane_key], []).append(entry)
+    if merged is None:
+        return(None)
+    # unknown barcodes of a pass include the samples of the other passes
+    assigned = {lane: [index['IndexSequence'].split('+')
+                       for entry in entries
+                       for result in entry.get('DemuxResults', [])
+                       for index in result.get('IndexMetrics', [])]
+                for lane, entries in merged['ConversionResults'].items()}
+    for key in STATS_LANE_LISTS:
+        merged[key] = [combine_lane(key, merged[key][lane],
+                                    assigned.get(lane, []))
+                       for lane in sorted(merged[key])]
+    with open(out_file, 'w') as outfile:
+        json.dump(merged, outfile, indent=4)
+    return(merged)
+
+def combine_lane(key, entries, assigned):
+    """
+    One Stats.json entry of a lane from the entries of several passes.
+    Unknown barcodes matching assigned, the indexes of the lane's samples,
+    are dropped.
+    """
+    if len(entries) == 1 or key == 'ReadInfosForLanes':
+        return(entries[0])
+    if key == 'ConversionResults':
+        return(combine_conversion(entries))
+    combined = dict(entries[0], Barcodes={})
+    for entry in entries:
+        for barcode, count in entry.get('Barcodes', {}).items():
+            if not any(covers(index, barcode.split('+'))
+                       for index in assigned):
+                combined['Barcodes'][barcode] = max(
+                    count, combined['Barcodes'].get(barcode, 0))
+    return(combined)
+
+def covers(index, barcode):
+    """True if each part of barcode and index is a prefix of the other."""
+    return(all(a.startswith(b) or b.startswith(a)
+               for a, b in zip(index, barcode)))
+
+def combine_conversion(entries):
+    """
+    Lane results of index geometry passes: the samples of every pass, and
+    as undetermined the clusters no pass assigned. Lane totals, and the
+    per read totals undetermined reads are derived from, come from the
+    first pass.
+    """
+    first = entries[0]
+    combined = dict(first)
+    combined['DemuxResults'] = [result for entry in entries
+                                for result in entry.get('DemuxResults', [])]
+    totals = {}
+    for result in first.get('DemuxResults', []) + \
+            [first.get('Undetermined') or {}]:
+        add_read_metrics(totals, result.get('ReadMetrics', []), 1)
+    assigned = 0
+    for result in combined['DemuxResults']:
+        assigned += result.get('NumberReads', 0)
+        add_read_metrics(totals, result.get('ReadMetrics', []), -1)
+    read_metrics = []
+    for number, metrics in sorted(totals.items()):
+        read_metrics.append({name: max(0, value)
+                             for name, value in metrics.items()})
+        read_metrics[-1]['ReadNumber'] = number
+    combined['Undetermined'] = {
+        'NumberReads': max(0, first.get('TotalClustersPF', 0) - assigned),
+        'Yield': sum(metrics.get('Yield', 0) for metrics in read_metrics),
+        'ReadMetrics': read_metrics}
+    return(combined)
+
+def add_read_metrics(totals, read_metrics, sign):
+    for metrics in read_metrics:
+        entry = totals.setdefault(metrics['ReadNumber'], {})
+        for name, value in metrics.items():
+            if name != 'ReadNumber':
+                entry[name] = entry.get(name, 0) + sign * value
+
+def merge_elements(dest, src):
+    """
+    Recursively add children of src missing from dest, matched by tag and
+    attributes. Leaf values already present in dest are kept.
+    """
+    for child in src:
+        match = None
+        for candidate in dest.findall(child.tag):
+            if candidate.attrib == child.attrib:
+                match = candidate
+                break
+        if match is None:
+            dest.append(child)
+        elif len(child):
+            merge_elements(match, child)
+
+def merge_stats_xml(fnames, out_file):
+    """Combine ConversionStats.xml or DemultiplexingStats.xml of lane shards."""
+    tree = None
+    for fname in fnames:
+        if tree is None:
+            tree = ET.parse(fname)
+        else:
+            merge_elements(tree.getroot(), ET.parse(fname).getroot())
+    if tree is not None:
+        tree.write(out_file, xml_declaration=True, encoding='utf-8')
+
+def filter_stats_xml(fname, out_file, lanes):
+    """Copy of ConversionStats.xml or DemultiplexingStats.xml keeping lanes."""
+    tree = ET.parse(fname)
+    for parent in tree.getroot().iter():
+        for child in list(parent):
+            if child.tag == 'Lane' and int(child.get('number')) not in lanes:
+                parent.remove(child)
+    tree.write(out_file, xml_declaration=True, encoding='utf-8')
+
+def merge_text(fnames, out_file):
+    """Concatenate tab separated reports, keeping the first header line once."""
+    header = None
+    with open(out_file, 'w') as outfile:
+        for fname in fnames:
+            with open(fname) as infile:
+                for i, line in enumerate(infile):
+                    if i == 0:
+                        if header is not None and line == header:
+                            continue
+                        header = header or line
+                    outfile.write(line)
+
+def sample_numbers(sheet):
+    """
+    bcl2fastq's S number of each sample of a sheet: its order of first
+    appearance, a sample listed in several lanes keeping one number.
+    """
+    ids = dict.fromkeys(row.get('Sample_ID') or row.get('Sample_Name')
+                        for row in sheet.rows)
+    return({sample_id: i + 1 for i, sample_id in enumerate(ids)})
+
+def renumbering(shard_sheet, full_sheet):
+    """S numbers of a shard's sheet mapped to those of the full sheet."""
+    full = sample_numbers(full_sheet)
+    return({number: full[sample_id] for sample_id, number
+            in sample_numbers(shard_sheet).items() if sample_id in full})
+
+def renumber(fname, numbers):
+    """FASTQ name with its S number mapped through numbers."""
+    match = SAMPLE_NUMBER.match(fname)
+    if not match or int(match.group(2)) not in numbers:
+        return(fname)
+    return('%s_S%d%s' % (match.group(1), numbers[int(match.group(2))],
+                         match.group(3)))
+
+def move_tree(src, dest, numbers=None):
+    """
+    Move every file under src to the same relative path under dest,
+    renumbering FASTQs through numbers if given.
+    """
+    for root, dirs, files in os.walk(src):
+        target = os.path.join(dest, os.path.relpath(root, src))
+        os.makedirs(target, exist_ok=True)
+        for fname in files:
+            new_name = renumber(fname, numbers) if numbers else fname
+            os.replace(os.path.join(root, fname),
+                       os.path.join(target, new_name))
+
+def stats_lanes(shard):
+    fname = os.path.join(shard, 'Stats', 'Stats.json')
+    if not os.path.exists(fname):
+        return([])
+    with open(fname) as infile:
+        return([entry['LaneNumber'] for entry in
+                json.load(infile).get('ConversionResults', [])])
+
+def shard_numbers(out_path, name, full_sheet):
+    """
+    S number mapping of a shard demultiplexed from the slice sheet
+    SampleSheet_<name>.csv in out_path, None without one.
+    """
+    fname = os.path.join(out_path, 'SampleSheet_%s.csv' % name)
+    if full_sheet is None or not os.path.exists(fname):
+        return(None)
+    return(renumbering(read_sample_sheet(fname), full_sheet))
+
+def merge_shards(out_path, shard_paths):
+    """
+    Move FASTQs of each shard into out_path and merge their Stats. bcl2fastq
+    numbers the samples of each slice sheet from S1, so FASTQs are renamed
+    to their S numbers in the full SampleSheet.csv of out_path. When
+    shards share lanes (index geometry passes), their Undetermined FASTQs
+    would collide and each holds the samples of the other passes, so they
+    are kept apart under Undetermined/<shard>, and their per-lane summaries
+    (e.g. FastqSummaryF1L1.txt) under Stats/<shard>.
+    """
+    lanes = [lane for shard in shard_paths for lane in stats_lanes(shard)]
+    overlapping = len(lanes) != len(set(lanes))
+    stats_dir = os.path.join(out_path, 'Stats')
+    os.makedirs(stats_dir, exist_ok=True)
+    full_sheet = os.path.join(out_path, 'SampleSheet.csv')
+    full_sheet = read_sample_sheet(full_sheet) \
+        if os.path.exists(full_sheet) else None
+    merged_files = ['Stats.json', 'ConversionStats.xml',
+                    'DemultiplexingStats.xml', 'AdapterTrimming.txt']
+    for name in merged_files:
+        fnames = [os.path.join(shard, 'Stats', name) for shard in shard_paths]
+        fnames = [f for f in fnames if os.path.exists(f)]
+        if not fnames:
+            continue
+        if name.endswith('.json'):
+            merge_stats_json(fnames, os.path.join(stats_dir, name))
+        elif name.endswith('.txt'):
+            merge_text(fnames, os.path.join(stats_dir, name))
+        else:
+            merge_stats_xml(fnames, os.path.join(stats_dir, name))
+        for fname in fnames:
+            os.remove(fname)
+    for shard in shard_paths:
+        name = os.path.basename(os.path.normpath(shard))
+        # html reports cannot be merged, keep one per shard
+        reports = os.path.join(shard, 'Reports')
+        if os.path.isdir(reports):
+            move_tree(reports, os.path.join(out_path, 'Reports', name))
+            shutil.rmtree(reports)
+        if overlapping:
+            undetermined = os.path.join(out_path, 'Undetermined', name)
+            for fname in os.listdir(shard):
+                if fname.startswith('Undetermined_'):
+                    os.makedirs(undetermined, exist_ok=True)
+                    os.replace(os.path.join(shard, fname),
+                               os.path.join(undetermined, fname))
+            stats = os.path.join(shard, 'Stats')
+            if os.path.isdir(stats):
+                move_tree(stats, os.path.join(stats_dir, name))
+                shutil.rmtree(stats)
+        # per-lane summaries of shards over disjoint lanes do not collide
+        move_tree(shard, out_path, shard_numbers(out_path, name, full_sheet))
+        shutil.rmtree(shard)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('out_path', help='Final demultiplexing output directory')
+    parser.add_argument('shards', nargs='+',
+                        help='Output directories of the lane shards')
+    args = parser.parse_args()
+    merge_shards(args.out_path, args.shards)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# tenxtags.py - lookup from 10x Genomics sample index oligos to index set
+# names, compiled once from the tag tables and cached until they change.
+
+import argparse
+import hashlib
+import os
+import pickle
+import sys
+import tempfile
+import pipelineparams as params
+
+# None disables the on-disk cache
+CACHE_DIR = getattr(params, 'tenx_tag_cache_path',
+                    os.path.join(os.path.expanduser('~'), '.cache',
+                                 'alademux', 'tenx_tags'))
+# bumped when TagIndex changes, so older pickles are rebuilt
+CACHE_VERSION = 1
+COMPLEMENT = str.maketrans('ACGTN', 'TGCAN')
+# instruments reading i5 on the reverse strand (workflow B), see the 10x
+# Genomics and Illumina documentation on dual index orientation
+REVERSE_I5 = ['NextSeq', 'MiniSeq', 'iSeq', 'HiSeq3000', 'HiSeq4000',
+              'HiSeqX']
+FORWARD_I5 = ['MiSeq', 'HiSeq2500', 'HiSeq2000']
+
+_compiled = {}
+
+def reverse_complement(seq):
+    return(seq.upper().translate(COMPLEMENT)[::-1])
+
+def add_oligo(lookup, oligo, tag):
+    # an oligo of a set wins over the reverse complement of another
+    if lookup.get(oligo, (None, True))[1]:
+        lookup[oligo] = (tag, False)
+    lookup.setdefault(reverse_complement(oligo), (tag, True))
+
+class TagIndex:
+    """
+    Index set of every oligo of a tag table and of its reverse complement.
+    The table has the columns index (an i7 oligo) and tag (the set name),
+    and optionally index2, the i5 oligo of dual index sets as read on the
+    forward strand (workflow A). A 4-oligo single index set has one row per
+    oligo.
+    """
+    def __init__(self):
+        # set name: {'i7': set of oligos, 'i5': oligo or None}
+        self.sets = {}
+        # oligo: (set name, True if it is the reverse complement)
+        self.i7 = {}
+        self.i5 = {}
+    def add(self, index, tag, index2=None):
+        index = index.strip().upper()
+        entry = self.sets.setdefault(tag, {'i7': set(), 'i5': None})
+        entry['i7'].add(index)
+        add_oligo(self.i7, index, tag)
+        if index2:
+            index2 = index2.strip().upper()
+            entry['i5'] = index2
+            add_oligo(self.i5, index2, tag)
+    def resolve(self, index, index2=None, i5_reverse=None):
+        """
+        Set name of a sample's index (and index2), or None, with notes on
+        anything unusual about the match. i5_reverse is the orientation of
+        the run's i5 read, None if unknown.
+        """
+        index = (index or '').strip().upper()
+        index2 = (index2 or '').strip().upper()
+        notes = []
+        if index in self.sets:
+            return(index, notes)
+        name, reverse = self.i7.get(index, (None, False))
+        if reverse:
+            notes.append('index entered as the reverse complement of %s' %
+                         name)
+        if index2 and index2 in self.i5:
+            name2, reverse2 = self.i5[index2]
+            if name is None:
+                name = name2
+                notes.append('index not in a 10x set, matched on index2')
+            elif name2 != name:
+                notes.append('index matches %s but index2 matches %s' %
+                             (name, name2))
+            if name2 == name and i5_reverse is not None and \
+               reverse2 != i5_reverse:
+                notes.append('index2 is not in the orientation read by this '
+                             'instrument')
+        return(name, notes)
+
+def compile_tags(fname):
+    index = TagIndex()
+    with open(fname) as infile:
+        header = infile.readline().rstrip('\r\n').split('\t')
+        columns = [header.index(col) if col in header else None
+                   for col in ['index', 'tag', 'index2']]
+        if columns[0] is None or columns[1] is None:
+            raise ValueError('%s needs the columns index and tag' % fname)
+        for line in infile:
+            fields = line.rstrip('\r\n').split('\t')
+            if len(fields) <= max(columns[:2]) or not fields[columns[0]]:
+                continue
+            index2 = fields[columns[2]] \
+                if columns[2] is not None and len(fields) > columns[2] \
+                else None
+            index.add(fields[columns[0]], fields[columns[1]].strip(), index2)
+    return(index)
+
+def cache_file(fname):
+    digest = hashlib.sha1(os.path.abspath(fname).encode()).hexdigest()[:16]
+    return(os.path.join(CACHE_DIR, '%s_%s.pickle' %
+                        (os.path.basename(fname), digest)))
+
+def load_tags(fname):
+    """
+    TagIndex of a tag table, reused from memory or from the cache on disk
+    while the table's modification time and size are unchanged.
+    """
+    stat = os.stat(fname)
+    key = (CACHE_VERSION, os.path.abspath(fname), stat.st_mtime_ns,
+           stat.st_size)
+    if key in _compiled:
+        return(_compiled[key])
+    cached = cache_file(fname) if CACHE_DIR else None
+    index = None
+    if cached and os.path.exists(cached):
+        try:
+            with open(cached, 'rb') as infile:
+                stored_key, index = pickle.load(infile)
+            if stored_key != key:
+                index = None
+        except Exception:
+            index = None
+    if index is None:
+        index = compile_tags(fname)
+        if cached:
+            try:
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                # written aside and renamed, readers never see half a file
+                fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+                with os.fdopen(fd, 'wb') as outfile:
+                    pickle.dump((key, index), outfile,
+                                pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, cached)
+            except OSError:
+                # the cache is an optimisation only
+                pass
+    _compiled[key] = index
+    return(index)
+
+def i5_reverse_complement(run):
+    """
+    True if the instrument of a run reads i5 on the reverse strand, False
+    on the forward strand, None if unknown (e.g. no RunInfo.xml).
+    """
+    if run is None:
+        return(None)
+    instrument = run.instrument()
+    if instrument.startswith('NovaSeq'):
+        if instrument.startswith('NovaSeqX'):
+            return(True)
+        # v1.5 reagents read i5 on the reverse strand, v1.0 on the forward
+        return(run.parameters.get('SbsConsumableVersion') == '3')
+    if any(instrument.startswith(name) for name in REVERSE_I5):
+        return(True)
+    if any(instrument.startswith(name) for name in FORWARD_I5):
+        return(False)
+    return(None)
+
+def main():
+    parser = argparse.ArgumentParser(description='''Look up the 10x index
+                                     set of index sequences.''')
+    parser.add_argument('tags', help='Tag table, e.g. 10x_tags.tsv')
+    parser.add_argument('index', nargs='+',
+                        help='index, or index,index2 of dual index sets')
+    args = parser.parse_args()
+    tags = load_tags(args.tags)
+    for value in args.index:
+        name, notes = tags.resolve(*value.split(',')[:2])
+        print('%s\t%s%s' % (value, name or 'missing',
+                            ''.join('\t' + note for note in notes)))
+    return(0)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# threadplanner.py - choose bcl2fastq loading, processing and writing thread
+# counts from the host, the run geometry and past demultiplexing timings.
+
+import json
+import os
+from runinfo import load_run
+
+# rough resident memory of one bcl2fastq thread of each kind
+MEM_PER_LOADING = 1024**3
+MEM_PER_PROCESSING = 512 * 1024**2
+MEM_PER_WRITING = 256 * 1024**2
+# loading/writing threads beyond this mostly contend for the same disks
+MAX_IO_THREADS = 8
+SHARED_FS_IO_THREADS = 4
+# past runs count as similar when lanes match and tiles are within 25%
+TILE_TOLERANCE = 0.25
+MIN_HISTORY = 3
+
+class ThreadPlan:
+    def __init__(self, loading, processing, writing):
+        self.loading = loading
+        self.processing = processing
+        self.writing = writing
+        # human readable notes on how the counts were chosen
+        self.reasons = []
+    def args(self):
+        return(['--loading-threads', str(self.loading),
+                '--processing-threads', str(self.processing),
+                '--writing-threads', str(self.writing)])
+    def comment(self):
+        """Shell comment block documenting the plan."""
+        lines = ['# Thread plan: -r %d -p %d -w %d' %
+                 (self.loading, self.processing, self.writing)]
+        lines.extend('#   ' + reason for reason in self.reasons)
+        return('\n'.join(lines) + '\n')
+
+def available_memory():
+    """Bytes of memory available to new processes, None if unknown."""
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return(int(line.split()[1]) * 1024)
+    except OSError:
+        pass
+    try:
+        return(os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE'))
+    except (ValueError, OSError, AttributeError):
+        return(None)
+
+def same_filesystem(path_a, path_b):
+    try:
+        return(os.stat(path_a).st_dev == os.stat(path_b).st_dev)
+    except OSError:
+        return(False)
+
+def run_geometry(run_folder):
+    """(lanes, tiles per lane) from RunInfo.xml, (None, None) if unavailable."""
+    run = load_run(run_folder)
+    if run is None or run.lanes is None:
+        return((None, None))
+    return((run.lanes, run.tiles))
+
+def read_history(fname):
+    """Past runs recorded as JSON lines; missing or bad lines are skipped."""
+    history = []
+    if not fname or not os.path.exists(fname):
+        return(history)
+    with open(fname) as infile:
+        for line in infile:
+            try:
+                history.append(json.loads(line))
+            except ValueError:
+                continue
+    return(history)
+
+def tuned_from_history(history, lanes, tiles):
+    """
+    Thread counts of the fastest similar past run per tile, or None when
+    fewer than MIN_HISTORY similar runs have been recorded.
+    """
+    keys = ['loading', 'processing', 'writing', 'wall_seconds']
+    similar = [h for h in history
+               if all(h.get(k) for k in keys)
+               and h.get('lanes') == lanes and h.get('tiles')
+               and abs(h['tiles'] - tiles) <= TILE_TOLERANCE * tiles]
+    if len(similar) < MIN_HISTORY:
+        return(None)
+    best = min(similar, key=lambda h: h['wall_seconds'] / h['tiles'])
+    return(best)
+
+def plan_threads(run_folder, out_path, n_samples=None, history_file=None,
+                 cpus=None, memory=None):
+    """Thread plan for a bcl2fastq run over run_folder writing to out_path."""
+    cpus = cpus or os.cpu_count() or 1
+    memory = memory if memory is not None else available_memory()
+    lanes, tiles = run_geometry(run_folder)
+    plan = ThreadPlan(1, max(1, cpus - 1), 1)
+    plan.reasons.append('%d cores on host' % cpus)
+
+    io_cap = MAX_IO_THREADS
+    if same_filesystem(run_folder, out_path):
+        io_cap = SHARED_FS_IO_THREADS
+        plan.reasons.append('input and output share a filesystem, '
+                            'at most %d loading/writing threads' % io_cap)
+    # one loading thread per lane keeps every lane's BCLs streaming
+    plan.loading = min(io_cap, lanes or 4, max(1, cpus // 4))
+    # bcl2fastq cannot use more writing threads than samples
+    plan.writing = min(io_cap, n_samples or 4, max(1, cpus // 4))
+    if lanes:
+        plan.reasons.append('%d lanes x %d tiles' % (lanes, tiles))
+        # processing works tile by tile
+        if lanes * tiles < plan.processing:
+            plan.processing = lanes * tiles
+            plan.reasons.append('processing capped at %d tiles' %
+                                plan.processing)
+    if n_samples:
+        plan.reasons.append('%d samples in sample sheet' % n_samples)
+
+    best = None
+    if lanes:
+        best = tuned_from_history(read_history(history_file), lanes, tiles)
+    if best:
+        plan.loading = min(best['loading'], io_cap)
+        plan.processing = min(best['processing'], max(1, cpus - 1))
+        plan.writing = min(best['writing'], io_cap)
+        plan.reasons.append('tuned from past run %s (%.0f s)' %
+                            (best.get('run_id', '?'), best['wall_seconds']))
+
+    if memory:
+        def needed():
+            return(plan.loading * MEM_PER_LOADING +
+                   plan.processing * MEM_PER_PROCESSING +
+                   plan.writing * MEM_PER_WRITING)
+        if needed() > memory:
+            while needed() > memory and plan.processing > 1:
+                plan.processing -= 1
+            plan.reasons.append('%.1f GiB available memory, processing '
+                                'reduced to %d' %
+                                (memory / 1024**3, plan.processing))
+    return(plan)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# timing.py - spans timing the phases of setting up and running a
+# demultiplexing, written as JSON lines per run.
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+TIMINGS = 'timings.jsonl'
+# fields of a demux history record, see threadplanner.py and estimator.py;
+# a record needs the first two
+HISTORY_FIELDS = ['lanes', 'tiles', 'loading', 'processing', 'writing',
+                  'demux_type', 'cycles', 'data_cycles', 'index_reads',
+                  'samples', 'cpus']
+# peak memory in kB of each demultiplexing command, see demuxer.sh measure()
+PEAK_RSS = 'peak_rss_kb.txt'
+
+_local = threading.local()
+
+def append_record(fname, record):
+    """Append one JSON line; a single write keeps concurrent writers whole."""
+    with open(fname, 'a') as outfile:
+        outfile.write(json.dumps(record, sort_keys=True) + '\n')
+
+class SpanLog:
+    def __init__(self, fname=None, run_id=None):
+        self.fname = fname
+        self.run_id = run_id
+        self.lock = threading.Lock()
+    def write(self, record):
+        if not self.fname:
+            return
+        with self.lock:
+            append_record(self.fname, record)
+    @contextmanager
+    def span(self, name, **fields):
+        """
+        Time the enclosed block. The yielded dict may be given more fields,
+        e.g. counts, before the record is written.
+        """
+        record = {'run_id': self.run_id, 'span': name,
+                  'start': round(time.time(), 3), 'host': socket.gethostname()}
+        record.update(fields)
+        start = time.perf_counter()
+        try:
+            yield record
+            record['status'] = 'ok'
+        except BaseException as err:
+            record['status'] = 'error'
+            record['error'] = type(err).__name__
+            raise
+        finally:
+            record['seconds'] = round(time.perf_counter() - start, 4)
+            self.write(record)
+
+def configure(fname, run_id):
+    """Send the spans of the calling thread to fname."""
+    _local.log = SpanLog(fname, run_id)
+    return(_local.log)
+
+def current():
+    log = getattr(_local, 'log', None)
+    if log is None:
+        log = _local.log = SpanLog()
+    return(log)
+
+def span(name, **fields):
+    """Span written to the log configured for this thread, if any."""
+    return(current().span(name, **fields))
+
+def stage_outputs(out_path):
+    """
+    Bytes of FASTQ written to out_path and, when measured, the peak memory
+    of the demultiplexing commands, summed over passes run concurrently.
+    """
+    outputs = {'output_bytes': 0}
+    for root, dirs, files in os.walk(out_path):
+        outputs['output_bytes'] += sum(
+            os.path.getsize(os.path.join(root, fname)) for fname in files
+            if fname.endswith('.fastq.gz'))
+    fname = os.path.join(out_path, PEAK_RSS)
+    if os.path.exists(fname):
+        with open(fname) as infile:
+            kilobytes = [int(line) for line in infile if line.strip().isdigit()]
+        if kilobytes:
+            outputs['peak_rss'] = 1024 * sum(kilobytes)
+        # a rerun of the stage measures afresh
+        os.remove(fname)
+    return(outputs)
+
+def main():
+    """
+    Record a span of a shell stage started at a given epoch time, e.g.
+    timing.py timings.jsonl RUN bcl2fastq $START loading=4
+    With --history, also append a demux history record for threadplanner.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fname', help='JSON lines file of the run')
+    parser.add_argument('run_id')
+    parser.add_argument('span', help='Name of the stage')
+    parser.add_argument('start', type=float, help='Start, seconds since epoch')
+    parser.add_argument('fields', nargs='*', metavar='key=value')
+    parser.add_argument('--history', help='Demux history file to append to')
+    args = parser.parse_args()
+    end = time.time()
+    record = {'run_id': args.run_id, 'span': args.span,
+              'start': args.start, 'seconds': round(end - args.start, 3),
+              'host': socket.gethostname(), 'status': 'ok'}
+    for field in args.fields:
+        key, value = field.split('=', 1)
+        try:
+            record[key] = json.loads(value)
+        except ValueError:
+            record[key] = value
+    append_record(args.fname, record)
+    if args.history and record.get('lanes') and record.get('tiles'):
+        history = {k: record[k] for k in HISTORY_FIELDS if k in record}
+        history.update({'run_id': args.run_id,
+                        'wall_seconds': record['seconds'],
+                        'date': time.strftime('%Y-%m-%d')})
+        history.update(stage_outputs(os.path.dirname(args.fname) or '.'))
+        append_record(args.history, history)
+    return(0)
+
+if __name__ == "__main__":
+    sys.exit(main())
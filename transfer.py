@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# transfer.py - copy the project folders of a demultiplexing output to GNomEx
+# with a bounded number of concurrent streams, checksumming while copying and
+# recording progress in a manifest so an interrupted transfer resumes.
+
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from samplesheet import read_sample_sheet
+import pipelineparams as params
+
+# read/write buffer of each copy stream
+BUFFER_SIZE = 8 * 1024**2
+# concurrent copy streams, kept low on the shared filesystem
+STREAMS = getattr(params, 'transfer_streams', 4)
+MANIFEST = 'transfer_manifest.tsv'
+MANIFEST_COLUMNS = ['path', 'size', 'mtime', 'md5', 'destination']
+CHECKSUM_FILE = 'md5_checksums.txt'
+
+class Manifest:
+    """
+    Tab separated record of copied files, appended to as each copy finishes.
+    Files already recorded with the same size and mtime are not copied again.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.path.exists(fname):
+            with open(fname) as infile:
+                for line in infile:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) != len(MANIFEST_COLUMNS) or \
+                       fields[0] == MANIFEST_COLUMNS[0]:
+                        # header, or a line cut short by an interruption
+                        continue
+                    entry = dict(zip(MANIFEST_COLUMNS, fields))
+                    self.entries[entry['path']] = entry
+        else:
+            with open(fname, 'w') as outfile:
+                outfile.write('\t'.join(MANIFEST_COLUMNS) + '\n')
+    def done(self, path, st):
+        """Whether path was copied with this size and mtime and is still there."""
+        entry = self.entries.get(path)
+        return(entry is not None and
+               int(entry['size']) == st.st_size and
+               float(entry['mtime']) == st.st_mtime and
+               os.path.exists(entry['destination']) and
+               os.path.getsize(entry['destination']) == st.st_size)
+    def add(self, path, st, md5, destination):
+        entry = {'path': path, 'size': str(st.st_size),
+                 'mtime': repr(st.st_mtime), 'md5': md5,
+                 'destination': destination}
+        with self.lock:
+            self.entries[path] = entry
+            with open(self.fname, 'a') as outfile:
+                outfile.write('\t'.join(entry[k] for k in MANIFEST_COLUMNS)
+                              + '\n')
+
+def copy_with_md5(src, dest, buffer_size=BUFFER_SIZE):
+    """Copy src to dest in one read pass, returning the MD5 of the data."""
+    md5 = hashlib.md5()
+    part = dest + '.part'
+    with open(src, 'rb') as infile, open(part, 'wb') as outfile:
+        while True:
+            block = infile.read(buffer_size)
+            if not block:
+                break
+            md5.update(block)
+            outfile.write(block)
+    shutil.copystat(src, part)
+    os.replace(part, dest)
+    return(md5.hexdigest())
+
+def project_destination(pattern, run_id, project):
+    """
+    GNomEx folder of a project, from a pattern such as
+    /Repository/MicroarrayData/{year}/{project}/Fastq where year comes
+    from the run id date.
+    """
+    year = '20' + run_id[:2] if run_id[:2].isdigit() else time.strftime('%Y')
+    return(pattern.format(year=year, project=project, run_id=run_id))
+
+def project_folders(out_path, projects):
+    """
+    Folder of each project relative to out_path. bcl2fastq writes projects
+    at the top of its output, cellranger mkfastq under a flowcell folder.
+    """
+    subdirs = sorted(name for name in os.listdir(out_path)
+                     if os.path.isdir(os.path.join(out_path, name)))
+    folders = {}
+    for project in projects:
+        if project in subdirs:
+            folders[project] = project
+            continue
+        for name in subdirs:
+            if os.path.isdir(os.path.join(out_path, name, project)):
+                folders[os.path.join(name, project)] = project
+    return(folders)
+
+def project_files(out_path, folders):
+    """(relative path, project folder) of every file under the folders."""
+    files = []
+    for folder in sorted(folders):
+        top = os.path.join(out_path, folder)
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames.sort()
+            for name in sorted(filenames):
+                files.append((os.path.relpath(os.path.join(dirpath, name),
+                                              out_path), folder))
+    return(files)
+
+def transfer(out_path, run_id, pattern, streams=STREAMS, manifest=None):
+    """
+    Copy the Sample_Project folders named in SampleSheet.csv. Returns the
+    number of project folders found and of files copied, skipped and failed.
+    """
+    sheet = read_sample_sheet(os.path.join(out_path, 'SampleSheet.csv'))
+    projects = set(row['Sample_Project'] for row in sheet.rows
+                   if row.get('Sample_Project'))
+    folders = project_folders(out_path, projects)
+    manifest = Manifest(manifest or os.path.join(out_path, MANIFEST))
+    destinations = {folder: project_destination(pattern, run_id, project)
+                    for folder, project in folders.items()}
+    checksums = {dest: [] for dest in destinations.values()}
+    counts = {'projects': len(folders), 'copied': 0, 'skipped': 0,
+              'failed': 0}
+    lock = threading.Lock()
+    def copy(item):
+        path, folder = item
+        src = os.path.join(out_path, path)
+        dest = os.path.join(destinations[folder],
+                            os.path.relpath(path, folder))
+        try:
+            st = os.stat(src)
+            if manifest.done(path, st):
+                status = 'skipped'
+                md5 = manifest.entries[path]['md5']
+            else:
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                md5 = copy_with_md5(src, dest)
+                manifest.add(path, st, md5, dest)
+                status = 'copied'
+        except OSError as err:
+            print('Failed to copy %s: %s' % (src, err))
+            status = 'failed'
+            md5 = None
+        with lock:
+            counts[status] += 1
+            if md5:
+                checksums[destinations[folder]].append(
+                    (md5, os.path.relpath(path, folder)))
+    with ThreadPoolExecutor(max_workers=max(1, streams)) as pool:
+        list(pool.map(copy, project_files(out_path, folders)))
+    # md5sum -c compatible list next to the copied files
+    for destination, sums in checksums.items():
+        if sums:
+            fname = os.path.join(destination, CHECKSUM_FILE)
+            with open(fname, 'w') as outfile:
+                for md5, path in sorted(sums, key=lambda s: s[1]):
+                    outfile.write('%s  %s\n' % (md5, path))
+    return(counts)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('out_path', help='Demultiplexing output directory')
+    parser.add_argument('run_id', help='Illumina run ID')
+    parser.add_argument('-d', '--destination',
+                        default=getattr(params, 'gnomex_fastq_path', None),
+                        help='''Destination of each project, formatted with
+                        {project}, {year} and {run_id}''')
+    parser.add_argument('-j', '--streams', type=int, default=STREAMS,
+                        help='Files copied at once')
+    parser.add_argument('--manifest',
+                        help='Manifest file (default: %s in out_path)' %
+                        MANIFEST)
+    args = parser.parse_args()
+    if not args.destination:
+        parser.error('no --destination and no gnomex_fastq_path setting')
+    start = time.time()
+    counts = transfer(args.out_path, args.run_id, args.destination,
+                      args.streams, args.manifest)
+    if not counts['projects']:
+        print('No project folders of SampleSheet.csv found in %s, nothing '
+              'was copied' % args.out_path)
+        return(1)
+    print('Transfer of %s: %d copied, %d already done, %d failed in %.0f s' %
+          (args.run_id, counts['copied'], counts['skipped'], counts['failed'],
+           time.time() - start))
+    return(1 if counts['failed'] else 0)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# watcher.py - daemon watching the Illumina run folder for completed runs,
+# setting up their demultiplexing with alademux and launching demuxer.sh.
+
+import argparse
+import asyncio
+import ctypes
+import ctypes.util
+import json
+import os
+import struct
+import sys
+import time
+
+from logger import Logger
+import pipelineparams as params
+from preview_demux import DemuxTypes
+from send_email import flush_held
+
+# files written by the instrument software once a run is finished
+COMPLETION_MARKERS = ['CopyComplete.txt', 'RTAComplete.txt']
+
+class Inotify:
+    """Minimal inotify binding over libc for watching run directories."""
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        # watch descriptor -> watched directory
+        self.paths = {}
+
+    def add_watch(self, path):
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self.paths[wd] = path
+
+    def read_events(self):
+        """(directory, file name) of every pending event."""
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if wd in self.paths:
+                events.append((self.paths[wd], os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class WatcherState:
+    """Runs already handled, persisted as JSON so restarts skip them."""
+    def __init__(self, fname):
+        self.fname = fname
+        self.runs = {}
+        if os.path.exists(fname):
+            with open(fname) as infile:
+                self.runs = json.load(infile)
+        self.is_new = not os.path.exists(fname)
+
+    def __contains__(self, run_id):
+        return run_id in self.runs
+
+    def set(self, run_id, status, **info):
+        entry = self.runs.setdefault(run_id, {})
+        entry.update(info)
+        entry['status'] = status
+        entry['time'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        dirname = os.path.dirname(self.fname)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp = self.fname + '.tmp'
+        with open(tmp, 'w') as outfile:
+            json.dump(self.runs, outfile, indent=2, sort_keys=True)
+        os.replace(tmp, self.fname)
+
+class RunWatcher(Logger):
+    def __init__(self, args):
+        self.args = args
+        self.state = WatcherState(args.state)
+        # runs being debounced or set up, never queued twice
+        self.active = set()
+        self.tasks = set()
+        self.slots = None
+        self.inotify = None
+
+    def is_complete(self, run_path):
+        return any(os.path.exists(os.path.join(run_path, marker))
+                   for marker in COMPLETION_MARKERS)
+
+    def snapshot(self, run_path):
+        """Sizes and mtimes of the top level entries of a run folder."""
+        entries = []
+        with os.scandir(run_path) as it:
+            for entry in it:
+                st = entry.stat(follow_symlinks=False)
+                entries.append((entry.name, st.st_size, st.st_mtime))
+        return sorted(entries)
+
+    def complete_runs(self):
+        runs = []
+        with os.scandir(self.args.run_path) as it:
+            for entry in it:
+                if entry.is_dir() and self.is_complete(entry.path):
+                    runs.append(entry.name)
+        return sorted(runs)
+
+    def watch_runs(self):
+        """Watch the run repository and every run folder not yet handled."""
+        if self.inotify is None:
+            return
+        watched = set(self.inotify.paths.values())
+        candidates = [self.args.run_path]
+        with os.scandir(self.args.run_path) as it:
+            for entry in it:
+                if entry.is_dir() and entry.name not in self.state:
+                    candidates.append(entry.path)
+        for path in candidates:
+            if path not in watched:
+                try:
+                    self.inotify.add_watch(path)
+                except OSError as err:
+                    self.Log('Cannot watch %s: %s' % (path, err))
+
+    def on_inotify(self):
+        for dirname, name in self.inotify.read_events():
+            if dirname == self.args.run_path:
+                path = os.path.join(dirname, name)
+                if os.path.isdir(path):
+                    self.watch_runs()
+                    self.consider(name)
+            elif name in COMPLETION_MARKERS:
+                self.consider(os.path.basename(dirname))
+
+    def consider(self, run_id):
+        run_path = os.path.join(self.args.run_path, run_id)
+        if run_id in self.state or run_id in self.active:
+            return
+        if not self.is_complete(run_path):
+            return
+        self.active.add(run_id)
+        task = asyncio.ensure_future(self.handle(run_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def settle(self, run_path):
+        """Wait until the run folder stops changing (partial copies)."""
+        before = self.snapshot(run_path)
+        while True:
+            await asyncio.sleep(self.args.settle)
+            after = self.snapshot(run_path)
+            if after == before:
+                return
+            before = after
+
+    async def handle(self, run_id):
+        run_path = os.path.join(self.args.run_path, run_id)
+        try:
+            await self.settle(run_path)
+            loop = asyncio.get_running_loop()
+            types, mixed = await loop.run_in_executor(None, DemuxTypes,
+                                                      run_id, True)
+            if not types and not mixed:
+                # GNomEx not filled in yet, the next poll retries
+                self.Log('%s complete but no GNomEx records yet' % run_id)
+                return
+            if mixed:
+                self.Log('%s lanes %s mix library types, demultiplex them '
+                         'by hand' % (run_id, mixed))
+            self.state.set(run_id, 'launching', types=types, mixed=mixed)
+            launches = []
+            for demux_type, lanes in sorted(types.items()):
+                out_demux_path = await self.setup(run_id, demux_type, lanes)
+                if out_demux_path:
+                    launches.append(self.demux(run_id, demux_type,
+                                               out_demux_path))
+            results = await asyncio.gather(*launches)
+            ok = len(results) == len(types) and all(results)
+            self.state.set(run_id, 'done' if ok and not mixed else 'failed')
+        except Exception as err:
+            self.Log('%s failed: %s' % (run_id, err))
+            self.state.set(run_id, 'failed', error=str(err))
+        finally:
+            self.active.discard(run_id)
+            if self.args.digest and not self.active:
+                # every run in flight has finished, mail their digest
+                await asyncio.get_running_loop().run_in_executor(None,
+                                                                 flush_held)
+
+    async def setup(self, run_id, demux_type, lanes):
+        """Run alademux.py for one type; returns its output folder or None."""
+        cmd = [sys.executable,
+               os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'alademux.py'),
+               '-r', run_id, '-t', demux_type,
+               '-i', self.args.run_path, '-o', self.args.out_path,
+               '-l'] + [str(lane) for lane in lanes]
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT)
+        output, _ = await proc.communicate()
+        output = output.decode(errors='replace')
+        if proc.returncode != 0:
+            self.Log('alademux failed for %s (%s):\n%s' %
+                     (run_id, demux_type, output))
+            return None
+        for line in output.splitlines():
+            if line.startswith('cd '):
+                return line[3:].strip()
+        return None
+
+    async def demux(self, run_id, demux_type, out_demux_path):
+        if self.args.dry_run:
+            self.Log('Dry run, not starting %s/demuxer.sh' % out_demux_path)
+            return True
+        async with self.slots:
+            self.Log('Starting %s demultiplexing of %s in %s' %
+                     (demux_type, run_id, out_demux_path))
+            env = dict(os.environ)
+            if self.args.digest:
+                env['ALADEMUX_MAIL_HOLD'] = '1'
+            with open(os.path.join(out_demux_path, 'nohup.out'), 'ab') as log:
+                proc = await asyncio.create_subprocess_exec(
+                    './demuxer.sh', cwd=out_demux_path, env=env,
+                    stdout=log, stderr=asyncio.subprocess.STDOUT)
+                returncode = await proc.wait()
+        self.Log('%s demultiplexing of %s finished with status %d' %
+                 (demux_type, run_id, returncode))
+        return returncode == 0
+
+    async def poll(self):
+        """Periodic scan; the only trigger when inotify is unavailable."""
+        while True:
+            for run_id in self.complete_runs():
+                self.consider(run_id)
+            self.watch_runs()
+            await asyncio.sleep(self.args.poll)
+
+    async def run(self):
+        self.slots = asyncio.Semaphore(self.args.jobs)
+        if self.state.is_new and not self.args.backfill:
+            # first start: runs finished before the watcher are not ours
+            for run_id in self.complete_runs():
+                self.state.set(run_id, 'preexisting')
+        try:
+            self.inotify = Inotify()
+            asyncio.get_running_loop().add_reader(self.inotify.fd,
+                                                self.on_inotify)
+            self.watch_runs()
+            self.Log('Watching %s with inotify' % self.args.run_path)
+        except (OSError, AttributeError) as err:
+            self.inotify = None
+            self.Log('inotify unavailable (%s), polling every %d s' %
+                     (err, self.args.poll))
+        await self.poll()
+
+def main():
+    default_state = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'alademux', 'watcher_state.json')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--run_path', default=params.illumina_run_path,
+                        help='Directory holding Illumina run folders')
+    parser.add_argument('-o', '--out_path', default=params.demux_result_path,
+                        help='Path to demultiplexing results')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of demuxer.sh scripts run at once')
+    parser.add_argument('--poll', type=int, default=300,
+                        help='Seconds between scans of the run folder')
+    parser.add_argument('--settle', type=int, default=600,
+                        help='''Seconds a completed run folder must stay
+                        unchanged before demultiplexing''')
+    parser.add_argument('--state', default=getattr(params, 'watcher_state',
+                                                   default_state),
+                        help='JSON file recording handled runs')
+    parser.add_argument('--backfill', action='store_true',
+                        help='''On first start also demultiplex runs that
+                        completed before the watcher was started''')
+    parser.add_argument('--digest', action='store_true',
+                        help='''Hold the notifications of runs finishing
+                        together and mail them as one digest''')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Set up runs with alademux but do not start demuxer.sh')
+    args = parser.parse_args()
+    asyncio.run(RunWatcher(args).run())
+
+if __name__ == "__main__":
+    main()